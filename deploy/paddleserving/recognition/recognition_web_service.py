@@ -14,12 +14,9 @@
 import base64
 import json
 import logging
-import os
-import pickle
 import sys
 
 import cv2
-import faiss
 import numpy as np
 from paddle_serving_app.reader import BGR2RGB
 from paddle_serving_app.reader import Div
@@ -29,6 +26,8 @@ from paddle_serving_app.reader import Resize
 from paddle_serving_app.reader import Sequential
 from paddle_serving_app.reader import Transpose
 from paddle_serving_server.web_service import Op, WebService
+from paddleclas.deploy.utils.doc_store import doc_store_exists, first_valid_doc
+from paddleclas.deploy.utils.index_version import VersionedIndex, index_exists, load_index, resolve_index_dir
 
 
 class DetOp(Op):
@@ -113,16 +112,18 @@ class RecOp(Op):
         ])
 
         index_dir = "../../drink_dataset_v2.0/index"
-        assert os.path.exists(os.path.join(
-            index_dir, "vector.index")), "vector.index not found ..."
-        assert os.path.exists(os.path.join(
-            index_dir, "id_map.pkl")), "id_map.pkl not found ... "
-
-        self.searcher = faiss.read_index(
-            os.path.join(index_dir, "vector.index"))
-
-        with open(os.path.join(index_dir, "id_map.pkl"), "rb") as fd:
-            self.id_map = pickle.load(fd)
+        assert index_exists(
+            resolve_index_dir(index_dir)), "vector.index not found ..."
+        assert doc_store_exists(
+            resolve_index_dir(index_dir)), "doc_store not found ... "
+
+        # open the index with mmap, so all serving workers on one host share
+        # the index pages, and hot-swap it when a new version is published
+        self.use_mmap = True
+        self.warmup_queries = 1024
+        self.index = VersionedIndex(
+            index_dir, lambda path: load_index(
+                path, use_mmap=self.use_mmap, warmup=self.warmup_queries))
 
         self.rec_nms_thresold = 0.05
         self.rec_score_thres = 0.5
@@ -188,15 +189,17 @@ class RecOp(Op):
                 np.sum(np.square(batch_features), axis=1, keepdims=True))
             batch_features = np.divide(batch_features, feas_norm)
 
-        scores, docs = self.searcher.search(batch_features, self.return_k)
+        snapshot = self.index.get()
+        scores, docs = snapshot.searcher.search(batch_features, self.return_k)
 
         results = []
         for i in range(scores.shape[0]):
             pred = {}
-            if scores[i][0] >= self.rec_score_thres:
+            top = first_valid_doc(docs[i], snapshot.id_map)
+            if top >= 0 and scores[i][top] >= self.rec_score_thres:
                 pred["bbox"] = [int(x) for x in self.det_boxes[i]["bbox"]]
-                pred["rec_docs"] = self.id_map[docs[i][0]].split()[1]
-                pred["rec_scores"] = scores[i][0]
+                pred["rec_docs"] = snapshot.id_map[docs[i][top]].split()[1]
+                pred["rec_scores"] = scores[i][top]
                 results.append(pred)
 
         # do NMS
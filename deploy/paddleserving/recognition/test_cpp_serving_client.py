@@ -12,32 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
-import pickle
-
 import cv2
-import faiss
 import numpy as np
 from paddle_serving_client import Client
+from paddleclas.deploy.utils.doc_store import doc_store_exists, first_valid_doc
+from paddleclas.deploy.utils.index_version import index_exists, load_index, resolve_index_dir
 
 rec_nms_thresold = 0.05
 rec_score_thres = 0.5
 feature_normalize = True
 return_k = 1
 index_dir = "../../drink_dataset_v2.0/index"
+use_mmap = True
 
 
 def init_index(index_dir):
-    assert os.path.exists(os.path.join(
-        index_dir, "vector.index")), "vector.index not found ..."
-    assert os.path.exists(os.path.join(
-        index_dir, "id_map.pkl")), "id_map.pkl not found ... "
-
-    searcher = faiss.read_index(os.path.join(index_dir, "vector.index"))
+    index_dir = resolve_index_dir(index_dir)
+    assert index_exists(index_dir), "vector.index not found ..."
+    assert doc_store_exists(index_dir), "doc_store not found ... "
 
-    with open(os.path.join(index_dir, "id_map.pkl"), "rb") as fd:
-        id_map = pickle.load(fd)
-    return searcher, id_map
+    return load_index(index_dir, use_mmap=use_mmap)
 
 
 # get box
@@ -84,10 +78,11 @@ def postprocess(fetch_dict, feature_normalize, det_boxes, searcher, id_map,
     results = []
     for i in range(scores.shape[0]):
         pred = {}
-        if scores[i][0] >= rec_score_thres:
+        top = first_valid_doc(docs[i], id_map)
+        if top >= 0 and scores[i][top] >= rec_score_thres:
             pred["bbox"] = [int(x) for x in det_boxes[i, 2:]]
-            pred["rec_docs"] = id_map[docs[i][0]].split()[1]
-            pred["rec_scores"] = scores[i][0]
+            pred["rec_docs"] = id_map[docs[i][top]].split()[1]
+            pred["rec_scores"] = scores[i][top]
             results.append(pred)
 
     # do NMS
@@ -0,0 +1,208 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare the recall, memory and latency of index methods on the features
+extracted by build_gallery.py, e.g.
+
+    python python/benchmark_index.py -c configs/inference_general.yaml \
+        --index_methods Flat,HNSW32,IVF,IVFSQ8,IVFPQ,OPQ --rerank_k 100
+
+Recall@k is measured against an exact flat search. Unless
+--query_features(.npy) is given, queries are sampled from the gallery
+features and held out of the indexed gallery, so no query finds itself. With
+IndexProcess.use_projection, gallery and query features are projected first.
+"""
+import time
+
+import faiss
+import numpy as np
+from paddleclas.deploy.python.build_gallery import load_gallery_features
+from paddleclas.deploy.utils import config, logger
+from paddleclas.deploy.utils.index_factory import RerankIndex, get_index_method
+from paddleclas.deploy.utils.projection import load_projection
+
+
+def parse_args():
+    parser = config.parser()
+    parser.add_argument('--index_methods', type=str,
+                        default="Flat,HNSW32,IVF,IVFSQ8,IVFPQ,OPQ")
+    parser.add_argument('--query_features', type=str, default=None)
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--topk', type=int, default=5)
+    parser.add_argument('--rerank_k', type=int, default=0)
+    parser.add_argument(
+        '--max_gallery',
+        type=int,
+        default=0,
+        help="use the first N gallery features, 0 for all")
+    parser.add_argument(
+        '--max_train',
+        type=int,
+        default=100000,
+        help="number of features to train IVF/PQ with")
+    return parser.parse_args()
+
+
+def metric_type(dist_type):
+    return faiss.METRIC_INNER_PRODUCT if dist_type == "IP" else faiss.METRIC_L2
+
+
+def exact_search(gallery, queries, k, dist_type="IP"):
+    index = faiss.IndexFlat(gallery.shape[1], metric_type(dist_type))
+    index.add(gallery)
+    return index.search(queries, k)[1]
+
+
+def build_index(gallery,
+                index_method,
+                dist_type="IP",
+                max_train=100000,
+                seed=0):
+    index = faiss.index_factory(gallery.shape[1], index_method,
+                                metric_type(dist_type))
+    if not index.is_trained:
+        rng = np.random.RandomState(seed)
+        num_train = min(max_train, gallery.shape[0])
+        train = gallery[np.sort(
+            rng.choice(
+                gallery.shape[0], num_train, replace=False))]
+        index.train(train)
+    index.add(gallery)
+    return index
+
+
+def index_memory(index):
+    """bytes of the serialized index, the float vectors kept for re-ranking
+    are on disk and not counted"""
+    if isinstance(index, RerankIndex):
+        index = index.index
+    return faiss.serialize_index(index).nbytes
+
+
+def recall_at_k(ids, gt):
+    k = gt.shape[1]
+    hits = [len(np.intersect1d(i[:k], g)) for i, g in zip(ids, gt)]
+    return float(np.sum(hits)) / gt.size
+
+
+def measure(searcher, queries, gt, k, batch_size=1):
+    """return recall@k, qps and p50/p99 latency(ms) of batches of queries"""
+    latencies = []
+    ids = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        tic = time.perf_counter()
+        _, batch_ids = searcher.search(batch, k)
+        latencies.append(time.perf_counter() - tic)
+        ids.append(batch_ids)
+    latencies = np.array(latencies) * 1000
+    return {
+        "recall": recall_at_k(np.concatenate(ids), gt),
+        "qps": len(queries) / max(latencies.sum() / 1000, 1e-9),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def load_features(config, max_gallery=0, projection=None):
+    """return the valid gallery features and their rows in the data_file"""
+    gallery_features, valid = load_gallery_features(config)
+    rows = np.nonzero(valid)[0]
+    if max_gallery > 0:
+        rows = rows[:max_gallery]
+    gallery = np.ascontiguousarray(gallery_features[rows], dtype=np.float32)
+    if projection is not None:
+        gallery = projection(gallery)
+    return gallery, rows
+
+
+def sample_queries(gallery,
+                   num_queries,
+                   query_features=None,
+                   seed=0,
+                   projection=None):
+    """
+    return (gallery, queries, gallery_rows). Without query_features, the
+    queries are sampled from the gallery and removed from the returned
+    gallery. gallery_rows are the positions of the returned gallery in the
+    input one.
+    """
+    if query_features is not None:
+        queries = np.ascontiguousarray(
+            np.load(query_features), dtype=np.float32)
+        if projection is not None and queries.shape[
+                1] == projection.input_dim:
+            queries = projection(queries)
+        return gallery, queries, np.arange(gallery.shape[0])
+    rng = np.random.RandomState(seed)
+    num_queries = min(num_queries, gallery.shape[0] - 1)
+    query_rows = rng.choice(gallery.shape[0], num_queries, replace=False)
+    keep = np.ones([gallery.shape[0]], dtype=bool)
+    keep[query_rows] = False
+    gallery_rows = np.nonzero(keep)[0]
+    return gallery[gallery_rows], gallery[query_rows], gallery_rows
+
+
+def main(args, config):
+    index_config = config["IndexProcess"]
+    dist_type = index_config.get("dist_type", "IP")
+    assert dist_type != "hamming", "benchmark of binary index is not supported"
+    projection = load_projection(index_config)
+    gallery, _ = load_features(index_config, args.max_gallery, projection)
+    if args.query_features is None:
+        logger.warning("--query_features is not set, hold out {} gallery "
+                       "features as queries".format(args.num_queries))
+    gallery, queries, _ = sample_queries(
+        gallery,
+        args.num_queries,
+        args.query_features,
+        projection=projection)
+    gt = exact_search(gallery, queries, args.topk, dist_type)
+    logger.info("gallery: {}, queries: {}, dim: {}".format(
+        gallery.shape[0], queries.shape[0], gallery.shape[1]))
+
+    header = "{:<28}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}".format(
+        "index", "recall", "memory(MB)", "build(s)", "qps", "p50(ms)",
+        "p99(ms)")
+    lines = [header]
+    for method in args.index_methods.split(","):
+        factory = get_index_method(
+            method,
+            gallery.shape[0],
+            gallery.shape[1],
+            dist_type,
+            nlist=index_config.get("nlist"),
+            pq_m=index_config.get("pq_m"))
+        tic = time.time()
+        index = build_index(gallery, factory, dist_type, args.max_train)
+        build_time = time.time() - tic
+        searchers = [(factory, index)]
+        if args.rerank_k > 0 and method not in ["Flat", "HNSW32"]:
+            searchers.append(("{}+rerank{}".format(factory, args.rerank_k),
+                              RerankIndex(index, gallery, args.rerank_k,
+                                          dist_type)))
+        for name, searcher in searchers:
+            result = measure(searcher, queries, gt, args.topk)
+            lines.append("{:<28}{:>10.4f}{:>12.1f}{:>10.1f}{:>10.0f}{:>10.3f}{:>10.3f}".
+                         format(name, result["recall"],
+                                index_memory(searcher) / 1024**2, build_time,
+                                result["qps"], result["p50_ms"],
+                                result["p99_ms"]))
+    logger.info("recall@{} against exact search:\n{}".format(args.topk,
+                                                             "\n".join(lines)))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args, config.get_config(args.config, overrides=args.override))
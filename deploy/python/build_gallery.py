@@ -11,14 +11,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
+import json
 import os
 import pickle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import faiss
 import numpy as np
 from paddleclas.deploy.python.predict_rec import RecPredictor
 from paddleclas.deploy.utils import config, logger
+from paddleclas.deploy.utils.doc_store import DocStore, load_doc_store, save_doc_store
+from paddleclas.deploy.utils.index_factory import RERANK_FILE, append_rerank_vectors, get_index_method, new_rerank_vectors_path, remove_unused_rerank_vectors, rerank_vectors_path, write_rerank_config
+from paddleclas.deploy.utils.index_version import VERSIONS_DIR, create_version_dir, keep_versions_of, list_versions, publish_version, resolve_index_dir
+from paddleclas.deploy.utils.sharded_index import SHARD_MANIFEST, ShardedIndex, build_shards, is_sharded
 from tqdm import tqdm
 
 
@@ -44,13 +52,80 @@ def split_datafile(data_file, image_root, delimiter="\t"):
     return gallery_images, gallery_docs
 
 
+def get_feature_cache_dir(config):
+    feature_dir = config.get("feature_cache_dir", None)
+    if feature_dir is None:
+        feature_dir = os.path.join(config["index_dir"], "features")
+    return feature_dir
+
+
+def model_fingerprint(config):
+    '''
+        md5 of the rec inference model files and the pre/post-process
+        config, features extracted by another model or preprocessing are
+        never resumed
+    '''
+    md5 = hashlib.md5()
+    model_dir = config["Global"]["rec_inference_model_dir"]
+    for name in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, name)
+        if not os.path.isfile(path):
+            continue
+        md5.update(name.encode("utf-8"))
+        with open(path, "rb") as fd:
+            for block in iter(lambda: fd.read(1 << 20), b""):
+                md5.update(block)
+    for key in ["RecPreProcess", "RecPostProcess"]:
+        md5.update(
+            json.dumps(
+                config.get(key, None), sort_keys=True,
+                default=str).encode("utf-8"))
+    return md5.hexdigest()
+
+
+def load_gallery_features(config):
+    '''
+        load the features extracted by GalleryBuilder in feature_cache_dir
+        return: gallery_features(np.memmap), valid(np.ndarray of bool)
+    '''
+    feature_dir = get_feature_cache_dir(config)
+    with open(os.path.join(feature_dir, "manifest.json"), "r") as fd:
+        manifest = json.load(fd)
+    num_images = manifest["num_images"]
+    assert manifest["completed_chunks"] * manifest[
+        "chunk_size"] >= num_images, "The feature extraction in {} is not completed".format(
+            feature_dir)
+    gallery_features = np.memmap(
+        os.path.join(feature_dir, "gallery_features.bin"),
+        dtype=manifest["dtype"],
+        mode="r",
+        shape=(num_images, manifest["feature_dim"]))
+    valid = np.ones([num_images], dtype=bool)
+    reject_path = os.path.join(feature_dir, "rejected_images.txt")
+    if os.path.exists(reject_path):
+        with open(reject_path, "r", encoding="utf-8") as fd:
+            for line in fd:
+                valid[int(line.split("\t")[0])] = False
+    return gallery_features, valid
+
+
 class GalleryBuilder(object):
     def __init__(self, config):
 
         self.config = config
         self.rec_predictor = RecPredictor(config)
         assert 'IndexProcess' in config.keys(), "Index config not found ... "
+        # the feature cache keeps the raw features, the index is built from
+        # the projected ones
+        self.projection = self.rec_predictor.projection
+        if self.projection is not None:
+            assert config["IndexProcess"][
+                "dist_type"] != "hamming", "The projection does not support hamming dist_type"
+            assert config["IndexProcess"][
+                "embedding_size"] == self.projection.output_dim, "embedding_size must be the output dim of the projection: {}".format(
+                    self.projection.output_dim)
         self.android_demo = config["Global"].get("android_demo", False)
+        self.rerank_path = None
         self.build(config['IndexProcess'])
 
     def build(self, config):
@@ -64,31 +139,50 @@ class GalleryBuilder(object):
 
         # when remove data in index, do not need extract fatures
         if operation_method != "remove":
-            gallery_features = self._extract_features(gallery_images, config)
+            gallery_features, valid = self._extract_features(gallery_images,
+                                                             config)
+            if self.projection is not None:
+                gallery_features = self._project_features(config,
+                                                          gallery_features)
+            rows = np.nonzero(valid)[0]
+            if len(rows) < len(gallery_docs):
+                gallery_docs = [gallery_docs[i] for i in rows]
         assert operation_method in [
             "new", "remove", "append"
         ], "Only append, remove and new operation are supported"
 
+        # build the shards from the memmap features in worker processes
+        if config.get("num_shards", 1) > 1 and operation_method == "new":
+            self._create_sharded_index(config, gallery_features, rows,
+                                       gallery_docs)
+            return
+
+        # the features are read from the memmap by `rows` in chunks, instead
+        # of copying the valid rows into memory
         if self.android_demo:
-            self._create_index_for_android_demo(config, gallery_features, gallery_docs)
+            self._create_index_for_android_demo(config, gallery_features,
+                                                rows, gallery_docs)
             return
 
         # vector.index: faiss index file
-        # id_map.pkl: use this file to map id to image_doc
+        # doc_store: use this store to map id to image_doc
         index, ids = None, None
         if operation_method in ["remove", "append"]:
-            # if remove or append, load vector.index and id_map.pkl
+            # if remove or append, load vector.index and doc_store
             index, ids = self._load_index(config)
             index_method = config.get("index_method", "HNSW32")
         else:
-            index_method, index, ids = self._create_index(config)
+            index_method, index, ids = self._create_index(config,
+                                                          len(gallery_docs))
         if index_method == "HNSW32":
             logger.warning(
                 "The HNSW32 method dose not support 'remove' operation")
 
         if operation_method != "remove":
             # calculate id for new data
-            index, ids = self._add_gallery(index, ids, gallery_features, gallery_docs, config, operation_method)
+            index, ids = self._add_gallery(index, ids, gallery_features, rows,
+                                           gallery_docs, config,
+                                           operation_method)
         else:
             if index_method == "HNSW32":
                 raise RuntimeError(
@@ -96,89 +190,272 @@ class GalleryBuilder(object):
                 )
             # remove ids in id_map, remove index data in faiss index
             index, ids = self._rm_id_in_galllery(index, ids, gallery_docs)
+            # the re-ranking vectors stay valid, as ids are never reused
+            if self._use_rerank(config):
+                self.rerank_path = rerank_vectors_path(
+                    resolve_index_dir(config["index_dir"]))
 
-        # store faiss index file and id_map file
+        # store faiss index file and doc_store
         self._save_gallery(config, index, ids)
 
-    def _create_index_for_android_demo(self, config, gallery_features, gallery_docs):
+    def _create_index_for_android_demo(self, config, gallery_features, rows,
+                                       gallery_docs):
         if not os.path.exists(config["index_dir"]):
             os.makedirs(config["index_dir"], exist_ok=True)
         #build index
         index = faiss.IndexFlatIP(config["embedding_size"])
-        index.add(gallery_features)
+        for _, features in self._feature_chunks(gallery_features, rows):
+            index.add(features)
 
         # calculate id for data
         ids_now = (np.arange(0, len(gallery_docs))).astype(np.int64)
         ids = {}
         for i, d in zip(list(ids_now), gallery_docs):
             ids[i] = d
-        self._save_gallery(config, index, ids)
+        self._save_gallery(config, index, DocStore.from_dict(ids))
+
+        # the lite/android transform tools still read id_map.pkl
+        with open(os.path.join(config["index_dir"], "id_map.pkl"), 'wb') as fd:
+            pickle.dump(ids, fd)
+
+    def _read_image(self, image_file):
+        img = cv2.imread(image_file)
+        if img is None:
+            return None
+        img = img[:, :, ::-1]
+        return self.rec_predictor.preprocess(img)
+
+    def _read_images(self, executor, image_files, window):
+        '''
+            read images by the executor and yield them in order, at most
+            `window` images are read ahead of the consumer
+        '''
+        futures = deque()
+        for image_file in image_files:
+            if len(futures) >= window:
+                yield futures.popleft().result()
+            futures.append(executor.submit(self._read_image, image_file))
+        while futures:
+            yield futures.popleft().result()
+
+    def _load_manifest(self, manifest_path, meta):
+        if not os.path.exists(manifest_path):
+            return 0
+        with open(manifest_path, "r") as fd:
+            manifest = json.load(fd)
+        for k, v in meta.items():
+            if manifest.get(k) != v:
+                logger.warning(
+                    "The extraction manifest {} does not match current gallery ({} changed), extract from scratch".
+                    format(manifest_path, k))
+                return 0
+        return manifest.get("completed_chunks", 0)
+
+    def _save_manifest(self, manifest_path, meta, completed_chunks):
+        manifest = dict(meta, completed_chunks=completed_chunks)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(manifest, fd)
+        os.replace(tmp_path, manifest_path)
 
     def _extract_features(self, gallery_images, config):
-        # extract gallery features
+        '''
+            extract gallery features into a memory-mapped file chunk by chunk.
+            The progress is recorded in a manifest so an interrupted build
+            resumes from the last completed chunk with `resume: True`, as
+            long as the image list, the rec model and its pre/post-process
+            are unchanged. Unreadable images are skipped and recorded in a
+            reject list.
+
+            return: gallery_features(np.memmap), valid(np.ndarray of bool)
+        '''
         if config["dist_type"] == "hamming":
-            gallery_features = np.zeros(
-                [len(gallery_images), config['embedding_size'] // 8],
-                dtype=np.uint8)
+            feature_dim = config['embedding_size'] // 8
+            dtype = np.uint8
+        elif self.projection is not None:
+            feature_dim = self.projection.input_dim
+            dtype = np.float32
         else:
-            gallery_features = np.zeros(
-                [len(gallery_images), config['embedding_size']],
-                dtype=np.float32)
+            feature_dim = config['embedding_size']
+            dtype = np.float32
+
+        feature_dir = get_feature_cache_dir(config)
+        os.makedirs(feature_dir, exist_ok=True)
+        feature_path = os.path.join(feature_dir, "gallery_features.bin")
+        manifest_path = os.path.join(feature_dir, "manifest.json")
+        reject_path = os.path.join(feature_dir, "rejected_images.txt")
 
-        #construct batch imgs and do inference
         batch_size = config.get("batch_size", 32)
-        batch_img = []
-        for i, image_file in enumerate(tqdm(gallery_images)):
-            img = cv2.imread(image_file)
-            if img is None:
-                logger.error("img empty, please check {}".format(image_file))
-                exit()
-            img = img[:, :, ::-1]
-            batch_img.append(img)
-
-            if (i + 1) % batch_size == 0:
-                rec_feat = self.rec_predictor.predict(batch_img)
-                gallery_features[i - batch_size + 1:i + 1, :] = rec_feat
-                batch_img = []
-
-        if len(batch_img) > 0:
-            rec_feat = self.rec_predictor.predict(batch_img)
-            gallery_features[-len(batch_img):, :] = rec_feat
-            batch_img = []
-
-        return gallery_features
+        chunk_size = max(config.get("chunk_size", 4096) // batch_size,
+                         1) * batch_size
+        num_workers = config.get("num_workers", 4)
+        num_images = len(gallery_images)
+        num_chunks = (num_images + chunk_size - 1) // chunk_size
+
+        md5 = hashlib.md5()
+        for image_file in gallery_images:
+            md5.update(image_file.encode("utf-8"))
+        meta = {
+            "num_images": num_images,
+            "feature_dim": feature_dim,
+            "dtype": np.dtype(dtype).name,
+            "chunk_size": chunk_size,
+            "image_list_md5": md5.hexdigest(),
+            "model_md5": model_fingerprint(self.config)
+        }
+
+        completed_chunks = 0
+        if config.get("resume", False) and os.path.exists(feature_path):
+            completed_chunks = self._load_manifest(manifest_path, meta)
+        rejected = set()
+        if completed_chunks > 0:
+            logger.info("Resume feature extraction from chunk {}/{}".format(
+                completed_chunks, num_chunks))
+            gallery_features = np.memmap(
+                feature_path,
+                dtype=dtype,
+                mode="r+",
+                shape=(num_images, feature_dim))
+            # only keep the rejected records of completed chunks
+            if os.path.exists(reject_path):
+                with open(reject_path, "r", encoding="utf-8") as fd:
+                    for line in fd:
+                        idx = int(line.split("\t")[0])
+                        if idx < completed_chunks * chunk_size:
+                            rejected.add(idx)
+        else:
+            gallery_features = np.memmap(
+                feature_path,
+                dtype=dtype,
+                mode="w+",
+                shape=(num_images, feature_dim))
+        with open(reject_path, "w", encoding="utf-8") as fd:
+            for idx in sorted(rejected):
+                fd.write("{}\t{}\n".format(idx, gallery_images[idx]))
+
+        # images are decoded and preprocessed by the reader threads, which
+        # run ahead of the inference on the main thread by up to 2 batches
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+        pbar = tqdm(
+            total=num_images, initial=min(completed_chunks * chunk_size,
+                                          num_images))
+        try:
+            for chunk_id in range(completed_chunks, num_chunks):
+                start = chunk_id * chunk_size
+                end = min(start + chunk_size, num_images)
+                batch_img, batch_idx = [], []
+                images = self._read_images(executor,
+                                           gallery_images[start:end],
+                                           2 * batch_size)
+                for idx, img in zip(range(start, end), images):
+                    if img is None:
+                        logger.warning(
+                            "Image file failed to read and has been skipped. The path: {}".
+                            format(gallery_images[idx]))
+                        rejected.add(idx)
+                        with open(reject_path, "a", encoding="utf-8") as fd:
+                            fd.write("{}\t{}\n".format(idx, gallery_images[
+                                idx]))
+                    else:
+                        batch_img.append(img)
+                        batch_idx.append(idx)
+
+                    if len(batch_img) == batch_size or (idx + 1 == end and
+                                                        len(batch_img) > 0):
+                        rec_feat = self.rec_predictor.predict(
+                            batch_img, preprocessed=True, project=False)
+                        gallery_features[batch_idx, :] = rec_feat
+                        batch_img, batch_idx = [], []
+                    pbar.update(1)
+
+                gallery_features.flush()
+                self._save_manifest(manifest_path, meta, chunk_id + 1)
+        finally:
+            pbar.close()
+            executor.shutdown(wait=False)
+
+        if len(rejected) > 0:
+            logger.warning(
+                "{} images failed to read and were skipped, see {}".format(
+                    len(rejected), reject_path))
+        valid = np.ones([num_images], dtype=bool)
+        valid[list(rejected)] = False
+        return gallery_features, valid
+
+    def _project_features(self, config, gallery_features):
+        '''
+            project the extracted features into a memmap file next to the
+            feature cache, rows keep the order of the gallery images
+        '''
+        projected_features = np.memmap(
+            os.path.join(
+                get_feature_cache_dir(config), "projected_features.bin"),
+            dtype=np.float32,
+            mode="w+",
+            shape=(gallery_features.shape[0], self.projection.output_dim))
+        self.projection(gallery_features, out=projected_features)
+        projected_features.flush()
+        logger.info("Project gallery features from {}-d to {}-d".format(
+            self.projection.input_dim, self.projection.output_dim))
+        return projected_features
 
     def _load_index(self, config):
+        index_dir = resolve_index_dir(config["index_dir"])
         assert os.path.join(
-            config["index_dir"], "vector.index"
+            index_dir, "vector.index"
         ), "The vector.index dose not exist in {} when 'index_operation' is not None".format(
-            config["index_dir"])
-        assert os.path.join(
-            config["index_dir"], "id_map.pkl"
-        ), "The id_map.pkl dose not exist in {} when 'index_operation' is not None".format(
-            config["index_dir"])
-        index = faiss.read_index(
-            os.path.join(config["index_dir"], "vector.index"))
-        with open(os.path.join(config["index_dir"], "id_map.pkl"),
-                  'rb') as fd:
-            ids = pickle.load(fd)
-        assert index.ntotal == len(ids.keys(
-        )), "data number in index is not equal in in id_map"
+            index_dir)
+        if is_sharded(index_dir):
+            index = ShardedIndex.load(index_dir)
+        elif config["dist_type"] == "hamming":
+            index = faiss.read_index_binary(
+                os.path.join(index_dir, "vector.index"))
+        else:
+            index = faiss.read_index(os.path.join(index_dir, "vector.index"))
+        # fall back to id_map.pkl for galleries built by older versions
+        ids = load_doc_store(index_dir, mmap=False)
+        assert index.ntotal == len(
+            ids), "data number in index is not equal in in doc_store"
         return index, ids
 
-    def _create_index(self, config):
+    def _get_index_method(self, config, gallery_size):
+        # cal ivf number and pq sub-quantizers automaticlly if not configured
+        return get_index_method(
+            config.get("index_method", "HNSW32"),
+            gallery_size,
+            config["embedding_size"],
+            config["dist_type"],
+            nlist=config.get("nlist", None),
+            pq_m=config.get("pq_m", None))
+
+    def _use_rerank(self, config):
+        return config.get("rerank_k", 0) > 0 and config[
+            "dist_type"] != "hamming"
+
+    def _add_rerank_vectors(self, config, operation_method, start_id,
+                            gallery_features, rows=None):
+        '''
+            keep the float vectors of a compressed index in a memmap file for
+            exact re-ranking. A new index starts a new file, appends extend
+            the file of the current index.
+        '''
+        if operation_method == "new":
+            self.rerank_path = new_rerank_vectors_path(config["index_dir"])
+        else:
+            self.rerank_path = rerank_vectors_path(
+                resolve_index_dir(config["index_dir"]))
+            if self.rerank_path is None:
+                logger.warning(
+                    "The index in {} has no vectors for re-ranking, 'rerank_k' is ignored".
+                    format(config["index_dir"]))
+                return
+        append_rerank_vectors(self.rerank_path, start_id, gallery_features,
+                              rows)
+
+    def _create_index(self, config, gallery_size):
         if not os.path.exists(config["index_dir"]):
             os.makedirs(config["index_dir"], exist_ok=True)
-        index_method = config.get("index_method", "HNSW32")
-
-        # if IVF method, cal ivf number automaticlly
-        if index_method == "IVF":
-            index_method = index_method + str(
-                min(int(len(gallery_images) // 8), 65536)) + ",Flat"
-
-        # for binary index, add B at head of index_method
-        if config["dist_type"] == "hamming":
-            index_method = "B" + index_method
+        index_method = self._get_index_method(config, gallery_size)
 
         #dist_type
         dist_type = faiss.METRIC_INNER_PRODUCT if config[
@@ -192,48 +469,155 @@ class GalleryBuilder(object):
             index = faiss.index_factory(config["embedding_size"],
                                         index_method, dist_type)
             index = faiss.IndexIDMap2(index)
-        ids = {}
+        ids = DocStore()
         return index_method, index, ids
 
-    def _add_gallery(self, index, ids, gallery_features, gallery_docs, config, operation_method):
-        start_id = max(ids.keys()) + 1 if ids else 0
+    def _feature_chunks(self, gallery_features, rows, chunk_size=65536):
+        '''
+            yield (offset in rows, features) of chunks of `rows`, read from
+            the memmap of gallery features
+        '''
+        for start in range(0, len(rows), chunk_size):
+            yield start, np.ascontiguousarray(gallery_features[rows[
+                start:start + chunk_size]])
+
+    def _train_rows(self, index, rows, config):
+        '''
+            rows to train the index with. By default IVF indexes are trained
+            with at most 256 points per list, which is the number the faiss
+            k-means samples anyway, other indexes with all rows
+        '''
+        max_train = config.get("max_train", None)
+        if max_train is None:
+            try:
+                max_train = 256 * faiss.extract_index_ivf(index).nlist
+            except (RuntimeError, TypeError):
+                # not an IVF index, or a binary one
+                max_train = len(rows)
+        if len(rows) <= max_train:
+            return rows
+        rng = np.random.RandomState(0)
+        return np.sort(rng.choice(rows, max_train, replace=False))
+
+    def _add_gallery(self, index, ids, gallery_features, rows, gallery_docs,
+                     config, operation_method):
+        # not max_id() + 1, the ids of removed vectors are never reused
+        start_id = ids.next_id
         ids_now = (
             np.arange(0, len(gallery_docs)) + start_id).astype(np.int64)
 
         # only train when new index file
-        if operation_method == "new":
-            if config["dist_type"] == "hamming":
-                index.add(gallery_features)
-            else:
-                index.train(gallery_features)
-
-        if not config["dist_type"] == "hamming":
-            index.add_with_ids(gallery_features, ids_now)
-
-        for i, d in zip(list(ids_now), gallery_docs):
-            ids[i] = d
+        if operation_method == "new" and not index.is_trained:
+            train_rows = self._train_rows(index, rows, config)
+            index.train(
+                np.ascontiguousarray(gallery_features[train_rows]))
+
+        for start, features in self._feature_chunks(gallery_features, rows):
+            if config["dist_type"] != "hamming":
+                index.add_with_ids(features,
+                                   ids_now[start:start + len(features)])
+            elif operation_method == "new":
+                index.add(features)
+
+        if self._use_rerank(config):
+            self._add_rerank_vectors(config, operation_method, start_id,
+                                     gallery_features, rows)
+        ids.add(ids_now, gallery_docs)
         return index, ids
 
     def _rm_id_in_galllery(self, index, ids, gallery_docs):
-        remove_ids = list(
-            filter(lambda k: ids.get(k) in gallery_docs, ids.keys()))
-        remove_ids = np.asarray(remove_ids)
+        remove_ids = []
+        for doc in gallery_docs:
+            remove_ids.extend(ids.lookup_doc(doc))
+        remove_ids = np.asarray(remove_ids, dtype=np.int64)
         index.remove_ids(remove_ids)
-        for k in remove_ids:
-            del ids[k]
+        ids.remove_ids(remove_ids)
 
         return index, ids
 
+    def _create_sharded_index(self, config, gallery_features, rows,
+                              gallery_docs):
+        '''
+            build `num_shards` sub-indexes, one per worker process. Vectors go
+            to shard id % num_shards and every shard stores the global ids.
+        '''
+        assert config[
+            "dist_type"] != "hamming", "The sharded index does not support hamming dist_type"
+        num_shards = config["num_shards"]
+        ids_now = np.arange(0, len(gallery_docs)).astype(np.int64)
+        ids = DocStore()
+        ids.add(ids_now, gallery_docs)
+        index_method = self._get_index_method(config,
+                                              len(gallery_docs) // num_shards)
+
+        if not os.path.exists(config["index_dir"]):
+            os.makedirs(config["index_dir"], exist_ok=True)
+        keep_versions = keep_versions_of(config, config["index_dir"])
+        if keep_versions > 0:
+            version, index_dir = create_version_dir(config["index_dir"])
+        else:
+            index_dir = config["index_dir"]
+        build_shards(
+            index_dir,
+            gallery_features,
+            rows,
+            ids_now,
+            num_shards,
+            config["embedding_size"],
+            index_method,
+            metric=config["dist_type"],
+            num_workers=config.get("num_shard_workers", None))
+        save_doc_store(index_dir, ids)
+        if self._use_rerank(config):
+            self._add_rerank_vectors(config, "new", 0, gallery_features, rows)
+        self._save_rerank_config(config, index_dir)
+        if keep_versions > 0:
+            publish_version(config["index_dir"], version, keep_versions)
+        self._remove_unused_rerank_vectors(config)
+
+    def _save_rerank_config(self, config, index_dir):
+        if self.rerank_path is None:
+            if os.path.exists(os.path.join(index_dir, RERANK_FILE)):
+                os.remove(os.path.join(index_dir, RERANK_FILE))
+            return
+        write_rerank_config(index_dir, self.rerank_path,
+                            config["embedding_size"],
+                            config.get("rerank_k", 0), config["dist_type"])
+
+    def _remove_unused_rerank_vectors(self, config):
+        index_dirs = [config["index_dir"]] + [
+            os.path.join(config["index_dir"], VERSIONS_DIR, v)
+            for v in list_versions(config["index_dir"])
+        ]
+        remove_unused_rerank_vectors(config["index_dir"], index_dirs)
+
     def _save_gallery(self, config, index, ids):
-        if config["dist_type"] == "hamming":
-            faiss.write_index_binary(
-                index, os.path.join(config["index_dir"], "vector.index"))
+        # with IndexProcess.keep_versions > 0, every build is saved as a new
+        # version and published atomically, so running searchers hot-swap to it
+        keep_versions = keep_versions_of(config, config["index_dir"])
+        if keep_versions > 0:
+            version, index_dir = create_version_dir(config["index_dir"])
         else:
-            faiss.write_index(
-                index, os.path.join(config["index_dir"], "vector.index"))
+            index_dir = config["index_dir"]
 
-        with open(os.path.join(config["index_dir"], "id_map.pkl"), 'wb') as fd:
-            pickle.dump(ids, fd)
+        if isinstance(index, ShardedIndex):
+            index.write(index_dir)
+        else:
+            if is_sharded(index_dir):
+                # a single index replaces the shards built before in index_dir
+                os.remove(os.path.join(index_dir, SHARD_MANIFEST))
+            if config["dist_type"] == "hamming":
+                faiss.write_index_binary(
+                    index, os.path.join(index_dir, "vector.index"))
+            else:
+                faiss.write_index(index,
+                                  os.path.join(index_dir, "vector.index"))
+
+        save_doc_store(index_dir, ids)
+        self._save_rerank_config(config, index_dir)
+        if keep_versions > 0:
+            publish_version(config["index_dir"], version, keep_versions)
+        self._remove_unused_rerank_vectors(config)
 
 
 def main(config):
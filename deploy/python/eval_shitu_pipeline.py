@@ -3,9 +3,10 @@ import os
 import cv2
 import numpy as np
 import faiss
-import pickle
 
 from paddleclas.deploy.utils import logger, config
+from paddleclas.deploy.utils.doc_store import first_valid_doc, load_doc_store
+from paddleclas.deploy.utils.index_version import resolve_index_dir
 from paddleclas.deploy.utils.get_image_list import get_image_and_label_list
 from paddleclas.deploy.python.build_gallery import GalleryBuilder
 from paddleclas.deploy.python.predict_rec import RecPredictor
@@ -20,7 +21,8 @@ class SystemPredictor(object):
 
         # create searcher
         self.return_k = self.config['IndexProcess']['return_k']
-        self.index_dir = self.config['IndexProcess']['index_dir']
+        self.index_dir = resolve_index_dir(self.config['IndexProcess'][
+            'index_dir'])
         if config['IndexProcess'].get("binary_index", False):
             self.Searcher = faiss.read_index_binary(
                 os.path.join(self.index_dir, "vector.index"))
@@ -28,8 +30,7 @@ class SystemPredictor(object):
             self.Searcher = faiss.read_index(
                 os.path.join(self.index_dir, "vector.index"))
 
-        with open(os.path.join(self.index_dir, "id_map.pkl"), "rb") as fd:
-            self.id_map = pickle.load(fd)
+        self.id_map = load_doc_store(self.index_dir)
 
     def append_self(self, results, shape):
         results.append({
@@ -89,8 +90,11 @@ class SystemPredictor(object):
             rec_results = self.rec_predictor.predict(crop_img)
             scores, docs = self.Searcher.search(rec_results, self.return_k)
 
-            outputs_list.append(self.id_map[docs[0][0]].split()[1])
-            scores_list.append(scores[0][0])
+            top = first_valid_doc(docs[0], self.id_map)
+            if top < 0:
+                continue
+            outputs_list.append(self.id_map[docs[0][top]].split()[1])
+            scores_list.append(scores[0][top])
         outputs = self.sort_output_by_scores(outputs_list, scores_list)
 
         return outputs
@@ -0,0 +1,61 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+List, rollback and prune the versions of a versioned index directory.
+
+Usage:
+    python python/manage_index_version.py --index_dir ./drink_dataset_v2.0/index --list
+    python python/manage_index_version.py --index_dir ./drink_dataset_v2.0/index --rollback
+    python python/manage_index_version.py --index_dir ./drink_dataset_v2.0/index --rollback v000002
+    python python/manage_index_version.py --index_dir ./drink_dataset_v2.0/index --keep 2
+"""
+import argparse
+
+from paddleclas.deploy.utils import logger
+from paddleclas.deploy.utils.index_version import current_version, list_versions, prune_versions, rollback
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index_dir', type=str, required=True)
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument(
+        '--rollback',
+        nargs='?',
+        const='',
+        default=None,
+        help="publish the given version, or the previous one if empty")
+    parser.add_argument(
+        '--keep',
+        type=int,
+        default=None,
+        help="remove the oldest versions and keep this number of versions")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.rollback is not None:
+        rollback(args.index_dir, args.rollback or None)
+    if args.keep is not None:
+        prune_versions(args.index_dir, args.keep)
+    if args.list or (args.rollback is None and args.keep is None):
+        current = current_version(args.index_dir)
+        for version in list_versions(args.index_dir):
+            logger.info("{} {}".format("*" if version == current else " ",
+                                       version))
+
+
+if __name__ == "__main__":
+    main()
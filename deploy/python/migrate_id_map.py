@@ -0,0 +1,70 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Migrate the legacy id_map.pkl in an index directory to doc_store, or export
+doc_store back to id_map.pkl for tools which still read the pickle, e.g.
+cpp_shitu/tools/transform_id_map.py.
+
+Usage:
+    python python/migrate_id_map.py --index_dir ./drink_dataset_v2.0/index
+    python python/migrate_id_map.py --index_dir ./drink_dataset_v2.0/index --export
+"""
+import argparse
+import os
+import pickle
+
+from paddleclas.deploy.utils import logger
+from paddleclas.deploy.utils.doc_store import DOC_STORE_DIR, ID_MAP_FILE, DocStore, load_doc_store, save_doc_store
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index_dir', type=str, required=True)
+    parser.add_argument(
+        '--export',
+        action='store_true',
+        help="export doc_store to id_map.pkl instead of migrating")
+    parser.add_argument(
+        '--remove_pickle',
+        action='store_true',
+        help="remove id_map.pkl after migrating")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    id_map_path = os.path.join(args.index_dir, ID_MAP_FILE)
+    if args.export:
+        assert DocStore.exists(
+            args.index_dir), "The doc_store dose not exist in {}".format(
+                args.index_dir)
+        store = load_doc_store(args.index_dir)
+        with open(id_map_path, "wb") as fd:
+            pickle.dump(store.to_dict(), fd)
+        logger.info("Export {} entries to {}".format(len(store), id_map_path))
+        return
+
+    assert os.path.exists(
+        id_map_path), "The id_map file dose not exist: {}".format(id_map_path)
+    with open(id_map_path, "rb") as fd:
+        store = DocStore.from_dict(pickle.load(fd))
+    save_doc_store(args.index_dir, store)
+    logger.info("Migrate {} entries to {}".format(
+        len(store), os.path.join(args.index_dir, DOC_STORE_DIR)))
+    if args.remove_pickle:
+        os.remove(id_map_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -63,6 +63,145 @@ def parse_class_id_map(class_id_map_file, delimiter):
     return class_id_map
 
 
+def label_array(class_id_map, num_classes):
+    """class id -> label name lookup table as a numpy object array"""
+    if class_id_map is None:
+        return None
+    if isinstance(class_id_map, dict):
+        size = max([num_classes] + [k + 1 for k in class_id_map])
+        labels = np.full(size, None, dtype=object)
+        for class_id, label_name in class_id_map.items():
+            labels[class_id] = label_name
+    else:
+        labels = np.empty(len(class_id_map), dtype=object)
+        labels[:] = class_id_map
+    return labels
+
+
+def topk_columns(probs, k):
+    """
+    ids and scores of the k largest probs of every row, in descending order.
+    Tied probs are ordered by descending class id, as
+    probs.argsort()[-k:][::-1] with a stable sort
+    """
+    num_classes = probs.shape[1]
+    k = min(k, num_classes)
+    if k < num_classes:
+        index = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+        kth = np.take_along_axis(probs, index, axis=1).min(axis=1)
+        # argpartition keeps any of the probs tied with the k-th largest one,
+        # sort these rows fully to keep the ones with the largest class ids
+        tied = np.nonzero((probs >= kth[:, None]).sum(axis=1) > k)[0]
+        if len(tied) > 0:
+            order = np.argsort(-probs[tied, ::-1], axis=1, kind="stable")
+            index[tied] = num_classes - 1 - order[:, :k]
+    else:
+        index = np.broadcast_to(np.arange(num_classes), probs.shape)
+    scores = np.take_along_axis(probs, index, axis=1)
+    order = np.lexsort((-index, -scores), axis=1)
+    return np.take_along_axis(index, order,
+                              axis=1), np.take_along_axis(
+                                  scores, order, axis=1)
+
+
+def columns_to_list(columns, score_decimals=None):
+    """
+    Convert columnar results to the list of per-sample dicts, keys keep the
+    order of the columns. Every column has one row per sample, except that
+    the flat columns of ragged results are split by the offsets in
+    columns["lod"]. None columns are dropped and "file_names" is output as
+    "file_name".
+    """
+    lod = columns.get("lod", None)
+    converted = {}
+    for key, value in columns.items():
+        if key == "lod" or value is None:
+            continue
+        if key == "file_names":
+            converted["file_name"] = list(value)
+            continue
+        if key == "scores" and score_decimals is not None:
+            value = np.around(value.astype(np.float64), score_decimals)
+        if isinstance(value, np.ndarray):
+            if lod is None:
+                value = value.tolist()
+            else:
+                value = [
+                    value[start:end].tolist()
+                    for start, end in zip(lod[:-1], lod[1:])
+                ]
+        converted[key] = value
+    keys = list(converted.keys())
+    return [dict(zip(keys, row)) for row in zip(*converted.values())]
+
+
+AGE_LIST = np.array(['AgeLess18', 'Age18-60', 'AgeOver60'], dtype=object)
+DIRECT_LIST = np.array(['Front', 'Side', 'Back'], dtype=object)
+BAG_LIST = np.array(['HandBag', 'ShoulderBag', 'Backpack'], dtype=object)
+UPPER_LIST = ['UpperStride', 'UpperLogo', 'UpperPlaid', 'UpperSplice']
+LOWER_LIST = np.array(
+    [
+        'LowerStripe', 'LowerPattern', 'LongCoat', 'Trousers', 'Shorts',
+        'Skirt&Dress'
+    ],
+    dtype=object)
+
+
+def _to_str(values):
+    """str of every float of an array, as an object array"""
+    return np.array([str(v) for v in values.tolist()], dtype=object)
+
+
+def _select(condition, if_true, if_false):
+    return np.where(condition, if_true, if_false).astype(object)
+
+
+def person_attributes(x, threshold=0.5, glasses_threshold=0.3,
+                      hold_threshold=0.6):
+    """attribute strings of a batch of person attribute probs, [N, 10]"""
+    upper_label = 'Upper: ' + _select(x[:, 3] > x[:, 2], 'LongSleeve',
+                                      'ShortSleeve')
+    for i, upper in enumerate(UPPER_LIST):
+        upper_label = upper_label + _select(x[:, 4 + i] > threshold,
+                                            ' {}'.format(upper), '')
+    lower_res = x[:, 8:14]
+    lower_label = np.full(x.shape[0], 'Lower: ', dtype=object)
+    for i, lower in enumerate(LOWER_LIST):
+        lower_label = lower_label + _select(lower_res[:, i] > threshold,
+                                            ' {}'.format(lower), '')
+    has_lower = (lower_res > threshold).any(axis=1)
+    lower_label = np.where(
+        has_lower, lower_label,
+        lower_label + ' ' + LOWER_LIST[np.argmax(
+            lower_res, axis=1)])
+    bag_idx = np.argmax(x[:, 15:18], axis=1)
+    bag_score = x[:, 15:18].max(axis=1)
+    return np.stack(
+        [
+            _select(x[:, 22] > threshold, 'Female', 'Male'),
+            AGE_LIST[np.argmax(x[:, 19:22], axis=1)],
+            DIRECT_LIST[np.argmax(x[:, 23:], axis=1)],
+            'Glasses: ' + _select(x[:, 1] > glasses_threshold, 'True',
+                                  'False'),
+            'Hat: ' + _select(x[:, 0] > threshold, 'True', 'False'),
+            'HoldObjectsInFront: ' + _select(x[:, 18] > hold_threshold,
+                                             'True', 'False'),
+            _select(bag_score > threshold, BAG_LIST[bag_idx], 'No bag'),
+            upper_label,
+            lower_label,
+            _select(x[:, 14] > threshold, 'Boots', 'No boots')
+        ],
+        axis=1)
+
+
+def person_output(x, glasses_threshold=0.3, hold_threshold=0.6):
+    """binary output of a batch of person attribute probs, [N, C]"""
+    threshold_list = np.full(x.shape[1], 0.5)
+    threshold_list[1] = glasses_threshold
+    threshold_list[18] = hold_threshold
+    return (x > threshold_list).astype(np.int8)
+
+
 class PostProcesser(object):
     def __init__(self, func_list, main_indicator="Topk"):
         self.func_list = func_list
@@ -92,60 +231,41 @@ class ThreshOutput(object):
 
         delimiter = delimiter if delimiter is not None else " "
         self.class_id_map = parse_class_id_map(class_id_map_file, delimiter)
+        self.label_names = None
 
-    def __call__(self, x, file_names=None):
-        def binary_classification(x):
-            y = []
-            for idx, probs in enumerate(x):
-                score = probs[1]
-                if score < self.threshold:
-                    result = {
-                        "class_ids": [0],
-                        "scores": [1 - score],
-                        "label_names": [self.label_0]
-                    }
-                else:
-                    result = {
-                        "class_ids": [1],
-                        "scores": [score],
-                        "label_names": [self.label_1]
-                    }
-                if file_names is not None:
-                    result["file_name"] = file_names[idx]
-                y.append(result)
-            return y
-
-        def multi_classification(x):
-            y = []
-            for idx, probs in enumerate(x):
-                index = probs.argsort(axis=0)[::-1].astype("int32")
-                top1_id = index[0]
-                top1_score = probs[top1_id]
-
-                if top1_score > self.threshold:
-                    rtn_id = top1_id
-                else:
-                    rtn_id = self.default_label_index
-
-                label_name = self.class_id_map[
-                    rtn_id] if self.class_id_map is not None else ""
-
-                result = {
-                    "class_ids": [rtn_id],
-                    "scores": [probs[rtn_id]],
-                    "label_names": [label_name]
-                }
-                if file_names is not None:
-                    result["file_name"] = file_names[idx]
-                y.append(result)
-            return y
-
+    def columnar(self, x, file_names=None):
+        """results of the batch as [N, 1] arrays"""
         if file_names is not None:
             assert x.shape[0] == len(file_names)
         if x.shape[1] == 2:
-            return binary_classification(x)
+            score = x[:, 1:2]
+            negative = score < self.threshold
+            return {
+                "class_ids": np.where(negative, 0, 1),
+                "scores": np.where(negative, 1 - score, score),
+                "label_names": _select(negative, self.label_0, self.label_1),
+                "file_names": file_names
+            }
+
+        top1_id = np.argmax(x, axis=1)
+        top1_score = x[np.arange(x.shape[0]), top1_id]
+        rtn_id = np.where(top1_score > self.threshold, top1_id,
+                          self.default_label_index)[:, None]
+        if self.label_names is None:
+            self.label_names = label_array(self.class_id_map, x.shape[1])
+        if self.label_names is not None:
+            label_names = self.label_names[rtn_id]
         else:
-            return multi_classification(x)
+            label_names = np.full(rtn_id.shape, "", dtype=object)
+        return {
+            "class_ids": rtn_id,
+            "scores": np.take_along_axis(x, rtn_id, axis=1),
+            "label_names": label_names,
+            "file_names": file_names
+        }
+
+    def __call__(self, x, file_names=None):
+        return columns_to_list(self.columnar(x, file_names))
 
 
 class ScoreOutput(object):
@@ -174,32 +294,29 @@ class Topk(object):
         delimiter = delimiter if delimiter is not None else " "
         self.class_id_map = parse_class_id_map(
             class_id_map_file, delimiter) if not label_list else label_list
+        self.label_names = None
 
-    def __call__(self, x, file_names=None):
+    def columnar(self, x, file_names=None):
+        """topk results of the batch as [N, k] arrays"""
         if file_names is not None:
             assert x.shape[0] == len(file_names)
-        y = []
-        for idx, probs in enumerate(x):
-            index = probs.argsort(axis=0)[-self.topk:][::-1].astype("int32")
-            clas_id_list = []
-            score_list = []
-            label_name_list = []
-            for i in index:
-                clas_id_list.append(i.item())
-                score_list.append(probs[i].item())
-                if self.class_id_map is not None:
-                    label_name_list.append(self.class_id_map[i.item()])
-            result = {
-                "class_ids": clas_id_list,
-                "scores": np.around(
-                    score_list, decimals=5).tolist(),
-            }
-            if file_names is not None:
-                result["file_name"] = file_names[idx]
-            if label_name_list is not None:
-                result["label_names"] = label_name_list
-            y.append(result)
-        return y
+        class_ids, scores = topk_columns(x, self.topk)
+        if self.label_names is None:
+            self.label_names = label_array(self.class_id_map, x.shape[1])
+        if self.label_names is not None:
+            label_names = self.label_names[class_ids]
+        else:
+            label_names = np.empty((x.shape[0], 0), dtype=object)
+        return {
+            "class_ids": class_ids,
+            "scores": scores,
+            "file_names": file_names,
+            "label_names": label_names
+        }
+
+    def __call__(self, x, file_names=None):
+        return columns_to_list(
+            self.columnar(x, file_names), score_decimals=5)
 
 
 class MultiLabelThreshOutput(object):
@@ -207,29 +324,33 @@ class MultiLabelThreshOutput(object):
         self.threshold = threshold
         delimiter = delimiter if delimiter is not None else " "
         self.class_id_map = parse_class_id_map(class_id_map_file, delimiter)
+        self.label_names = None
+
+    def columnar(self, x, file_names=None):
+        """
+        results of the batch as flat arrays of the (sample, class) pairs over
+        the threshold, the pairs of sample i are in [lod[i], lod[i + 1])
+        """
+        mask = x >= self.threshold
+        rows, class_ids = np.nonzero(mask)
+        if self.label_names is None:
+            self.label_names = label_array(self.class_id_map, x.shape[1])
+        if self.label_names is not None:
+            label_names = self.label_names[class_ids]
+        else:
+            label_names = np.empty(0, dtype=object)
+        lod = np.concatenate([[0], np.cumsum(mask.sum(axis=1))])
+        return {
+            "class_ids": class_ids,
+            "scores": x[rows, class_ids],
+            "label_names": label_names,
+            "file_names": file_names,
+            "lod": lod
+        }
 
     def __call__(self, x, file_names=None):
-        y = []
-        for idx, probs in enumerate(x):
-            index = np.where(probs >= self.threshold)[0].astype("int32")
-            clas_id_list = []
-            score_list = []
-            label_name_list = []
-            for i in index:
-                clas_id_list.append(i.item())
-                score_list.append(probs[i].item())
-                if self.class_id_map is not None:
-                    label_name_list.append(self.class_id_map[i.item()])
-            result = {
-                "class_ids": clas_id_list,
-                "scores": np.around(
-                    score_list, decimals=5).tolist(),
-                "label_names": label_name_list
-            }
-            if file_names is not None:
-                result["file_name"] = file_names[idx]
-            y.append(result)
-        return y
+        return columns_to_list(
+            self.columnar(x, file_names), score_decimals=5)
 
 
 class SavePreLabel(object):
@@ -256,23 +377,19 @@ class SavePreLabel(object):
 class Binarize(object):
     def __init__(self, method="round"):
         self.method = method
-        self.unit = np.array([[128, 64, 32, 16, 8, 4, 2, 1]]).T
 
     def __call__(self, x, file_names=None):
         if self.method == "round":
-            x = np.round(x + 1).astype("uint8") - 1
+            bits = np.round(x + 1) >= 2
 
         if self.method == "sign":
-            x = ((np.sign(x) + 1) / 2).astype("uint8")
+            bits = x > 0
 
         embedding_size = x.shape[1]
         assert embedding_size % 8 == 0, "The Binary index only support vectors with sizes multiple of 8"
 
-        byte = np.zeros([x.shape[0], embedding_size // 8], dtype=np.uint8)
-        for i in range(embedding_size // 8):
-            byte[:, i:i + 1] = np.dot(x[:, i * 8:(i + 1) * 8], self.unit)
-
-        return byte
+        # 8 bits a byte, the first bit is the most significant one
+        return np.packbits(bits, axis=1)
 
 
 class PersonAttribute(object):
@@ -284,87 +401,20 @@ class PersonAttribute(object):
         self.glasses_threshold = glasses_threshold
         self.hold_threshold = hold_threshold
 
+    def columnar(self, batch_preds, file_names=None):
+        """"attributes" as a [N, 10] string array, "output" as a [N, C] int8
+        array"""
+        x = np.asarray(batch_preds, dtype=np.float64)
+        return {
+            "attributes": person_attributes(x, self.threshold,
+                                            self.glasses_threshold,
+                                            self.hold_threshold),
+            "output": person_output(x, self.glasses_threshold,
+                                    self.hold_threshold)
+        }
+
     def __call__(self, batch_preds, file_names=None):
-        # postprocess output of predictor
-        age_list = ['AgeLess18', 'Age18-60', 'AgeOver60']
-        direct_list = ['Front', 'Side', 'Back']
-        bag_list = ['HandBag', 'ShoulderBag', 'Backpack']
-        upper_list = ['UpperStride', 'UpperLogo', 'UpperPlaid', 'UpperSplice']
-        lower_list = [
-            'LowerStripe', 'LowerPattern', 'LongCoat', 'Trousers', 'Shorts',
-            'Skirt&Dress'
-        ]
-        batch_res = []
-        for res in batch_preds:
-            res = res.tolist()
-            label_res = []
-            # gender 
-            gender = 'Female' if res[22] > self.threshold else 'Male'
-            label_res.append(gender)
-            # age
-            age = age_list[np.argmax(res[19:22])]
-            label_res.append(age)
-            # direction 
-            direction = direct_list[np.argmax(res[23:])]
-            label_res.append(direction)
-            # glasses
-            glasses = 'Glasses: '
-            if res[1] > self.glasses_threshold:
-                glasses += 'True'
-            else:
-                glasses += 'False'
-            label_res.append(glasses)
-            # hat
-            hat = 'Hat: '
-            if res[0] > self.threshold:
-                hat += 'True'
-            else:
-                hat += 'False'
-            label_res.append(hat)
-            # hold obj
-            hold_obj = 'HoldObjectsInFront: '
-            if res[18] > self.hold_threshold:
-                hold_obj += 'True'
-            else:
-                hold_obj += 'False'
-            label_res.append(hold_obj)
-            # bag
-            bag = bag_list[np.argmax(res[15:18])]
-            bag_score = res[15 + np.argmax(res[15:18])]
-            bag_label = bag if bag_score > self.threshold else 'No bag'
-            label_res.append(bag_label)
-            # upper
-            upper_res = res[4:8]
-            upper_label = 'Upper:'
-            sleeve = 'LongSleeve' if res[3] > res[2] else 'ShortSleeve'
-            upper_label += ' {}'.format(sleeve)
-            for i, r in enumerate(upper_res):
-                if r > self.threshold:
-                    upper_label += ' {}'.format(upper_list[i])
-            label_res.append(upper_label)
-            # lower
-            lower_res = res[8:14]
-            lower_label = 'Lower: '
-            has_lower = False
-            for i, l in enumerate(lower_res):
-                if l > self.threshold:
-                    lower_label += ' {}'.format(lower_list[i])
-                    has_lower = True
-            if not has_lower:
-                lower_label += ' {}'.format(lower_list[np.argmax(lower_res)])
-
-            label_res.append(lower_label)
-            # shoe
-            shoe = 'Boots' if res[14] > self.threshold else 'No boots'
-            label_res.append(shoe)
-
-            threshold_list = [0.5] * len(res)
-            threshold_list[1] = self.glasses_threshold
-            threshold_list[18] = self.hold_threshold
-            pred_res = (np.array(res) > np.array(threshold_list)
-                        ).astype(np.int8).tolist()
-            batch_res.append({"attributes": label_res, "output": pred_res})
-        return batch_res
+        return columns_to_list(self.columnar(batch_preds, file_names))
 
 
 class FaceAttribute(object):
@@ -428,33 +478,39 @@ class VehicleAttribute(object):
             "sedan", "suv", "van", "hatchback", "mpv", "pickup", "bus",
             "truck", "estate"
         ]
+        self.color_names = np.array(self.color_list, dtype=object)
+        self.type_names = np.array(self.type_list, dtype=object)
 
-    def __call__(self, batch_preds, file_names=None):
-        # postprocess output of predictor
-        batch_res = []
-        for res in batch_preds:
-            res = res.tolist()
-            label_res = []
-            color_idx = np.argmax(res[:10])
-            type_idx = np.argmax(res[10:])
-            if res[color_idx] >= self.color_threshold:
-                color_info = f"Color: ({self.color_list[color_idx]}, prob: {res[color_idx]})"
-            else:
-                color_info = "Color unknown"
-
-            if res[type_idx + 10] >= self.type_threshold:
-                type_info = f"Type: ({self.type_list[type_idx]}, prob: {res[type_idx + 10]})"
-            else:
-                type_info = "Type unknown"
+    def columnar(self, batch_preds, file_names=None):
+        """"attributes" as a [N] string array, "output" as a [N, 19] int8
+        array"""
+        x = np.asarray(batch_preds, dtype=np.float64)
 
-            label_res = f"{color_info}, {type_info}"
+        # postprocess output of predictor
+        rows = np.arange(x.shape[0])
+        color_idx = np.argmax(x[:, :10], axis=1)
+        type_idx = np.argmax(x[:, 10:], axis=1)
+        color_prob = x[rows, color_idx]
+        type_prob = x[rows, type_idx + 10]
+        color_info = np.where(
+            color_prob >= self.color_threshold,
+            "Color: (" + self.color_names[color_idx] + ", prob: " +
+            _to_str(color_prob) + ")", "Color unknown")
+        type_info = np.where(
+            type_prob >= self.type_threshold,
+            "Type: (" + self.type_names[type_idx] + ", prob: " +
+            _to_str(type_prob) + ")", "Type unknown")
+
+        threshold_list = [self.color_threshold
+                          ] * 10 + [self.type_threshold] * 9
+        pred_res = (x > np.array(threshold_list)).astype(np.int8)
+        return {
+            "attributes": color_info + ", " + type_info,
+            "output": pred_res
+        }
 
-            threshold_list = [self.color_threshold
-                              ] * 10 + [self.type_threshold] * 9
-            pred_res = (np.array(res) > np.array(threshold_list)
-                        ).astype(np.int8).tolist()
-            batch_res.append({"attributes": label_res, "output": pred_res})
-        return batch_res
+    def __call__(self, batch_preds, file_names=None):
+        return columns_to_list(self.columnar(batch_preds, file_names))
 
 
 class TableAttribute(object):
@@ -473,31 +529,34 @@ class TableAttribute(object):
         self.obstruction_threshold = obstruction_threshold
         self.angle_threshold = angle_threshold
 
-    def __call__(self, batch_preds, file_names=None):
+    def columnar(self, batch_preds, file_names=None):
+        """"attributes" as a [N, 6] string array, "output" as a [N, 6] int8
+        array"""
+        x = np.asarray(batch_preds, dtype=np.float64)
+
         # postprocess output of predictor
-        batch_res = []
+        label_res = np.stack(
+            [
+                _select(x[:, 0] > self.source_threshold, 'Scanned', 'Photo'),
+                _select(x[:, 1] > self.number_threshold, 'Little',
+                        'Numerous'),
+                _select(x[:, 2] > self.color_threshold, 'Black-and-White',
+                        'Multicolor'),
+                _select(x[:, 3] > self.clarity_threshold, 'Clear', 'Blurry'),
+                _select(x[:, 4] > self.number_threshold, 'Without-Obstacles',
+                        'With-Obstacles'),
+                _select(x[:, 5] > self.number_threshold, 'Horizontal',
+                        'Tilted')
+            ],
+            axis=1)
+
+        threshold_list = [
+            self.source_threshold, self.number_threshold,
+            self.color_threshold, self.clarity_threshold,
+            self.obstruction_threshold, self.angle_threshold
+        ]
+        pred_res = (x > np.array(threshold_list)).astype(np.int8)
+        return {"attributes": label_res, "output": pred_res}
 
-        for res in batch_preds:
-            res = res.tolist()
-            label_res = []
-            source = 'Scanned' if res[0] > self.source_threshold else 'Photo'
-            number = 'Little' if res[1] > self.number_threshold else 'Numerous'
-            color = 'Black-and-White' if res[
-                2] > self.color_threshold else 'Multicolor'
-            clarity = 'Clear' if res[3] > self.clarity_threshold else 'Blurry'
-            obstruction = 'Without-Obstacles' if res[
-                4] > self.number_threshold else 'With-Obstacles'
-            angle = 'Horizontal' if res[
-                5] > self.number_threshold else 'Tilted'
-
-            label_res = [source, number, color, clarity, obstruction, angle]
-
-            threshold_list = [
-                self.source_threshold, self.number_threshold,
-                self.color_threshold, self.clarity_threshold,
-                self.obstruction_threshold, self.angle_threshold
-            ]
-            pred_res = (np.array(res) > np.array(threshold_list)
-                        ).astype(np.int8).tolist()
-            batch_res.append({"attributes": label_res, "output": pred_res})
-        return batch_res
+    def __call__(self, batch_preds, file_names=None):
+        return columns_to_list(self.columnar(batch_preds, file_names))
@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import time
 
 import cv2
 import numpy as np
 
-from paddleclas.deploy.utils import logger, config
+from paddleclas.deploy.utils import logger, config, op_profile
 from paddleclas.deploy.utils.predictor import Predictor
+from paddleclas.deploy.utils.tta import build_tta
 from paddleclas.deploy.utils.get_image_list import get_image_list
 from paddleclas.deploy.python.preprocess import create_operators
 from paddleclas.deploy.python.postprocess import build_postprocess
@@ -29,10 +31,18 @@ class ClsPredictor(Predictor):
 
         self.preprocess_ops = []
         self.postprocess = None
+        self.tta = None
         if "PreProcess" in config:
             if "transform_ops" in config["PreProcess"]:
                 self.preprocess_ops = create_operators(config["PreProcess"][
                     "transform_ops"])
+            # test-time augmentation(optional)
+            self.tta = build_tta(config["PreProcess"].get("tta", None))
+            if self.tta is not None:
+                logger.info("Use {}".format(self.tta))
+        # time and number of images of inference, to report the throughput
+        self.infer_time = 0.0
+        self.infer_samples = 0
         if "PostProcess" in config:
             self.postprocess = build_postprocess(config["PostProcess"])
 
@@ -89,15 +99,24 @@ class ClsPredictor(Predictor):
         if self.benchmark:
             self.auto_logger.times.stamp()
 
-        if not use_onnx:
-            input_tensor.copy_from_cpu(image)
-            self.predictor.run()
-            batch_output = output_tensor.copy_to_cpu()
-        else:
-            batch_output = self.predictor.run(
+        def run(image):
+            if not use_onnx:
+                input_tensor.copy_from_cpu(image)
+                self.predictor.run()
+                return output_tensor.copy_to_cpu()
+            return self.predictor.run(
                 output_names=[output_names],
                 input_feed={input_names: image})[0]
 
+        tic = time.time()
+        if self.tta is not None:
+            # the views of the batch in one run per shape
+            batch_output = self.tta(image, run)
+        else:
+            batch_output = run(image)
+        self.infer_time += time.time() - tic
+        self.infer_samples += len(image)
+
         if self.benchmark:
             self.auto_logger.times.stamp()
         if self.postprocess is not None:
@@ -155,6 +174,15 @@ def main(config):
                         print("{}:\tscore(s): {}".format(filename, scores_str))
             batch_imgs = []
             batch_names = []
+    if cls_predictor.tta is not None and cls_predictor.infer_time > 0:
+        num_views = cls_predictor.tta.num_views
+        logger.info(
+            "TTA views: {}, ips: {:.5f} images/sec, {:.5f} views/sec".format(
+                num_views, cls_predictor.infer_samples /
+                cls_predictor.infer_time, cls_predictor.infer_samples *
+                num_views / cls_predictor.infer_time))
+    for line in op_profile.summary():
+        logger.info(line)
     if cls_predictor.benchmark:
         cls_predictor.auto_logger.report()
     return
@@ -22,7 +22,7 @@ import numpy as np
 import cv2
 import paddle
 
-from paddleclas.deploy.utils import logger, config
+from paddleclas.deploy.utils import logger, config, op_profile
 from paddleclas.deploy.utils.predictor import Predictor
 from paddleclas.deploy.utils.get_image_list import get_image_list
 from paddleclas.deploy.python.preprocess import create_operators
@@ -38,7 +38,7 @@ class DetPredictor(Predictor):
             "transform_ops"])
         self.config = config
 
-    def preprocess(self, img):
+    def preprocess_image(self, img):
         im_info = {
             'scale_factor': np.array(
                 [1., 1.], dtype=np.float32),
@@ -48,7 +48,10 @@ class DetPredictor(Predictor):
             "scale_factor": np.array(
                 [1., 1.], dtype=np.float32)
         }
-        im, im_info = det_preprocess(img, im_info, self.preprocess_ops)
+        return det_preprocess(img, im_info, self.preprocess_ops)
+
+    def preprocess(self, img):
+        im, im_info = self.preprocess_image(img)
         inputs = self.create_inputs(im, im_info)
         return inputs
 
@@ -61,33 +64,94 @@ class DetPredictor(Predictor):
         Returns:
             inputs (dict): input of model
         """
+        return self.create_batch_inputs([im], [im_info])
+
+    def create_batch_inputs(self, ims, im_infos):
+        """
+        stack preprocessed images into one batch. Images of different shapes
+        are zero padded at the bottom and right to the largest shape, which
+        leaves the box coordinates unchanged, and every image keeps its own
+        im_shape and scale_factor.
+        """
+        max_h = max(im.shape[1] for im in ims)
+        max_w = max(im.shape[2] for im in ims)
+        image = np.zeros(
+            (len(ims), ims[0].shape[0], max_h, max_w), dtype='float32')
+        for i, im in enumerate(ims):
+            image[i, :, :im.shape[1], :im.shape[2]] = im
         inputs = {}
-        inputs['image'] = np.array((im, )).astype('float32')
+        inputs['image'] = image
         inputs['im_shape'] = np.array(
-            (im_info['im_shape'], )).astype('float32')
+            [im_info['im_shape'] for im_info in im_infos]).astype('float32')
         inputs['scale_factor'] = np.array(
-            (im_info['scale_factor'], )).astype('float32')
+            [im_info['scale_factor']
+             for im_info in im_infos]).astype('float32')
 
         return inputs
 
     def parse_det_results(self, pred, threshold, label_list):
         max_det_results = self.config["Global"]["max_det_results"]
-        keep_indexes = pred[:, 1].argsort()[::-1][:max_det_results]
+        keep_indexes = np.argsort(-pred[:, 1], kind="stable")[:max_det_results]
+        # the rows of class -1 are the placeholder of images without boxes
+        keep_indexes = keep_indexes[(pred[keep_indexes, 1] >= threshold) & (
+            pred[keep_indexes, 0] >= 0)]
+        return [{
+            "class_id": int(pred[idx, 0]),
+            "score": pred[idx, 1],
+            "bbox": pred[idx, 2:],
+            "label_name": label_list[int(pred[idx, 0])],
+        } for idx in keep_indexes]
+
+    def run(self, inputs):
+        """
+        run the predictor once, return the [N, 6] boxes of the batch and the
+        number of boxes of every image
+        """
+        input_names = self.predictor.get_input_names()
+        for i in range(len(input_names)):
+            input_tensor = self.predictor.get_input_handle(input_names[i])
+            input_tensor.copy_from_cpu(inputs[input_names[i]])
+
+        t1 = time.time()
+        self.predictor.run()
+        output_names = self.predictor.get_output_names()
+        boxes_tensor = self.predictor.get_output_handle(output_names[0])
+        np_boxes = boxes_tensor.copy_to_cpu()
+        if len(output_names) > 1:
+            boxes_num = self.predictor.get_output_handle(output_names[
+                1]).copy_to_cpu().reshape([-1])
+        else:
+            # models exported without boxes_num only support batch 1
+            assert inputs['image'].shape[
+                0] == 1, "The model has no boxes_num output for batch inference"
+            boxes_num = np.array([np_boxes.shape[0]])
+        t2 = time.time()
+        logger.info("Inference: {} ms per batch image".format(
+            (t2 - t1) * 1000.0 / inputs['image'].shape[0]))
+        return np_boxes, boxes_num
+
+    def predict_batch(self, images):
+        '''
+        Args:
+            images (list[np.ndarray]): images read by cv2 in RGB, the boxes
+                are filtered by Global.threshold as in predict
+        Returns:
+            results (list[list[dict]]): the detection results of every image
+        '''
+        ims, im_infos = zip(*[self.preprocess_image(img) for img in images])
+        inputs = self.create_batch_inputs(ims, im_infos)
+        np_boxes, boxes_num = self.run(inputs)
+
+        np_boxes = np_boxes.reshape([-1, 6])
+        splits = np.cumsum(boxes_num)[:-1]
         results = []
-        for idx in keep_indexes:
-            single_res = pred[idx]
-            class_id = int(single_res[0])
-            score = single_res[1]
-            bbox = single_res[2:]
-            if score < threshold:
+        for boxes in np.split(np_boxes[:int(np.sum(boxes_num))], splits):
+            if boxes.shape[0] == 0:
+                results.append([])
                 continue
-            label_name = label_list[class_id]
-            results.append({
-                "class_id": class_id,
-                "score": score,
-                "bbox": bbox,
-                "label_name": label_name,
-            })
+            results.append(
+                self.parse_det_results(boxes, self.config["Global"][
+                    "threshold"], self.config["Global"]["label_list"]))
         return results
 
     def predict(self, image, threshold=0.5, run_benchmark=False):
@@ -102,26 +166,12 @@ class DetPredictor(Predictor):
                             shape: [N, im_h, im_w]
         '''
         inputs = self.preprocess(image)
-        np_boxes = None
-        input_names = self.predictor.get_input_names()
-
-        for i in range(len(input_names)):
-            input_tensor = self.predictor.get_input_handle(input_names[i])
-            input_tensor.copy_from_cpu(inputs[input_names[i]])
-
-        t1 = time.time()
-        self.predictor.run()
-        output_names = self.predictor.get_output_names()
-        boxes_tensor = self.predictor.get_output_handle(output_names[0])
-        np_boxes = boxes_tensor.copy_to_cpu()
-        t2 = time.time()
-
-        print("Inference: {} ms per batch image".format((t2 - t1) * 1000.0))
+        np_boxes, _ = self.run(inputs)
 
         # do not perform postprocess in benchmark mode
         results = []
         if reduce(lambda x, y: x * y, np_boxes.shape) < 6:
-            print('[WARNNING] No object detected.')
+            logger.warning('No object detected.')
         else:
             results = self.parse_det_results(
                 np_boxes, self.config["Global"]["threshold"],
@@ -133,11 +183,18 @@ def main(config):
     det_predictor = DetPredictor(config)
     image_list = get_image_list(config["Global"]["infer_imgs"])
 
-    assert config["Global"]["batch_size"] == 1
-    for idx, image_file in enumerate(image_list):
-        img = cv2.imread(image_file)[:, :, ::-1]
-        output = det_predictor.predict(img)
-        print(output)
+    batch_size = config["Global"]["batch_size"]
+    for start in range(0, len(image_list), batch_size):
+        batch_files = image_list[start:start + batch_size]
+        batch_imgs = [cv2.imread(f)[:, :, ::-1] for f in batch_files]
+        if batch_size == 1:
+            outputs = [det_predictor.predict(batch_imgs[0])]
+        else:
+            outputs = det_predictor.predict_batch(batch_imgs)
+        for output in outputs:
+            print(output)
+    for line in op_profile.summary():
+        logger.info(line)
 
     return
 
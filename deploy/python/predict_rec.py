@@ -16,8 +16,9 @@ import os
 import cv2
 import numpy as np
 
-from paddleclas.deploy.utils import logger, config
+from paddleclas.deploy.utils import logger, config, op_profile
 from paddleclas.deploy.utils.predictor import Predictor
+from paddleclas.deploy.utils.projection import load_projection
 from paddleclas.deploy.utils.get_image_list import get_image_list
 from paddleclas.deploy.python.preprocess import create_operators
 from paddleclas.deploy.python.postprocess import build_postprocess
@@ -30,6 +31,8 @@ class RecPredictor(Predictor):
         self.preprocess_ops = create_operators(config["RecPreProcess"][
             "transform_ops"])
         self.postprocess = build_postprocess(config["RecPostProcess"])
+        # optional PCA(-whitening) projection of IndexProcess
+        self.projection = load_projection(config.get("IndexProcess", None))
         self.benchmark = config["Global"].get("benchmark", False)
 
         if self.benchmark:
@@ -52,7 +55,25 @@ class RecPredictor(Predictor):
                 ],
                 warmup=2)
 
-    def predict(self, images, feature_normalize=True):
+    def preprocess(self, image):
+        for ops in self.preprocess_ops:
+            image = ops(image)
+        return image
+
+    def predict(self,
+                images,
+                feature_normalize=True,
+                preprocessed=False,
+                project=True):
+        """
+        Args:
+            images: an image or a list of images in RGB order.
+            feature_normalize: whether to L2-normalize the output features.
+            preprocessed: whether `images` have already been processed by
+                `self.preprocess`, e.g. in a background reader thread.
+            project: whether to apply the projection of IndexProcess, if
+                any, to the features.
+        """
         use_onnx = self.args.get("use_onnx", False)
         if not use_onnx:
             input_names = self.predictor.get_input_names()
@@ -68,9 +89,9 @@ class RecPredictor(Predictor):
             self.auto_logger.times.start()
         if not isinstance(images, (list, )):
             images = [images]
-        for idx in range(len(images)):
-            for ops in self.preprocess_ops:
-                images[idx] = ops(images[idx])
+        if not preprocessed:
+            for idx in range(len(images)):
+                images[idx] = self.preprocess(images[idx])
         image = np.array(images)
         if self.benchmark:
             self.auto_logger.times.stamp()
@@ -92,6 +113,9 @@ class RecPredictor(Predictor):
                 np.sum(np.square(batch_output), axis=1, keepdims=True))
             batch_output = np.divide(batch_output, feas_norm)
 
+        if project and self.projection is not None:
+            batch_output = self.projection(batch_output)
+
         if self.postprocess is not None:
             batch_output = self.postprocess(batch_output)
 
@@ -131,6 +155,8 @@ def main(config):
                 print("{}:\t{}".format(filename, result_dict))
             batch_imgs = []
             batch_names = []
+    for line in op_profile.summary():
+        logger.info(line)
     if rec_predictor.benchmark:
         rec_predictor.auto_logger.report()
 
@@ -0,0 +1,294 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Video stream mode of the PP-ShiTu pipeline. The detector runs every
+`det_interval` frames, boxes are propagated between detections by an IoU
+tracker(and optionally optical flow), and recognition only runs for new
+tracks or tracks whose crop changed. Recognition results of a track are
+smoothed by voting.
+
+    python python/predict_stream.py -c configs/inference_general.yaml \
+        -o Global.infer_video=./test.mp4
+"""
+import time
+from collections import Counter, deque
+
+import cv2
+import numpy as np
+from paddleclas.deploy.python.predict_system import SystemPredictor
+from paddleclas.deploy.utils import config, logger
+from paddleclas.deploy.utils.rec_cache import dhash
+
+
+def read_video(video_file):
+    """yield the RGB frames of a video file or camera id"""
+    if isinstance(video_file, str) and video_file.isdigit():
+        video_file = int(video_file)
+    capture = cv2.VideoCapture(video_file)
+    assert capture.isOpened(), "Failed to open video {}".format(video_file)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield frame[:, :, ::-1]
+    finally:
+        capture.release()
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """IoU of every pair of [xmin, ymin, xmax, ymax] boxes, [N, M]"""
+    a = np.asarray(boxes_a, dtype="float32").reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype="float32").reshape(1, -1, 4)
+    xx1 = np.maximum(a[..., 0], b[..., 0])
+    yy1 = np.maximum(a[..., 1], b[..., 1])
+    xx2 = np.minimum(a[..., 2], b[..., 2])
+    yy2 = np.minimum(a[..., 3], b[..., 3])
+    inter = np.maximum(0.0, xx2 - xx1) * np.maximum(0.0, yy2 - yy1)
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-6)
+
+
+class Track(object):
+    def __init__(self, track_id, bbox, vote_window=10, whole_frame=False):
+        self.track_id = track_id
+        self.bbox = np.asarray(bbox, dtype="float32")
+        # the whole-frame box of append_self, not moved by optical flow
+        self.whole_frame = whole_frame
+        # number of detections the track is not matched in
+        self.age = 0
+        # crop hash of the last recognition, None before the first one
+        self.rec_hash = None
+        self.frames_since_rec = 0
+        self.votes = deque(maxlen=vote_window)
+
+    def vote(self):
+        """the most voted label and its mean score, None if not recognized"""
+        if not self.votes:
+            return None
+        counts = Counter(label for label, _ in self.votes)
+        label, _ = counts.most_common(1)[0]
+        if label is None:
+            return None
+        scores = [score for l, score in self.votes if l == label]
+        return label, float(np.mean(scores))
+
+
+class IoUTracker(object):
+    def __init__(self,
+                 iou_thresh=0.3,
+                 max_age=2,
+                 vote_window=10,
+                 use_optical_flow=False):
+        self.iou_thresh = iou_thresh
+        self.max_age = max_age
+        self.vote_window = vote_window
+        self.use_optical_flow = use_optical_flow
+        self.tracks = []
+        self.next_id = 0
+        self.prev_gray = None
+
+    def update(self, boxes, whole_frame=None):
+        """
+        match the detected boxes to the tracks greedily by IoU, whole_frame
+        marks the boxes which cover the whole frame
+        """
+        if whole_frame is None:
+            whole_frame = [False] * len(boxes)
+        matched_tracks = set()
+        matched_boxes = set()
+        if self.tracks and len(boxes) > 0:
+            ious = iou_matrix([t.bbox for t in self.tracks], boxes)
+            for flat in np.argsort(-ious, axis=None):
+                i, j = np.unravel_index(flat, ious.shape)
+                if ious[i, j] < self.iou_thresh:
+                    break
+                if i in matched_tracks or j in matched_boxes:
+                    continue
+                matched_tracks.add(i)
+                matched_boxes.add(j)
+                self.tracks[i].bbox = np.asarray(boxes[j], dtype="float32")
+                self.tracks[i].whole_frame = whole_frame[j]
+                self.tracks[i].age = 0
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.age += 1
+        self.tracks = [t for t in self.tracks if t.age <= self.max_age]
+        for j, box in enumerate(boxes):
+            if j not in matched_boxes:
+                self.tracks.append(
+                    Track(self.next_id, box, self.vote_window, whole_frame[j]))
+                self.next_id += 1
+
+    def propagate(self, img):
+        """
+        move the detector boxes by the median optical flow of points inside
+        them, the whole-frame boxes stay
+        """
+        if not self.use_optical_flow:
+            return
+        gray = cv2.cvtColor(np.ascontiguousarray(img), cv2.COLOR_RGB2GRAY)
+        prev_gray, self.prev_gray = self.prev_gray, gray
+        tracks = [t for t in self.tracks if not t.whole_frame]
+        if prev_gray is None or not tracks:
+            return
+        grid = np.linspace(0.2, 0.8, 4, dtype="float32")
+        points = []
+        for track in tracks:
+            xmin, ymin, xmax, ymax = track.bbox
+            xs, ys = np.meshgrid(xmin + grid * (xmax - xmin),
+                                 ymin + grid * (ymax - ymin))
+            points.append(np.stack([xs.ravel(), ys.ravel()], axis=1))
+        points = np.concatenate(points).reshape(-1, 1, 2).astype("float32")
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray,
+                                                          points, None)
+        flow = (next_points - points).reshape(len(tracks), -1, 2)
+        status = status.reshape(len(tracks), -1).astype(bool)
+        height, width = gray.shape
+        for track, track_flow, valid in zip(tracks, flow, status):
+            if valid.any():
+                dx, dy = np.median(track_flow[valid], axis=0)
+                track.bbox += np.array([dx, dy, dx, dy], dtype="float32")
+                track.bbox[[0, 2]] = np.clip(track.bbox[[0, 2]], 0, width)
+                track.bbox[[1, 3]] = np.clip(track.bbox[[1, 3]], 0, height)
+
+
+class StreamPredictor(object):
+    """
+    Args:
+        system_predictor: SystemPredictor whose detector, recognizer and
+            index are used.
+        config: the optional `Stream` section of the config.
+            det_interval: run the detector every N frames.
+            iou_thresh: min IoU to match a detection to a track.
+            max_age: drop a track not matched in this many detections.
+            change_thresh: re-recognize a track when the hash of its crop
+                differs from the last recognized one by more bits.
+            rec_interval: re-recognize a track at least every N frames, 0 to
+                disable.
+            vote_window: number of recognition results a track votes with.
+            use_optical_flow: propagate boxes between detections by optical
+                flow, otherwise boxes stay until the next detection.
+    """
+
+    def __init__(self, system_predictor, config=None):
+        config = config or {}
+        self.predictor = system_predictor
+        self.det_interval = max(config.get("det_interval", 5), 1)
+        self.change_thresh = config.get("change_thresh", 10)
+        self.rec_interval = config.get("rec_interval", 0)
+        self.tracker = IoUTracker(
+            iou_thresh=config.get("iou_thresh", 0.3),
+            max_age=config.get("max_age", 2),
+            vote_window=config.get("vote_window", 10),
+            use_optical_flow=config.get("use_optical_flow", False))
+        self.num_frames = 0
+        self.det_calls = 0
+        self.rec_calls = 0
+        # rec calls the per-frame pipeline would make, one per box per frame
+        self.baseline_rec_calls = 0
+        self.elapse = 0.0
+
+    def _detect(self, img):
+        if self.predictor.det_predictor:
+            results = self.predictor.det_predictor.predict(img)
+        else:
+            results = []
+        num_det = len(results)
+        results = self.predictor.append_self(results, img.shape)
+        self.det_calls += 1
+        # the boxes after the detections are the whole frame
+        return ([r["bbox"] for r in results],
+                [i >= num_det for i in range(len(results))])
+
+    def _need_rec(self, track, crop_hash):
+        if track.rec_hash is None:
+            return True
+        if self.rec_interval > 0 and \
+                track.frames_since_rec >= self.rec_interval:
+            return True
+        return bin(crop_hash ^ track.rec_hash).count("1") > self.change_thresh
+
+    def predict(self, img):
+        """predict one frame of the stream"""
+        start = time.time()
+        self.tracker.propagate(img)
+        if self.num_frames % self.det_interval == 0:
+            self.tracker.update(*self._detect(img))
+
+        snapshot = self.predictor.index.get()
+        output = []
+        for track in self.tracker.tracks:
+            xmin, ymin, xmax, ymax = track.bbox.astype("int")
+            if xmax <= xmin or ymax <= ymin:
+                continue
+            self.baseline_rec_calls += 1
+            track.frames_since_rec += 1
+            crop_img = img[ymin:ymax, xmin:xmax, :].copy()
+            crop_hash = dhash(crop_img)
+            if self._need_rec(track, crop_hash):
+                _, scores, docs = self.predictor.search(crop_img, snapshot)
+                self.rec_calls += 1
+                top1 = self.predictor.top1_result(scores[0], docs[0],
+                                                  snapshot.id_map)
+                track.votes.append(top1 if top1 is not None else (None, 0.0))
+                track.rec_hash = crop_hash
+                track.frames_since_rec = 0
+            result = track.vote()
+            if result is None:
+                continue
+            output.append({
+                "bbox": [xmin, ymin, xmax, ymax],
+                "rec_docs": result[0],
+                "rec_scores": result[1],
+                "track_id": track.track_id
+            })
+        output = self.predictor.nms_to_rec_results(
+            output, self.predictor.config["Global"]["rec_nms_thresold"])
+        self.num_frames += 1
+        self.elapse += time.time() - start
+        return output
+
+    def predict_stream(self, frames):
+        """yield the results of every frame of an iterable of RGB frames"""
+        for frame in frames:
+            yield self.predict(frame)
+
+    def stats(self):
+        return {
+            "frames": self.num_frames,
+            "fps": self.num_frames / self.elapse if self.elapse > 0 else 0.0,
+            "det_calls": self.det_calls,
+            "rec_calls": self.rec_calls,
+            "avoided_rec_calls": self.baseline_rec_calls - self.rec_calls
+        }
+
+
+def main(config):
+    system_predictor = SystemPredictor(config)
+    stream_predictor = StreamPredictor(system_predictor,
+                                       config.get("Stream", None))
+    video_file = config["Global"]["infer_video"]
+    for idx, output in enumerate(
+            stream_predictor.predict_stream(read_video(video_file))):
+        print("frame {}: {}".format(idx, output))
+    logger.info("Stream: {}".format(stream_predictor.stats()))
+    return
+
+
+if __name__ == "__main__":
+    args = config.parse_args()
+    config = config.get_config(args.config, overrides=args.override, show=True)
+    main(config)
@@ -11,15 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import os
 import copy
 
 import numpy as np
 import cv2
-import faiss
-import pickle
-
-from paddleclas.deploy.utils import logger, config
+from paddleclas.deploy.utils import logger, config, op_profile
+from paddleclas.deploy.utils.doc_store import doc_store_exists, first_valid_doc
+from paddleclas.deploy.utils.index_version import VersionedIndex, index_exists, load_index, resolve_index_dir
+from paddleclas.deploy.utils.rec_cache import RecognitionCache
 from paddleclas.deploy.utils.get_image_list import get_image_list
 from paddleclas.deploy.utils.draw_bbox import draw_bbox_results
 from paddleclas.deploy.python.predict_rec import RecPredictor
@@ -44,20 +43,47 @@ class SystemPredictor(object):
         self.return_k = self.config['IndexProcess']['return_k']
 
         index_dir = self.config["IndexProcess"]["index_dir"]
-        assert os.path.exists(os.path.join(
-            index_dir, "vector.index")), "vector.index not found ..."
-        assert os.path.exists(os.path.join(
-            index_dir, "id_map.pkl")), "id_map.pkl not found ... "
-
-        if config['IndexProcess'].get("dist_type") == "hamming":
-            self.Searcher = faiss.read_index_binary(
-                os.path.join(index_dir, "vector.index"))
-        else:
-            self.Searcher = faiss.read_index(
-                os.path.join(index_dir, "vector.index"))
-
-        with open(os.path.join(index_dir, "id_map.pkl"), "rb") as fd:
-            self.id_map = pickle.load(fd)
+        assert index_exists(
+            resolve_index_dir(index_dir)), "vector.index not found ..."
+        assert doc_store_exists(
+            resolve_index_dir(index_dir)), "doc_store not found ... "
+
+        # the searcher and doc_store are hot-swapped when a new index version
+        # is published in index_dir
+        dist_type = config['IndexProcess'].get("dist_type")
+        use_mmap = config['IndexProcess'].get("use_mmap", False)
+        warmup = config['IndexProcess'].get("warmup_queries", 0)
+        rerank_k = config['IndexProcess'].get("rerank_k", None)
+        # search parameters written by tools/tune_index.py
+        nprobe = config['IndexProcess'].get("nprobe", None)
+        ef_search = config['IndexProcess'].get("ef_search", None)
+        self.index = VersionedIndex(
+            index_dir,
+            lambda path: load_index(
+                path, dist_type, use_mmap, warmup, rerank_k,
+                nprobe=nprobe, ef_search=ef_search),
+            reload_interval=config['IndexProcess'].get("reload_interval",
+                                                       1.0))
+
+        # optional cache of recognition results of near-duplicate frames
+        self.rec_cache = None
+        cache_config = config.get("RecCache", None)
+        if cache_config and cache_config.get("enable", True):
+            self.rec_cache = RecognitionCache(
+                capacity=cache_config.get("capacity", 1024),
+                hamming_tolerance=cache_config.get("hamming_tolerance", 4),
+                level=cache_config.get("level", "crop"),
+                hash_size=cache_config.get("hash_size", 8))
+            # cached results are stale once the gallery version changes
+            self.index.add_listener(self.rec_cache.invalidate)
+
+    @property
+    def Searcher(self):
+        return self.index.get().searcher
+
+    @property
+    def id_map(self):
+        return self.index.get().id_map
 
     def append_self(self, results, shape):
         results.append({
@@ -96,10 +122,55 @@ class SystemPredictor(object):
 
         return filtered_results
 
+    def top1_result(self, scores, docs, id_map):
+        """return (rec_docs, rec_scores) of the top-1 result of one query if
+        it passes the threshold, else None"""
+        top = first_valid_doc(docs, id_map)
+        if top < 0:
+            return None
+        if self.config["IndexProcess"]["dist_type"] == "hamming":
+            if scores[top] > self.config["IndexProcess"]["hamming_radius"]:
+                return None
+        elif scores[top] < self.config["IndexProcess"]["score_thres"]:
+            return None
+        return id_map[docs[top]].split()[1], scores[top]
+
+    def search(self, crop_img, snapshot):
+        rec_results = self.rec_predictor.predict(crop_img)
+        scores, docs = snapshot.searcher.search(rec_results, self.return_k)
+        return rec_results, scores, docs
+
     def predict(self, img):
+        # use one index snapshot for the whole image
+        snapshot = self.index.get()
+        if self.rec_cache is not None and self.rec_cache.level == "frame":
+            output = self.rec_cache.lookup(
+                img, snapshot.version,
+                lambda: self.predict_with_snapshot(img, snapshot))
+            return copy.deepcopy(output)
+        return self.predict_with_snapshot(img, snapshot)
+
+    def predict_batch(self, imgs):
+        """detect a batch of images in one run, then recognize every image"""
+        if self.rec_cache is not None and self.rec_cache.level == "frame":
+            # cached frames skip detection as well
+            return [self.predict(img) for img in imgs]
+        snapshot = self.index.get()
+        if self.det_predictor:
+            det_results = self.det_predictor.predict_batch(imgs)
+        else:
+            det_results = [[] for _ in imgs]
+        return [
+            self.predict_with_snapshot(img, snapshot, results)
+            for img, results in zip(imgs, det_results)
+        ]
+
+    def predict_with_snapshot(self, img, snapshot, det_results=None):
         output = []
         # st1: get all detection results
-        if self.det_predictor:
+        if det_results is not None:
+            results = det_results
+        elif self.det_predictor:
             results = self.det_predictor.predict(img)
         else:
             results = []
@@ -112,22 +183,19 @@ class SystemPredictor(object):
             preds = {}
             xmin, ymin, xmax, ymax = result["bbox"].astype("int")
             crop_img = img[ymin:ymax, xmin:xmax, :].copy()
-            rec_results = self.rec_predictor.predict(crop_img)
             preds["bbox"] = [xmin, ymin, xmax, ymax]
-            scores, docs = self.Searcher.search(rec_results, self.return_k)
-
-            # just top-1 result will be returned for the final
-            if self.config["IndexProcess"]["dist_type"] == "hamming":
-                if scores[0][0] <= self.config["IndexProcess"][
-                        "hamming_radius"]:
-                    preds["rec_docs"] = self.id_map[docs[0][0]].split()[1]
-                    preds["rec_scores"] = scores[0][0]
-                    output.append(preds)
+            if self.rec_cache is not None and self.rec_cache.level == "crop":
+                # hits reuse the feature and search result of a similar crop
+                rec_results, scores, docs = self.rec_cache.lookup(
+                    crop_img, snapshot.version,
+                    lambda: self.search(crop_img, snapshot))
             else:
-                if scores[0][0] >= self.config["IndexProcess"]["score_thres"]:
-                    preds["rec_docs"] = self.id_map[docs[0][0]].split()[1]
-                    preds["rec_scores"] = scores[0][0]
-                    output.append(preds)
+                rec_results, scores, docs = self.search(crop_img, snapshot)
+            # just top-1 result will be returned for the final
+            top1 = self.top1_result(scores[0], docs[0], snapshot.id_map)
+            if top1 is not None:
+                preds["rec_docs"], preds["rec_scores"] = top1
+                output.append(preds)
 
         # st5: nms to the final results to avoid fetching duplicate results
         output = self.nms_to_rec_results(
@@ -140,13 +208,24 @@ def main(config):
     system_predictor = SystemPredictor(config)
     image_list = get_image_list(config["Global"]["infer_imgs"])
 
-    assert config["Global"]["batch_size"] == 1
-    for idx, image_file in enumerate(image_list):
-        img = cv2.imread(image_file)[:, :, ::-1]
-        output = system_predictor.predict(img)
-        save_dir = config["Global"]["output_dir"]
-        draw_bbox_results(img, output, image_file, save_dir=save_dir)
-        print(output)
+    # images are detected in batches of batch_size, and recognized one by one
+    batch_size = config["Global"]["batch_size"]
+    save_dir = config["Global"]["output_dir"]
+    for start in range(0, len(image_list), batch_size):
+        batch_files = image_list[start:start + batch_size]
+        batch_imgs = [cv2.imread(f)[:, :, ::-1] for f in batch_files]
+        if batch_size == 1:
+            outputs = [system_predictor.predict(batch_imgs[0])]
+        else:
+            outputs = system_predictor.predict_batch(batch_imgs)
+        for img, image_file, output in zip(batch_imgs, batch_files, outputs):
+            draw_bbox_results(img, output, image_file, save_dir=save_dir)
+            print(output)
+    if system_predictor.rec_cache is not None:
+        logger.info("Recognition cache: {}".format(
+            system_predictor.rec_cache.stats()))
+    for line in op_profile.summary():
+        logger.info(line)
     return
 
 
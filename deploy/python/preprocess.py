@@ -30,6 +30,7 @@ from PIL import Image
 from paddle.vision.transforms import ToTensor, Normalize, Resize, CenterCrop
 
 from paddleclas.deploy.python.det_preprocess import DetNormalizeImage, DetPadStride, DetPermute, DetResize
+from paddleclas.deploy.utils import op_profile
 
 
 def create_operators(params):
@@ -50,7 +51,7 @@ def create_operators(params):
         op = getattr(mod, op_name)(**param)
         ops.append(op)
 
-    return ops
+    return op_profile.wrap_ops(ops)
 
 
 class UnifiedResize(object):
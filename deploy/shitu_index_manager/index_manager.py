@@ -28,7 +28,7 @@ root_path/            # 库存储目录
 |   |-- ……
 |-- index              # 真正的生成的index库存储目录，后端生成及操作，前端无需操作。
 |   |-- vector.index   # faiss生成的索引库
-|   |-- id_map.pkl     # 索引文件
+|   |-- doc_store      # 索引文件，id到图像信息的映射
 """
 
 if __name__ == '__main__':
@@ -18,29 +18,37 @@ import mod.mainwindow
 
 from paddleclas.deploy.utils import config, logger
 from paddleclas.deploy.python.predict_rec import RecPredictor
+from paddleclas.deploy.utils.doc_store import DocStore, doc_store_exists, load_doc_store, save_doc_store
+from paddleclas.deploy.utils.feature_store import FeatureStore
+from paddleclas.deploy.utils.index_version import DEFAULT_KEEP_VERSIONS, create_version_dir, current_version, publish_version, resolve_index_dir
 from fastapi import FastAPI
 import uvicorn
 import numpy as np
 import faiss
 from typing import List
 import pickle
+import shutil
 import cv2
 import socket
 import json
 import operator
+import threading
 from multiprocessing import Process
 """
 完整的index库如下:
 root_path/            # 库存储目录
 |-- image_list.txt     # 图像列表，每行：image_path label。由前端生成及修改。后端只读
-|-- features.pkl       # 建库之后，保存的embedding向量，后端生成，前端无需操作
+|-- features           # 建库之后，保存的embedding向量(追加写入的memmap及删除日志)，后端生成，前端无需操作
 |-- images             # 图像存储目录，由前端生成及增删查等操作。后端只读
 |   |-- md5.jpg
 |   |-- md5.jpg
 |   |-- ……
 |-- index              # 真正的生成的index库存储目录，后端生成及操作，前端无需操作。
-|   |-- vector.index   # faiss生成的索引库
-|   |-- id_map.pkl     # 索引文件
+|   |-- CURRENT        # 当前发布的版本号，更新时原子替换，检索端据此热更新
+|   |-- versions       # 每次建库或更新生成一个新版本，保留最近keep_versions个
+|   |   |-- v000001
+|   |   |   |-- vector.index   # faiss生成的索引库
+|   |   |   |-- doc_store      # 索引文件，id到图像信息的映射
 """
 
 
@@ -49,13 +57,23 @@ class ShiTuIndexManager(object):
         self.root_path = None
         self.image_list_path = "image_list.txt"
         self.image_dir = "images"
-        self.index_path = "index/vector.index"
-        self.id_map_path = "index/id_map.pkl"
-        self.features_path = "features.pkl"
+        self.index_dir = "index"
+        self.features_path = "features"
+        # the feature store of a new index, swapped in once it is published
+        self.new_features_path = "features.new"
+        self.legacy_features_path = "features.pkl"
         self.index = None
         self.id_map = None
         self.features = None
+        # changes of the feature store, written once the index is published
+        self.pending_features = None
+        self.pending_deletes = None
         self.config = config
+        # rebuild the index and feature store when the ratio of deleted rows
+        # is larger than this threshold
+        self.compact_ratio = config["IndexProcess"].get("compact_ratio", 0.2)
+        self.keep_versions = max(config["IndexProcess"].get(
+            "keep_versions", DEFAULT_KEEP_VERSIONS), 1)
         self.predictor = RecPredictor(config)
 
     def _load_pickle(self, path):
@@ -64,26 +82,57 @@ class ShiTuIndexManager(object):
         else:
             return None
 
-    def _save_pickle(self, path, data):
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as fd:
-            pickle.dump(data, fd)
-
     def _load_index(self):
-        self.index = faiss.read_index(
-            os.path.join(self.root_path, self.index_path))
-        self.id_map = self._load_pickle(
-            os.path.join(self.root_path, self.id_map_path))
-        self.features = self._load_pickle(
-            os.path.join(self.root_path, self.features_path))
-
-    def _save_index(self, index, id_map, features):
-        faiss.write_index(index, os.path.join(self.root_path, self.index_path))
-        self._save_pickle(
-            os.path.join(self.root_path, self.id_map_path), id_map)
-        self._save_pickle(
-            os.path.join(self.root_path, self.features_path), features)
+        root_index_dir = os.path.join(self.root_path, self.index_dir)
+        version = current_version(root_index_dir)
+        index_dir = resolve_index_dir(root_index_dir)
+        self.index = faiss.read_index(os.path.join(index_dir, "vector.index"))
+        self.id_map = load_doc_store(index_dir, mmap=False)
+        features_path = os.path.join(self.root_path, self.features_path)
+        new_features_path = os.path.join(self.root_path,
+                                         self.new_features_path)
+        if FeatureStore.exists(new_features_path):
+            # left by create_index, used if its index has been published
+            if FeatureStore(new_features_path).version == version:
+                self._swap_features()
+            else:
+                shutil.rmtree(new_features_path)
+        if not FeatureStore.exists(features_path):
+            # migrate features.pkl saved by older versions
+            FeatureStore.from_features_dict(
+                features_path,
+                self._load_pickle(
+                    os.path.join(self.root_path, self.legacy_features_path)))
+        self.features = FeatureStore(features_path)
+        # commit or drop the journal left by an interrupted update
+        self.features.recover(version)
+
+    def _swap_features(self):
+        features_path = os.path.join(self.root_path, self.features_path)
+        old_path = features_path + ".old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(features_path):
+            os.rename(features_path, old_path)
+        os.rename(
+            os.path.join(self.root_path, self.new_features_path),
+            features_path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    def _save_index(self, index, id_map, before_publish=None):
+        # the index is written as a new version and published atomically, so
+        # searchers keep serving the old version until the new one is ready.
+        # The changes of the feature store are recorded by `before_publish`
+        # and committed after that, see FeatureStore.recover
+        root_index_dir = os.path.join(self.root_path, self.index_dir)
+        version, index_dir = create_version_dir(root_index_dir)
+        faiss.write_index(index, os.path.join(index_dir, "vector.index"))
+        save_doc_store(index_dir, id_map)
+        if before_publish is not None:
+            before_publish(version)
+        publish_version(root_index_dir, version, self.keep_versions)
+        return version
 
     def _update_path(self, root_path, image_list_path=None):
         if root_path == self.root_path:
@@ -157,43 +206,60 @@ class ShiTuIndexManager(object):
 
         # gernerate index
         if index_method == "IVF":
-            index_method = index_method + str(
-                min(max(int(len(gallery_images) // 32), 2), 65536)) + ",Flat"
+            # nlist may be set by tools/tune_index.py
+            nlist = self.config["IndexProcess"].get("nlist", None) or min(
+                max(int(len(gallery_images) // 32), 2), 65536)
+            index_method = index_method + str(nlist) + ",Flat"
         index = faiss.index_factory(
             self.config["IndexProcess"]["embedding_size"], index_method,
             faiss.METRIC_INNER_PRODUCT)
         self.index = faiss.IndexIDMap2(index)
         features = self._cal_featrue(gallery_images)
         self.index.train(features)
-        index_ids = np.arange(0, len(gallery_images)).astype(np.int64)
+        index_ids = np.arange(len(gallery_images), dtype=np.int64)
         self.index.add_with_ids(features, index_ids)
 
-        self.id_map = dict()
-        for i, d in zip(list(index_ids), gallery_docs):
-            self.id_map[i] = d
-
-        self.features = {
-            "features": features,
-            "index_method": index_method,
-            "image_ids": image_ids,
-            "index_ids": index_ids.tolist()
-        }
-        self._save_index(self.index, self.id_map, self.features)
+        self.id_map = DocStore()
+        self.id_map.add(index_ids, gallery_docs)
+
+        def create_features(version):
+            # the feature store of the old index is replaced only after the
+            # new index is published
+            features_store = FeatureStore.create(
+                os.path.join(self.root_path, self.new_features_path),
+                features.shape[1],
+                dtype=features.dtype,
+                index_method=index_method)
+            features_store.append(features, index_ids, image_ids)
+            features_store.set_version(version)
+
+        self._save_index(self.index, self.id_map, create_features)
+        self._swap_features()
+        self.features = FeatureStore(
+            os.path.join(self.root_path, self.features_path))
 
     def open_index(self, root_path: str, image_list_path: str) -> str:
         self._update_path(root_path)
         _, _, image_ids = self._split_datafile(image_list_path, root_path)
-        if os.path.exists(os.path.join(self.root_path, self.index_path)) and \
-                os.path.exists(os.path.join(self.root_path, self.id_map_path)) and \
-                os.path.exists(os.path.join(self.root_path, self.features_path)):
+        features_exists = FeatureStore.exists(
+            os.path.join(self.root_path, self.features_path)) or os.path.exists(
+                os.path.join(self.root_path, self.legacy_features_path)
+            ) or FeatureStore.exists(
+                os.path.join(self.root_path, self.new_features_path))
+        index_dir = resolve_index_dir(
+            os.path.join(self.root_path, self.index_dir))
+        if os.path.exists(os.path.join(index_dir, "vector.index")) and \
+                doc_store_exists(index_dir) and \
+                features_exists:
             self._update_path(root_path)
             self._load_index()
-            if operator.eq(set(image_ids), set(self.features['image_ids'])):
+            if operator.eq(
+                    set(image_ids), set(self.features.live_image_ids())):
                 return ""
             else:
                 return "The image list is different from index, Please update index"
         else:
-            return "File not exist: features.pkl, vector.index, id_map.pkl"
+            return "File not exist: features, vector.index, doc_store"
 
     def update_index(self, image_list: str, image_root: str=None) -> str:
         if self.index and self.id_map and self.features:
@@ -201,20 +267,40 @@ class ShiTuIndexManager(object):
                 image_list, image_root
                 if image_root is not None else self.root_path)
 
-            # for add image
-            add_ids = list(
-                set(image_ids).difference(set(self.features["image_ids"])))
-            add_indexes = [i for i, x in enumerate(image_ids) if x in add_ids]
-            add_image_paths = [image_paths[i] for i in add_indexes]
-            add_image_docs = [image_docs[i] for i in add_indexes]
-            add_image_ids = [image_ids[i] for i in add_indexes]
-            self._add_index(add_image_paths, add_image_docs, add_image_ids)
-
-            # delete images
-            delete_ids = list(
-                set(self.features["image_ids"]).difference(set(image_ids)))
-            self._delete_index(delete_ids)
-            self._save_index(self.index, self.id_map, self.features)
+            self.pending_features, self.pending_deletes = None, None
+            try:
+                # for add image
+                live_image_ids = set(self.features.live_image_ids())
+                add_ids = set(image_ids).difference(live_image_ids)
+                add_indexes = [
+                    i for i, x in enumerate(image_ids) if x in add_ids
+                ]
+                add_image_paths = [image_paths[i] for i in add_indexes]
+                add_image_docs = [image_docs[i] for i in add_indexes]
+                add_image_ids = [image_ids[i] for i in add_indexes]
+                self._add_index(add_image_paths, add_image_docs,
+                                add_image_ids)
+
+                # delete images
+                delete_ids = list(live_image_ids.difference(set(image_ids)))
+                self._delete_index(delete_ids)
+                compact = self._pending_tombstone_ratio() > self.compact_ratio
+                if compact and not self._support_remove():
+                    self._rebuild_index()
+                version = self._save_index(self.index, self.id_map,
+                                           self._write_journal)
+            except Exception:
+                # drop the changes in memory, the published index and the
+                # feature store are unchanged
+                self._load_index()
+                raise
+            self.features.recover(version)
+            self.pending_features, self.pending_deletes = None, None
+            if compact:
+                logger.info(
+                    "Compact features, {:.2%} of them are deleted".format(
+                        self.features.tombstone_ratio))
+                self.features.compact()
             return ""
         else:
             return "Failed. Please create or open index first"
@@ -223,43 +309,67 @@ class ShiTuIndexManager(object):
         if len(image_ids) == 0:
             return
         featrures = self._cal_featrue(image_list)
-        index_ids = (
-            np.arange(0, len(image_list)) + max(self.id_map.keys()) + 1
-        ).astype(np.int64)
+        index_ids = self.features.allocate_ids(len(image_list))
         self.index.add_with_ids(featrures, index_ids)
+        self.id_map.add(index_ids, image_docs)
+        self.pending_features = (featrures, index_ids, image_ids)
 
-        for i, d in zip(index_ids, image_docs):
-            self.id_map[i] = d
-
-        self.features['features'] = np.concatenate(
-            [self.features['features'], featrures], axis=0)
-        self.features['image_ids'].extend(image_ids)
-        self.features['index_ids'].extend(index_ids.tolist())
+    def _support_remove(self):
+        # HNSW can not remove vectors, so deleted ids are kept in the index
+        # as tombstones, which are filtered out by the doc_store when searching
+        index_method = self.features.meta.get("index_method") or ""
+        return "hnsw" not in index_method.lower()
 
     def _delete_index(self, image_ids: List):
         if len(image_ids) == 0:
             return
-        indexes = [
-            i for i, x in enumerate(self.features['image_ids'])
-            if x in image_ids
-        ]
-        self.features["features"] = np.delete(
-            self.features["features"], indexes, axis=0)
-        self.features["image_ids"] = np.delete(
-            np.asarray(self.features["image_ids"]), indexes, axis=0).tolist()
-        index_ids = np.delete(
-            np.asarray(self.features["index_ids"]), indexes, axis=0).tolist()
-        id_map_values = [self.id_map[i] for i in index_ids]
-        self.index.reset()
-        ids = np.arange(0, len(id_map_values)).astype(np.int64)
-        self.index.add_with_ids(self.features['features'], ids)
-        self.id_map.clear()
-        for i, d in zip(ids, id_map_values):
-            self.id_map[i] = d
-        self.features["index_ids"] = ids
+        index_ids = self.features.index_ids_of(image_ids)
+        if self._support_remove():
+            self.index.remove_ids(index_ids)
+        self.id_map.remove_ids(index_ids)
+        self.pending_deletes = index_ids
+
+    def _pending_tombstone_ratio(self):
+        """tombstone ratio of the feature store with the pending changes"""
+        num_rows = self.features.num_rows
+        num_deleted = num_rows - self.features.num_live
+        if self.pending_features is not None:
+            num_rows += len(self.pending_features[1])
+        if self.pending_deletes is not None:
+            num_deleted += len(self.pending_deletes)
+        return num_deleted / num_rows if num_rows > 0 else 0.0
+
+    def _rebuild_index(self):
+        # rebuild with the stable ids of the remaining features, to drop the
+        # tombstones of an index which can not remove vectors
+        logger.info("Rebuild index, {:.2%} of the features are deleted".format(
+            self._pending_tombstone_ratio()))
+        features, index_ids = self.features.live()
+        if self.pending_deletes is not None:
+            keep = ~np.isin(index_ids, self.pending_deletes)
+            features, index_ids = features[keep], index_ids[keep]
+        if self.pending_features is not None:
+            features = np.concatenate(
+                [features, self.pending_features[0]], axis=0)
+            index_ids = np.concatenate(
+                [index_ids, self.pending_features[1]])
+        index = faiss.index_factory(
+            self.config["IndexProcess"]["embedding_size"],
+            self.features.meta["index_method"], faiss.METRIC_INNER_PRODUCT)
+        self.index = faiss.IndexIDMap2(index)
+        self.index.train(features)
+        self.index.add_with_ids(features, index_ids)
+
+    def _write_journal(self, version):
+        features, index_ids, image_ids = self.pending_features or (None,
+                                                                    None, None)
+        self.features.write_journal(version, features, index_ids, image_ids,
+                                    self.pending_deletes)
 
 
 app = FastAPI()
+# handlers run in a thread pool, only one of them may modify the index at once
+manager_lock = threading.Lock()
 
 
 @app.get("/new_index")
@@ -271,13 +381,14 @@ def new_index(image_list_path: str,
     try:
         if index_root_path is not None:
             image_list_path = os.path.join(index_root_path, image_list_path)
-        index_path = os.path.join(index_root_path, "index", "vector.index")
-        id_map_path = os.path.join(index_root_path, "index", "id_map.pkl")
+        index_dir = resolve_index_dir(os.path.join(index_root_path, "index"))
+        index_path = os.path.join(index_dir, "vector.index")
 
         if not (os.path.exists(index_path) and
-                os.path.exists(id_map_path)) or force:
-            manager.create_index(image_list_path, index_method,
-                                 index_root_path)
+                doc_store_exists(index_dir)) or force:
+            with manager_lock:
+                manager.create_index(image_list_path, index_method,
+                                     index_root_path)
         else:
             result = "There alrealy has index in {}".format(index_root_path)
     except Exception as e:
@@ -291,7 +402,8 @@ def open_index(index_root_path: str, image_list_path: str):
     result = ""
     try:
         image_list_path = os.path.join(index_root_path, image_list_path)
-        result = manager.open_index(index_root_path, image_list_path)
+        with manager_lock:
+            result = manager.open_index(index_root_path, image_list_path)
     except Exception as e:
         result = e.__str__()
 
@@ -305,8 +417,9 @@ def update_index(image_list_path: str, index_root_path: str=None):
     try:
         if index_root_path is not None:
             image_list_path = os.path.join(index_root_path, image_list_path)
-        result = manager.update_index(
-            image_list=image_list_path, image_root=index_root_path)
+        with manager_lock:
+            result = manager.update_index(
+                image_list=image_list_path, image_root=index_root_path)
     except Exception as e:
         result = e.__str__()
     data = {"error_message": result}
@@ -2,4 +2,6 @@ from . import logger
 from . import config
 from . import get_image_list
 from . import predictor
-from . import encode_decode
\ No newline at end of file
+from . import encode_decode
+from . import doc_store
+from . import feature_store
@@ -0,0 +1,364 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A compact document store used to map faiss ids to gallery documents, which
+replaces the pickled `id_map.pkl` dict. The store is saved as a directory:
+
+doc_store/
+|-- ids.npy            # int64 ids, sorted
+|-- offsets.npy        # int64 offsets of every document in blob.bin, len(ids) + 1
+|-- blob.bin           # utf-8 encoded documents, memory-mapped when loading
+|-- doc_hash.npy       # sorted 64-bit hashes of the full documents
+|-- doc_hash_pos.npy   # position in ids.npy of every entry in doc_hash.npy
+|-- key_hash.npy       # sorted 64-bit hashes of the image keys(first field of document)
+|-- key_hash_pos.npy   # position in ids.npy of every entry in key_hash.npy
+|-- meta.json          # next_id: the next free id, ids are never reused
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+DOC_STORE_DIR = "doc_store"
+ID_MAP_FILE = "id_map.pkl"
+
+
+def hash_text(text):
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def doc_key(doc):
+    # the first field of a document is the image path
+    return doc.split()[0] if doc.strip() else doc
+
+
+class DocStore(object):
+    """
+    Map int64 ids to document strings with O(log N) lookup in both directions.
+    Appended and removed entries are kept in memory and merged when saving.
+    """
+
+    def __init__(self, ids=None, offsets=None, blob=None):
+        self.ids = np.zeros([0], dtype=np.int64) if ids is None else ids
+        self.offsets = np.zeros(
+            [1], dtype=np.int64) if offsets is None else offsets
+        self.blob = np.zeros([0], dtype=np.uint8) if blob is None else blob
+        self.doc_hash = np.zeros([0], dtype=np.int64)
+        self.doc_hash_pos = np.zeros([0], dtype=np.int64)
+        self.key_hash = np.zeros([0], dtype=np.int64)
+        self.key_hash_pos = np.zeros([0], dtype=np.int64)
+        self._removed = np.zeros([len(self.ids)], dtype=bool)
+        self._num_removed = 0
+        self._pending = {}
+        self._pending_doc_index = {}
+        self._pending_key_index = {}
+        # ids removed at the end are not handed out again, as the vectors of
+        # older index versions, e.g. for re-ranking, are addressed by id
+        self.next_id = int(self.ids.max()) + 1 if len(self.ids) > 0 else 0
+
+    @classmethod
+    def from_dict(cls, id_map):
+        store = cls()
+        if len(id_map) > 0:
+            ids = np.asarray(list(id_map.keys()), dtype=np.int64)
+            store.add(ids, [id_map[k] for k in id_map.keys()])
+            store.compact()
+        return store
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = "r" if mmap else None
+        ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(
+            os.path.join(path, "offsets.npy"), mmap_mode=mmap_mode)
+        blob_path = os.path.join(path, "blob.bin")
+        if os.path.getsize(blob_path) > 0 and mmap:
+            blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            blob = np.fromfile(blob_path, dtype=np.uint8)
+        store = cls(ids, offsets, blob)
+        for name in ["doc_hash", "doc_hash_pos", "key_hash", "key_hash_pos"]:
+            setattr(store, name,
+                    np.load(
+                        os.path.join(path, name + ".npy"),
+                        mmap_mode=mmap_mode))
+        # stores saved by older versions only know the ids they still hold
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as fd:
+                store.next_id = max(store.next_id, json.load(fd)["next_id"])
+        return store
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(
+            os.path.join(index_dir, DOC_STORE_DIR, "ids.npy"))
+
+    def save(self, path):
+        self.compact()
+        tmp_path = path.rstrip("/") + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "ids.npy"), np.asarray(self.ids))
+        np.save(
+            os.path.join(tmp_path, "offsets.npy"), np.asarray(self.offsets))
+        np.asarray(self.blob).tofile(os.path.join(tmp_path, "blob.bin"))
+        for name in ["doc_hash", "doc_hash_pos", "key_hash", "key_hash_pos"]:
+            np.save(
+                os.path.join(tmp_path, name + ".npy"),
+                np.asarray(getattr(self, name)))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as fd:
+            json.dump({"next_id": self.next_id}, fd)
+        # swap the directory so readers never see a partially written store
+        if os.path.exists(path):
+            old_path = path.rstrip("/") + ".old"
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, path)
+
+    def __len__(self):
+        return len(self.ids) - self._num_removed + len(self._pending)
+
+    def _position(self, idx):
+        pos = int(np.searchsorted(self.ids, idx))
+        if pos < len(self.ids) and self.ids[pos] == idx and not self._removed[
+                pos]:
+            return pos
+        return -1
+
+    def _doc_at(self, pos):
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def __contains__(self, idx):
+        return int(idx) in self._pending or self._position(int(idx)) >= 0
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx in self._pending:
+            return self._pending[idx]
+        pos = self._position(idx)
+        if pos < 0:
+            raise KeyError(idx)
+        return self._doc_at(pos)
+
+    def get(self, idx, default=None):
+        try:
+            return self[idx]
+        except KeyError:
+            return default
+
+    def max_id(self):
+        max_id = -1
+        if len(self.ids) > 0:
+            max_id = int(self.ids[~self._removed].max(
+            )) if self._num_removed < len(self.ids) else -1
+        if len(self._pending) > 0:
+            max_id = max(max_id, max(self._pending.keys()))
+        return max_id
+
+    def keys(self):
+        keys = np.asarray(self.ids)[~self._removed].tolist()
+        return keys + list(self._pending.keys())
+
+    def items(self):
+        for pos in np.nonzero(~self._removed)[0]:
+            yield int(self.ids[pos]), self._doc_at(pos)
+        for idx, doc in self._pending.items():
+            yield idx, doc
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def _lookup(self, text, sorted_hash, hash_pos, pending_index, match):
+        h = hash_text(text)
+        left = int(np.searchsorted(sorted_hash, h, side="left"))
+        right = int(np.searchsorted(sorted_hash, h, side="right"))
+        ids = []
+        for pos in hash_pos[left:right]:
+            # guard against hash collisions
+            if not self._removed[pos] and match(self._doc_at(pos)) == text:
+                ids.append(int(self.ids[pos]))
+        ids.extend(pending_index.get(text, []))
+        return ids
+
+    def lookup_doc(self, doc):
+        """return the ids whose document equals `doc`"""
+        return self._lookup(doc, self.doc_hash, self.doc_hash_pos,
+                            self._pending_doc_index, lambda d: d)
+
+    def lookup_key(self, key):
+        """return the ids whose image key(first field) equals `key`"""
+        return self._lookup(key, self.key_hash, self.key_hash_pos,
+                            self._pending_key_index, doc_key)
+
+    def add(self, ids, docs):
+        assert len(ids) == len(docs), "ids and docs must have the same length"
+        for idx, doc in zip(ids, docs):
+            idx = int(idx)
+            assert idx not in self, "id {} already exists".format(idx)
+            self._pending[idx] = doc
+            self.next_id = max(self.next_id, idx + 1)
+            self._pending_doc_index.setdefault(doc, []).append(idx)
+            self._pending_key_index.setdefault(doc_key(doc), []).append(idx)
+
+    def remove_ids(self, ids):
+        for idx in ids:
+            idx = int(idx)
+            if idx in self._pending:
+                doc = self._pending.pop(idx)
+                self._pending_doc_index[doc].remove(idx)
+                self._pending_key_index[doc_key(doc)].remove(idx)
+                continue
+            pos = self._position(idx)
+            if pos >= 0:
+                self._removed[pos] = True
+                self._num_removed += 1
+
+    def compact(self):
+        """merge pending appends and removals into the columnar arrays"""
+        if self._num_removed == 0 and len(self._pending) == 0:
+            return
+        keep = ~self._removed
+        ids = np.asarray(self.ids)
+        offsets = np.asarray(self.offsets)
+        lengths = offsets[1:] - offsets[:-1]
+        if self._num_removed > 0:
+            kept_lengths = lengths[keep]
+            kept_starts = offsets[:-1][keep]
+            kept_offsets = np.concatenate(
+                [[0], np.cumsum(kept_lengths)]).astype(np.int64)
+            # gather the byte ranges of all kept documents at once
+            gather = np.repeat(kept_starts - kept_offsets[:-1],
+                               kept_lengths) + np.arange(kept_offsets[-1])
+            blob = np.asarray(self.blob)[gather]
+            new_pos = np.cumsum(keep) - 1
+
+            def _filter(sorted_hash, hash_pos):
+                hash_keep = keep[hash_pos]
+                return (np.asarray(sorted_hash)[hash_keep],
+                        new_pos[np.asarray(hash_pos)[hash_keep]])
+
+            doc_hash, doc_hash_pos = _filter(self.doc_hash, self.doc_hash_pos)
+            key_hash, key_hash_pos = _filter(self.key_hash, self.key_hash_pos)
+            ids = ids[keep]
+        else:
+            kept_offsets = offsets
+            blob = np.asarray(self.blob)
+            doc_hash, doc_hash_pos = np.asarray(self.doc_hash), np.asarray(
+                self.doc_hash_pos)
+            key_hash, key_hash_pos = np.asarray(self.key_hash), np.asarray(
+                self.key_hash_pos)
+
+        pending_ids = np.asarray(list(self._pending.keys()), dtype=np.int64)
+        pending_docs = [
+            self._pending[idx].encode("utf-8") for idx in pending_ids
+        ]
+        pending_lengths = np.asarray(
+            [len(doc) for doc in pending_docs], dtype=np.int64)
+        pending_pos = np.arange(len(pending_ids)) + len(ids)
+        all_ids = np.concatenate([ids, pending_ids])
+        all_offsets = np.concatenate(
+            [kept_offsets, kept_offsets[-1] + np.cumsum(pending_lengths)])
+        all_blob = np.concatenate(
+            [blob, np.frombuffer(b"".join(pending_docs), dtype=np.uint8)])
+        doc_hash = np.concatenate([
+            doc_hash, np.asarray(
+                [hash_text(self._pending[idx]) for idx in pending_ids],
+                dtype=np.int64)
+        ])
+        key_hash = np.concatenate([
+            key_hash, np.asarray(
+                [hash_text(doc_key(self._pending[idx])) for idx in pending_ids],
+                dtype=np.int64)
+        ])
+        doc_hash_pos = np.concatenate([doc_hash_pos, pending_pos])
+        key_hash_pos = np.concatenate([key_hash_pos, pending_pos])
+
+        # keep ids sorted, and remap the hash positions accordingly
+        order = np.argsort(all_ids, kind="stable")
+        if not np.all(order == np.arange(len(order))):
+            lengths = all_offsets[1:] - all_offsets[:-1]
+            sorted_lengths = lengths[order]
+            sorted_offsets = np.concatenate(
+                [[0], np.cumsum(sorted_lengths)]).astype(np.int64)
+            gather = np.repeat(all_offsets[:-1][order] - sorted_offsets[:-1],
+                               sorted_lengths) + np.arange(sorted_offsets[-1])
+            all_blob = all_blob[gather]
+            all_offsets = sorted_offsets
+            all_ids = all_ids[order]
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(len(order))
+            doc_hash_pos = inverse[doc_hash_pos]
+            key_hash_pos = inverse[key_hash_pos]
+
+        doc_order = np.argsort(doc_hash, kind="stable")
+        key_order = np.argsort(key_hash, kind="stable")
+        self.ids = all_ids.astype(np.int64)
+        self.offsets = all_offsets.astype(np.int64)
+        self.blob = all_blob.astype(np.uint8)
+        self.doc_hash = doc_hash[doc_order]
+        self.doc_hash_pos = doc_hash_pos[doc_order].astype(np.int64)
+        self.key_hash = key_hash[key_order]
+        self.key_hash_pos = key_hash_pos[key_order].astype(np.int64)
+        self._removed = np.zeros([len(self.ids)], dtype=bool)
+        self._num_removed = 0
+        self._pending = {}
+        self._pending_doc_index = {}
+        self._pending_key_index = {}
+
+
+def load_doc_store(index_dir, mmap=True):
+    """
+    load the document store in `index_dir`, fall back to the legacy
+    `id_map.pkl` if the index has not been migrated yet
+    """
+    if DocStore.exists(index_dir):
+        return DocStore.load(os.path.join(index_dir, DOC_STORE_DIR), mmap=mmap)
+    id_map_path = os.path.join(index_dir, ID_MAP_FILE)
+    assert os.path.exists(id_map_path), "{} and {} not found in {}".format(
+        DOC_STORE_DIR, ID_MAP_FILE, index_dir)
+    with open(id_map_path, "rb") as fd:
+        return DocStore.from_dict(pickle.load(fd))
+
+
+def save_doc_store(index_dir, store):
+    store.save(os.path.join(index_dir, DOC_STORE_DIR))
+
+
+def doc_store_exists(index_dir):
+    return DocStore.exists(index_dir) or os.path.exists(
+        os.path.join(index_dir, ID_MAP_FILE))
+
+
+def first_valid_doc(docs, id_map):
+    """
+    position of the first search result of one query with a document, or -1.
+    ids deleted from an index which can not remove vectors(e.g. HNSW) are
+    kept as tombstones, they are skipped as well as the -1 paddings
+    """
+    for i, doc_id in enumerate(docs):
+        if doc_id >= 0 and doc_id in id_map:
+            return i
+    return -1
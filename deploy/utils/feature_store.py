@@ -0,0 +1,294 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+An append-only store of gallery features with a deletion log, which replaces
+the pickled `features.pkl`. The store is saved as a directory:
+
+features/
+|-- meta.json          # dim, dtype, index_method and the next free index id
+|-- vectors.bin        # append-only feature rows, memory-mapped when reading
+|-- index_ids.bin      # int64 index id of every row
+|-- image_ids.txt      # image id of every row, one per line
+|-- deleted.bin        # int64 index ids deleted since the last compaction
+|-- journal            # changes of an index version not committed yet
+
+The changes of a new index version are written to the journal before the
+version is published, and committed to the store after that. A journal
+left by an interrupted update is replayed if its version was published,
+and dropped otherwise, see `recover`.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+JOURNAL_DIR = "journal"
+
+
+class FeatureStore(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as fd:
+            self.meta = json.load(fd)
+        self.dim = self.meta["dim"]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self._load()
+
+    @classmethod
+    def create(cls, path, dim, dtype="float32", index_method=None):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        meta = {
+            "dim": int(dim),
+            "dtype": np.dtype(dtype).name,
+            "index_method": index_method,
+            "next_id": 0
+        }
+        with open(os.path.join(path, "meta.json"), "w") as fd:
+            json.dump(meta, fd)
+        for name in ["vectors.bin", "index_ids.bin", "deleted.bin"]:
+            open(os.path.join(path, name), "wb").close()
+        open(os.path.join(path, "image_ids.txt"), "w").close()
+        return cls(path)
+
+    @classmethod
+    def from_features_dict(cls, path, features):
+        """migrate the dict saved in the legacy features.pkl"""
+        feats = np.asarray(features["features"])
+        store = cls.create(
+            path,
+            feats.shape[1],
+            dtype=feats.dtype,
+            index_method=features.get("index_method"))
+        store.append(feats,
+                     np.asarray(features["index_ids"]), features["image_ids"])
+        return store
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    def _load(self):
+        row_bytes = self.dim * self.dtype.itemsize
+        num_vectors = os.path.getsize(
+            os.path.join(self.path, "vectors.bin")) // row_bytes
+        index_ids = np.fromfile(
+            os.path.join(self.path, "index_ids.bin"), dtype=np.int64)
+        with open(
+                os.path.join(self.path, "image_ids.txt"), "r",
+                encoding="utf-8") as fd:
+            image_ids = fd.read().splitlines()
+        # drop a partially written tail left by an interrupted append
+        num_rows = min(num_vectors, len(index_ids), len(image_ids))
+        self.index_ids = index_ids[:num_rows]
+        self.image_ids = image_ids[:num_rows]
+        self.num_rows = num_rows
+        deleted = np.fromfile(
+            os.path.join(self.path, "deleted.bin"), dtype=np.int64)
+        self.deleted = np.isin(self.index_ids, deleted)
+        self._id_to_row = {
+            image_id: row
+            for row, image_id in enumerate(self.image_ids)
+            if not self.deleted[row]
+        }
+
+    def _save_meta(self):
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w") as fd:
+            json.dump(self.meta, fd)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    @property
+    def vectors(self):
+        if self.num_rows == 0:
+            return np.zeros([0, self.dim], dtype=self.dtype)
+        return np.memmap(
+            os.path.join(self.path, "vectors.bin"),
+            dtype=self.dtype,
+            mode="r",
+            shape=(self.num_rows, self.dim))
+
+    @property
+    def next_id(self):
+        return self.meta["next_id"]
+
+    @property
+    def num_live(self):
+        return self.num_rows - int(self.deleted.sum())
+
+    @property
+    def tombstone_ratio(self):
+        if self.num_rows == 0:
+            return 0.0
+        return 1.0 - self.num_live / self.num_rows
+
+    def live_image_ids(self):
+        return list(self._id_to_row.keys())
+
+    def allocate_ids(self, num):
+        """ids are never reused, so deleted ids stay invalid for readers"""
+        ids = np.arange(num, dtype=np.int64) + self.next_id
+        self.meta["next_id"] = self.next_id + num
+        self._save_meta()
+        return ids
+
+    def append(self, features, index_ids, image_ids):
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        index_ids = np.asarray(index_ids, dtype=np.int64)
+        assert features.shape[0] == len(index_ids) == len(image_ids)
+        with open(os.path.join(self.path, "vectors.bin"), "ab") as fd:
+            features.tofile(fd)
+        with open(os.path.join(self.path, "index_ids.bin"), "ab") as fd:
+            index_ids.tofile(fd)
+        with open(
+                os.path.join(self.path, "image_ids.txt"), "a",
+                encoding="utf-8") as fd:
+            for image_id in image_ids:
+                fd.write("{}\n".format(image_id))
+        start = self.num_rows
+        self.index_ids = np.concatenate([self.index_ids, index_ids])
+        self.image_ids.extend(image_ids)
+        self.deleted = np.concatenate(
+            [self.deleted, np.zeros(
+                [len(index_ids)], dtype=bool)])
+        self.num_rows += len(index_ids)
+        for row, image_id in enumerate(image_ids):
+            self._id_to_row[image_id] = start + row
+        if len(index_ids) > 0 and index_ids.max() >= self.next_id:
+            self.meta["next_id"] = int(index_ids.max()) + 1
+            self._save_meta()
+
+    def index_ids_of(self, image_ids):
+        rows = [
+            self._id_to_row[x] for x in image_ids if x in self._id_to_row
+        ]
+        return self.index_ids[rows]
+
+    def delete(self, index_ids):
+        index_ids = np.asarray(index_ids, dtype=np.int64)
+        with open(os.path.join(self.path, "deleted.bin"), "ab") as fd:
+            index_ids.tofile(fd)
+        rows = np.nonzero(np.isin(self.index_ids, index_ids))[0]
+        self.deleted[rows] = True
+        for row in rows:
+            self._id_to_row.pop(self.image_ids[row], None)
+
+    @property
+    def version(self):
+        """the index version the store is committed for"""
+        return self.meta.get("version", None)
+
+    def set_version(self, version):
+        self.meta["version"] = version
+        self._save_meta()
+
+    def write_journal(self,
+                      version,
+                      features=None,
+                      index_ids=None,
+                      image_ids=None,
+                      deleted=None):
+        """record the changes of index `version` before it is published"""
+        journal_path = os.path.join(self.path, JOURNAL_DIR)
+        tmp_path = journal_path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        if features is None:
+            features = np.zeros([0, self.dim], dtype=self.dtype)
+            index_ids, image_ids = np.zeros([0], dtype=np.int64), []
+        if deleted is None:
+            deleted = np.zeros([0], dtype=np.int64)
+        np.save(
+            os.path.join(tmp_path, "features.npy"),
+            np.asarray(
+                features, dtype=self.dtype))
+        np.save(
+            os.path.join(tmp_path, "index_ids.npy"),
+            np.asarray(
+                index_ids, dtype=np.int64))
+        np.save(
+            os.path.join(tmp_path, "deleted.npy"),
+            np.asarray(
+                deleted, dtype=np.int64))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as fd:
+            json.dump({"version": version, "image_ids": list(image_ids)}, fd)
+        if os.path.exists(journal_path):
+            shutil.rmtree(journal_path)
+        os.rename(tmp_path, journal_path)
+
+    def recover(self, published_version):
+        """
+        commit the journal if its version is published, else drop it. Rows
+        already appended by an interrupted commit are not appended again.
+        """
+        journal_path = os.path.join(self.path, JOURNAL_DIR)
+        if not os.path.exists(os.path.join(journal_path, "meta.json")):
+            return
+        with open(os.path.join(journal_path, "meta.json"), "r") as fd:
+            journal = json.load(fd)
+        if journal["version"] == published_version and \
+                self.version != published_version:
+            features = np.load(os.path.join(journal_path, "features.npy"))
+            index_ids = np.load(os.path.join(journal_path, "index_ids.npy"))
+            new = ~np.isin(index_ids, self.index_ids)
+            self.append(features[new], index_ids[new], [
+                x for x, n in zip(journal["image_ids"], new) if n
+            ])
+            deleted = np.load(os.path.join(journal_path, "deleted.npy"))
+            if len(deleted) > 0:
+                self.delete(deleted)
+            self.set_version(published_version)
+        shutil.rmtree(journal_path)
+
+    def live(self):
+        """return (features, index_ids) of the rows which are not deleted"""
+        keep = ~self.deleted
+        return np.asarray(self.vectors[keep]), self.index_ids[keep]
+
+    def compact(self):
+        """rewrite the store without the deleted rows, ids are kept stable"""
+        keep = ~self.deleted
+        tmp_path = self.path.rstrip("/") + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "vectors.bin"), "wb") as fd:
+            vectors = self.vectors
+            chunk_size = 65536
+            for start in range(0, self.num_rows, chunk_size):
+                chunk = vectors[start:start + chunk_size]
+                np.ascontiguousarray(chunk[keep[start:start + chunk_size]])\
+                    .tofile(fd)
+        self.index_ids[keep].tofile(os.path.join(tmp_path, "index_ids.bin"))
+        with open(
+                os.path.join(tmp_path, "image_ids.txt"), "w",
+                encoding="utf-8") as fd:
+            for image_id, k in zip(self.image_ids, keep):
+                if k:
+                    fd.write("{}\n".format(image_id))
+        open(os.path.join(tmp_path, "deleted.bin"), "wb").close()
+        with open(os.path.join(tmp_path, "meta.json"), "w") as fd:
+            json.dump(self.meta, fd)
+
+        old_path = self.path.rstrip("/") + ".old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.rename(self.path, old_path)
+        os.rename(tmp_path, self.path)
+        shutil.rmtree(old_path)
+        self._load()
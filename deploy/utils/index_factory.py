@@ -0,0 +1,205 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Translate IndexProcess.index_method into a faiss index_factory string, and
+keep the float vectors of compressed indexes for exact re-ranking.
+
+Supported index_method:
+    HNSW32, Flat: used as is
+    IVF:    IVF{nlist},Flat
+    IVFPQ:  IVF{nlist},PQ{M}        product quantization, M bytes per vector
+    OPQ:    OPQ{M},IVF{nlist},PQ{M} PQ with a learned rotation
+    SQ8:    SQ8                     8-bit scalar quantization, d bytes per vector
+    IVFSQ8: IVF{nlist},SQ8
+any other string is passed to faiss.index_factory unchanged.
+"""
+
+import glob
+import json
+import math
+import os
+import uuid
+
+import numpy as np
+
+RERANK_FILE = "rerank.json"
+RERANK_VECTORS = "rerank_vectors_{}.bin"
+
+
+def auto_nlist(gallery_size):
+    # 4 * sqrt(N) lists, with at least 39 training points per centroid
+    nlist = min(int(4 * math.sqrt(gallery_size)), gallery_size // 39)
+    return int(min(max(nlist, 1), 65536))
+
+
+def auto_pq_m(embedding_size):
+    # the largest divisor of d which is no larger than d / 8, i.e. >= 16x
+    # compression of float32 vectors
+    for m in range(max(embedding_size // 8, 1), 0, -1):
+        if embedding_size % m == 0:
+            return m
+    return 1
+
+
+def auto_pq_nbits(gallery_size):
+    # a PQ codebook of 2^nbits centroids needs at least as many points
+    return int(min(8, max(math.floor(math.log2(max(gallery_size, 2))), 1)))
+
+
+def get_index_method(index_method,
+                     gallery_size,
+                     embedding_size,
+                     dist_type="IP",
+                     nlist=None,
+                     pq_m=None):
+    """return the faiss index_factory string of `index_method`"""
+    if index_method == "IVF":
+        # keep the list count of galleries built by older versions
+        nlist = nlist or min(max(int(gallery_size // 8), 1), 65536)
+        index_method = "IVF{},Flat".format(nlist)
+    elif index_method in ["IVFPQ", "OPQ", "IVFSQ8"]:
+        nlist = nlist or auto_nlist(gallery_size)
+        pq_m = pq_m or auto_pq_m(embedding_size)
+        nbits = auto_pq_nbits(gallery_size)
+        pq = "PQ{}".format(pq_m) if nbits == 8 else "PQ{}x{}".format(pq_m,
+                                                                   nbits)
+        if index_method == "IVFPQ":
+            index_method = "IVF{},{}".format(nlist, pq)
+        elif index_method == "OPQ":
+            index_method = "OPQ{},IVF{},{}".format(pq_m, nlist, pq)
+        else:
+            index_method = "IVF{},SQ8".format(nlist)
+
+    # for binary index, add B at head of index_method
+    if dist_type == "hamming":
+        index_method = "B" + index_method
+    return index_method
+
+
+def new_rerank_vectors_path(root_dir):
+    """create an empty vectors file with a unique name in `root_dir`, it is
+    never shared with the vectors file of another build"""
+    while True:
+        path = os.path.join(root_dir, RERANK_VECTORS.format(uuid.uuid4().hex))
+        try:
+            open(path, "xb").close()
+            return path
+        except FileExistsError:
+            continue
+
+
+def rerank_vectors_path(index_dir):
+    """return the vectors file used by the index in `index_dir`, or None"""
+    if not os.path.exists(os.path.join(index_dir, RERANK_FILE)):
+        return None
+    with open(os.path.join(index_dir, RERANK_FILE), "r") as fd:
+        config = json.load(fd)
+    return os.path.abspath(os.path.join(index_dir, config["vectors"]))
+
+
+def remove_unused_rerank_vectors(root_dir, index_dirs):
+    """remove the vectors files of `root_dir` no index in `index_dirs` uses"""
+    used = set(rerank_vectors_path(d) for d in index_dirs)
+    for path in glob.glob(os.path.join(root_dir, RERANK_VECTORS.format("*"))):
+        if os.path.abspath(path) not in used:
+            os.remove(path)
+
+
+def append_rerank_vectors(path,
+                          start_id,
+                          features,
+                          rows=None,
+                          chunk_size=65536):
+    """
+    write float vectors to an id-addressed memmap file, the vector of id i
+    is row i. Ids are never reused, so the file only grows and all versions
+    of an index built by appending can share it.
+    """
+    num = len(rows) if rows is not None else features.shape[0]
+    dim = features.shape[1]
+    total = start_id + num
+    if not os.path.exists(path):
+        open(path, "wb").close()
+    if os.path.getsize(path) < total * dim * 4:
+        os.truncate(path, total * dim * 4)
+    vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(total, dim))
+    for start in range(0, num, chunk_size):
+        end = min(start + chunk_size, num)
+        if rows is not None:
+            chunk = features[rows[start:end]]
+        else:
+            chunk = features[start:end]
+        vectors[start_id + start:start_id + end] = chunk
+    vectors.flush()
+    return path
+
+
+def write_rerank_config(index_dir, vectors_path, dim, rerank_k, dist_type):
+    config = {
+        "vectors": os.path.relpath(vectors_path, index_dir),
+        "dim": int(dim),
+        "rerank_k": int(rerank_k),
+        "metric": dist_type
+    }
+    with open(os.path.join(index_dir, RERANK_FILE), "w") as fd:
+        json.dump(config, fd, indent=2)
+
+
+class RerankIndex(object):
+    """
+    Search `rerank_k` candidates in a compressed index and re-rank them with
+    the exact distance to the float vectors in a memory-mapped file.
+    """
+
+    def __init__(self, index, vectors, rerank_k, metric="IP"):
+        self.index = index
+        self.vectors = vectors
+        self.rerank_k = rerank_k
+        self.metric = metric
+
+    @classmethod
+    def load(cls, index, index_dir, rerank_k=None):
+        with open(os.path.join(index_dir, RERANK_FILE), "r") as fd:
+            config = json.load(fd)
+        path = os.path.join(index_dir, config["vectors"])
+        num = os.path.getsize(path) // (config["dim"] * 4)
+        vectors = np.memmap(
+            path, dtype=np.float32, mode="r", shape=(num, config["dim"]))
+        rerank_k = config["rerank_k"] if rerank_k is None else rerank_k
+        return cls(index, vectors, rerank_k, config["metric"])
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    @property
+    def d(self):
+        return self.index.d
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        _, ids = self.index.search(queries, max(k, self.rerank_k))
+        valid = (ids >= 0) & (ids < len(self.vectors))
+        candidates = np.asarray(self.vectors[np.where(valid, ids, 0)])
+        if self.metric == "IP":
+            scores = np.einsum("qd,qrd->qr", queries, candidates)
+            scores = np.where(valid, scores, -np.inf)
+            order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        else:
+            scores = np.sum(np.square(candidates - queries[:, None, :]), axis=2)
+            scores = np.where(valid, scores, np.inf)
+            order = np.argsort(scores, axis=1, kind="stable")[:, :k]
+        ids = np.where(valid, ids, -1)
+        return (np.take_along_axis(scores, order, axis=1).astype(np.float32),
+                np.take_along_axis(ids, order, axis=1))
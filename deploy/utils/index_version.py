@@ -0,0 +1,335 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Versioned index directory, which lets writers publish a new index while
+readers keep serving queries with the old one. The layout is:
+
+index_dir/
+|-- CURRENT            # name of the published version
+|-- versions
+|   |-- v000001        # vector.index and doc_store of every version
+|   |-- v000002
+|   |-- ……
+
+Writers build a new version in `versions/` and then atomically replace
+`CURRENT`. An index_dir without `CURRENT` is treated as a single version, so
+indexes built by older versions keep working.
+"""
+
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+import faiss
+import numpy as np
+
+from . import logger
+from .doc_store import load_doc_store
+from .index_factory import RERANK_FILE, RerankIndex
+from .sharded_index import ShardedIndex, is_sharded
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+DEFAULT_KEEP_VERSIONS = 3
+
+IndexSnapshot = namedtuple("IndexSnapshot", ["version", "searcher", "id_map"])
+
+
+def current_version(index_dir):
+    current_path = os.path.join(index_dir, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path, "r") as fd:
+        return fd.read().strip() or None
+
+
+def resolve_index_dir(index_dir):
+    """return the directory of the published version"""
+    version = current_version(index_dir)
+    if version is None:
+        return index_dir
+    return os.path.join(index_dir, VERSIONS_DIR, version)
+
+
+def index_exists(index_path):
+    """whether a single or sharded faiss index exists in `index_path`"""
+    return os.path.exists(os.path.join(index_path, "vector.index")) or \
+        is_sharded(index_path)
+
+
+def list_versions(index_dir):
+    versions_dir = os.path.join(index_dir, VERSIONS_DIR)
+    if not os.path.exists(versions_dir):
+        return []
+    return sorted(v for v in os.listdir(versions_dir) if v.startswith("v"))
+
+
+def keep_versions_of(config, index_dir):
+    """
+    number of versions to retain, 0 means the legacy single version layout.
+    An index_dir which is already versioned stays versioned.
+    """
+    keep_versions = config.get("keep_versions", 0)
+    if keep_versions <= 0 and current_version(index_dir) is not None:
+        keep_versions = DEFAULT_KEEP_VERSIONS
+    return keep_versions
+
+
+def create_version_dir(index_dir):
+    versions = list_versions(index_dir)
+    last = int(versions[-1][1:]) if versions else 0
+    version = "v{:06d}".format(last + 1)
+    version_dir = os.path.join(index_dir, VERSIONS_DIR, version)
+    os.makedirs(version_dir)
+    return version, version_dir
+
+
+def _write_current(index_dir, version):
+    tmp_path = os.path.join(index_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w") as fd:
+        fd.write(version)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_path, os.path.join(index_dir, CURRENT_FILE))
+
+
+def publish_version(index_dir, version, keep_versions=DEFAULT_KEEP_VERSIONS):
+    _write_current(index_dir, version)
+    prune_versions(index_dir, keep_versions)
+    logger.info("Publish index version {} in {}".format(version, index_dir))
+
+
+def prune_versions(index_dir, keep_versions):
+    """remove the oldest versions, the published one is always kept"""
+    current = current_version(index_dir)
+    versions = [v for v in list_versions(index_dir) if v != current]
+    num_remove = len(versions) - max(keep_versions - 1, 0)
+    for version in versions[:max(num_remove, 0)]:
+        shutil.rmtree(
+            os.path.join(index_dir, VERSIONS_DIR, version), ignore_errors=True)
+
+
+def rollback(index_dir, version=None):
+    """publish `version`, or the version before the current one"""
+    versions = list_versions(index_dir)
+    if version is None:
+        current = current_version(index_dir)
+        assert current in versions, "No published version in {}".format(
+            index_dir)
+        pos = versions.index(current)
+        assert pos > 0, "No version older than {} to rollback to".format(
+            current)
+        version = versions[pos - 1]
+    assert version in versions, "Version {} not found in {}".format(version,
+                                                                    index_dir)
+    _write_current(index_dir, version)
+    logger.info("Rollback index in {} to version {}".format(index_dir,
+                                                           version))
+    return version
+
+
+def mmap_io_flags():
+    # IO_FLAG_MMAP maps inverted lists, IO_FLAG_MMAP_IFC(faiss>=1.8) maps the
+    # codes of flat indexes, so the pages are shared through the page cache
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+def warmup_index(searcher, num_queries=0):
+    """
+    fault in the pages of a memory-mapped index by searching the IVF
+    centroids(every inverted list is visited once) or random queries.
+    The centroids are searched by the IVF index itself, as they are in the
+    space after the pre-transform(e.g. OPQ) of the outer index
+    """
+    if num_queries <= 0 or searcher.ntotal == 0:
+        return
+    if isinstance(searcher, faiss.IndexBinary):
+        queries = np.random.randint(
+            0, 256, size=(num_queries, searcher.code_size), dtype=np.uint8)
+        searcher.search(queries, 1)
+        return
+    try:
+        ivf = faiss.extract_index_ivf(searcher)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None:
+        num = min(num_queries, ivf.nlist)
+        queries = ivf.quantizer.reconstruct_n(0, num)
+        nprobe = ivf.nprobe
+        ivf.nprobe = 1
+        ivf.search(queries, 1)
+        ivf.nprobe = nprobe
+    else:
+        queries = np.random.rand(num_queries, searcher.d).astype(np.float32)
+        searcher.search(queries, 1)
+
+
+def set_search_params(searcher, nprobe=None, ef_search=None):
+    """
+    set the search-time parameters, e.g. the ones tuned by
+    tools/tune_index.py. Parameters which do not apply to the index type
+    are skipped with a warning.
+    """
+    if isinstance(searcher, RerankIndex):
+        searcher = searcher.index
+    if isinstance(searcher, ShardedIndex):
+        indexes = searcher.shards
+    else:
+        indexes = [searcher]
+    params = {"nprobe": nprobe, "efSearch": ef_search}
+    for index in indexes:
+        if isinstance(index, faiss.IndexBinary):
+            # ParameterSpace only handles float indexes
+            index = faiss.downcast_IndexBinary(index)
+            if nprobe and hasattr(index, "nprobe"):
+                index.nprobe = nprobe
+            continue
+        for name, value in params.items():
+            if not value:
+                continue
+            try:
+                faiss.ParameterSpace().set_index_parameter(index, name,
+                                                           value)
+            except RuntimeError:
+                logger.warning("Search parameter {} does not apply to the "
+                               "index, skipped".format(name))
+
+
+def load_index(index_path,
+               dist_type=None,
+               use_mmap=False,
+               warmup=0,
+               rerank_k=None,
+               nprobe=None,
+               ef_search=None):
+    """
+    load faiss searcher and doc_store from a (resolved) index directory
+
+    Args:
+        use_mmap: open the index with faiss mmap flags, so worker processes on
+            one host share the pages of the index instead of each holding a
+            private copy.
+        warmup: number of warm-up queries to fault in the hot pages.
+        rerank_k: number of candidates to re-rank with the exact vectors, if
+            the index keeps them. None to use the value set when building.
+        nprobe, ef_search: search-time parameters of IVF and HNSW indexes,
+            None to keep the values stored in the index.
+    """
+    start = time.time()
+    flags = mmap_io_flags() if use_mmap else 0
+    if is_sharded(index_path):
+        searcher = ShardedIndex.load(index_path, flags)
+        for shard in searcher.shards:
+            warmup_index(shard, warmup)
+    elif dist_type == "hamming":
+        searcher = faiss.read_index_binary(
+            os.path.join(index_path, "vector.index"), flags)
+        warmup_index(searcher, warmup)
+    else:
+        searcher = faiss.read_index(
+            os.path.join(index_path, "vector.index"), flags)
+        warmup_index(searcher, warmup)
+    set_search_params(searcher, nprobe, ef_search)
+    if os.path.exists(os.path.join(index_path, RERANK_FILE)):
+        searcher = RerankIndex.load(searcher, index_path, rerank_k)
+        if searcher.rerank_k <= 0:
+            searcher = searcher.index
+    id_map = load_doc_store(index_path)
+    msg = "Load index {} in {:.2f}s(mmap: {}, warmup: {})".format(
+        index_path, time.time() - start, use_mmap, warmup)
+    if resource is not None:
+        # ru_maxrss is in KB on Linux
+        msg += ", max rss: {:.1f}MB".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    logger.info(msg)
+    return searcher, id_map
+
+
+class VersionedIndex(object):
+    """
+    Hold a snapshot of the published index and hot-swap it when a new version
+    is published. Callers should take one snapshot per query with `get()`,
+    so in-flight queries keep using the snapshot they started with.
+
+    Args:
+        index_dir: the versioned or legacy index directory.
+        loader: callable(index_path) -> (searcher, id_map).
+        reload_interval: seconds between checks of the CURRENT file, a value
+            <= 0 disables reloading.
+    """
+
+    def __init__(self, index_dir, loader, reload_interval=1.0):
+        self.index_dir = index_dir
+        self.loader = loader
+        self.reload_interval = reload_interval
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._reloading = False
+        self._last_check = time.time()
+        version = current_version(index_dir)
+        searcher, id_map = loader(resolve_index_dir(index_dir))
+        self._snapshot = IndexSnapshot(version, searcher, id_map)
+
+    def add_listener(self, callback):
+        """callback(snapshot) is called after a new version is swapped in"""
+        self.listeners.append(callback)
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def get(self):
+        if self.reload_interval > 0:
+            now = time.time()
+            if now - self._last_check >= self.reload_interval:
+                self._last_check = now
+                self._maybe_reload()
+        return self._snapshot
+
+    def _maybe_reload(self):
+        version = current_version(self.index_dir)
+        if version is None or version == self._snapshot.version:
+            return
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(
+            target=self._reload, args=(version, ), daemon=True).start()
+
+    def _reload(self, version):
+        try:
+            searcher, id_map = self.loader(
+                os.path.join(self.index_dir, VERSIONS_DIR, version))
+            # the reference swap is atomic, queries holding the old snapshot
+            # finish with it
+            self._snapshot = IndexSnapshot(version, searcher, id_map)
+            logger.info("Index in {} is reloaded to version {}".format(
+                self.index_dir, version))
+            for callback in self.listeners:
+                callback(self._snapshot)
+        except Exception as e:
+            logger.warning("Failed to reload index version {}: {}".format(
+                version, e))
+        finally:
+            self._reloading = False
@@ -0,0 +1,242 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-operator timing of the preprocessing of the predictors, enabled by
+Global.op_profile of the deploy config and saved to Global.op_profile_dir.
+
+Every operator built by create_operators is wrapped to record its number of
+calls, total, min and max wall time, a histogram of the wall time(for the
+p50 and p99) and its input and output shapes. Every process flushes its
+stats to a file of the profile directory, and `summary` merges the files of
+all processes and saves the report as `<profile_dir>.json`.
+"""
+
+import json
+import math
+import os
+import shutil
+import time
+from collections import Counter
+
+# log-spaced histogram of the wall time from 1us to 100s
+HIST_MIN_EXP = -6
+HIST_BINS_PER_DECADE = 20
+HIST_NUM_BINS = 8 * HIST_BINS_PER_DECADE
+# max number of distinct input and output shapes recorded by an operator
+MAX_SHAPES = 8
+# min interval in seconds of flushing the stats of a process
+FLUSH_INTERVAL = 1.0
+
+_state = {
+    "dir": None,
+    "pid": None,
+    "stats": {},
+    "last_flush": 0.0,
+    "num_pipelines": 0
+}
+
+
+def enable(profile_dir):
+    """record the operators created from now on, to files of profile_dir"""
+    if os.path.exists(profile_dir):
+        shutil.rmtree(profile_dir)
+    os.makedirs(profile_dir)
+    _state["pid"] = None
+    _state["stats"] = {}
+    _state["dir"] = profile_dir
+
+
+def enabled():
+    return _state["dir"] is not None
+
+
+def wrap_ops(ops):
+    """wrap the operators of a pipeline to be profiled if enabled"""
+    if not enabled() or ops is None:
+        return ops
+    pipeline = _state["num_pipelines"]
+    _state["num_pipelines"] += 1
+    return [
+        ProfiledOp(op, "{}/{}.{}".format(pipeline, idx, type(op).__name__))
+        for idx, op in enumerate(ops)
+    ]
+
+
+class ProfiledOp(object):
+    def __init__(self, op, key):
+        self.op = op
+        self.key = key
+
+    def __call__(self, *args, **kwargs):
+        tic = time.perf_counter()
+        out = self.op(*args, **kwargs)
+        cost = time.perf_counter() - tic
+        record(self.key, cost, args[0] if len(args) == 1 else args, out)
+        return out
+
+    def __getattr__(self, name):
+        if name == "op":
+            raise AttributeError(name)
+        return getattr(self.op, name)
+
+
+def _shape(x):
+    if hasattr(x, "shape"):
+        return str(list(x.shape))
+    if hasattr(x, "size") and hasattr(x, "mode"):
+        # PIL Image
+        return "PIL{}".format(list(x.size))
+    if isinstance(x, (list, tuple)):
+        return "({})".format(", ".join(_shape(v) for v in x))
+    if isinstance(x, dict):
+        return "{{{}}}".format(", ".join(
+            "{}: {}".format(k, _shape(v)) for k, v in x.items()))
+    return type(x).__name__
+
+
+def _new_stats():
+    return {
+        "calls": 0,
+        "total": 0.0,
+        "min": float("inf"),
+        "max": 0.0,
+        "hist": [0] * HIST_NUM_BINS,
+        "shapes": {}
+    }
+
+
+def record(key, cost, data_in, data_out):
+    if _state["pid"] != os.getpid():
+        # a new process does not count the stats of its parent
+        _state["pid"] = os.getpid()
+        _state["stats"] = {}
+    stats = _state["stats"].setdefault(key, _new_stats())
+    stats["calls"] += 1
+    stats["total"] += cost
+    stats["min"] = min(stats["min"], cost)
+    stats["max"] = max(stats["max"], cost)
+    idx = int((math.log10(max(cost, 1e-9)) - HIST_MIN_EXP) *
+              HIST_BINS_PER_DECADE)
+    stats["hist"][min(max(idx, 0), HIST_NUM_BINS - 1)] += 1
+    shapes = "{} -> {}".format(_shape(data_in), _shape(data_out))
+    if shapes in stats["shapes"] or len(stats["shapes"]) < MAX_SHAPES:
+        stats["shapes"][shapes] = stats["shapes"].get(shapes, 0) + 1
+    if time.time() - _state["last_flush"] > FLUSH_INTERVAL:
+        flush()
+
+
+def _process_name():
+    return "pid{}".format(os.getpid())
+
+
+def flush():
+    """write the stats of this process to the profile directory"""
+    _state["last_flush"] = time.time()
+    if not enabled() or _state["pid"] != os.getpid():
+        return
+    path = os.path.join(_state["dir"], _process_name() + ".json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(_state["stats"], f)
+    os.replace(path + ".tmp", path)
+
+
+def _percentile(hist, q):
+    target = q * sum(hist)
+    count = 0
+    for idx, num in enumerate(hist):
+        count += num
+        if num > 0 and count >= target:
+            return 10**(HIST_MIN_EXP + (idx + 0.5) / HIST_BINS_PER_DECADE)
+    return 0.0
+
+
+def _report(stats):
+    return {
+        "calls": stats["calls"],
+        "total": stats["total"],
+        "mean": stats["total"] / max(stats["calls"], 1),
+        "min": stats["min"],
+        "max": stats["max"],
+        "p50": _percentile(stats["hist"], 0.5),
+        "p99": _percentile(stats["hist"], 0.99),
+        "shapes": stats["shapes"]
+    }
+
+
+def collect():
+    """
+    Returns:
+        dict: the stats of every operator merged over all processes in
+            "total", and the stats of every process in "processes".
+    """
+    flush()
+    processes = {}
+    for name in sorted(os.listdir(_state["dir"])):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(_state["dir"], name)) as f:
+                processes[name[:-len(".json")]] = json.load(f)
+        except (OSError, ValueError):
+            # being written
+            continue
+    total = {}
+    for stats_dict in processes.values():
+        for key, stats in stats_dict.items():
+            merged = total.setdefault(key, _new_stats())
+            merged["calls"] += stats["calls"]
+            merged["total"] += stats["total"]
+            merged["min"] = min(merged["min"], stats["min"])
+            merged["max"] = max(merged["max"], stats["max"])
+            merged["hist"] = [
+                x + y for x, y in zip(merged["hist"], stats["hist"])
+            ]
+            merged["shapes"] = dict(
+                Counter(merged["shapes"]) + Counter(stats["shapes"]))
+    return {
+        "total": {key: _report(stats)
+                  for key, stats in total.items()},
+        "processes": {
+            name: {key: _report(stats)
+                   for key, stats in stats_dict.items()}
+            for name, stats_dict in processes.items()
+        }
+    }
+
+
+def summary():
+    """
+    Merge the stats of all processes, save them as json next to the profile
+    directory(`<profile_dir>.json`), and return the lines of the operators
+    by total time.
+    """
+    if not enabled():
+        return []
+    report = collect()
+    with open(_state["dir"].rstrip(os.sep) + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    total = report["total"]
+    all_time = sum(stats["total"] for stats in total.values())
+    lines = []
+    for key in sorted(total, key=lambda k: -total[k]["total"]):
+        stats = total[key]
+        lines.append(
+            "[OpProfile] {}: calls: {}, total: {:.3f}s({:.1%}), mean: "
+            "{:.3f}ms, p50: {:.3f}ms, p99: {:.3f}ms, shapes: {}".format(
+                key, stats["calls"], stats["total"], stats["total"] / max(
+                    all_time, 1e-12), stats["mean"] * 1e3, stats["p50"] * 1e3,
+                stats["p99"] * 1e3,
+                max(stats["shapes"], key=stats["shapes"].get)
+                if stats["shapes"] else ""))
+    return lines
@@ -23,6 +23,8 @@ import paddle
 from paddle.inference import Config
 from paddle.inference import create_predictor
 
+from paddleclas.deploy.utils import op_profile
+
 
 class Predictor(object):
     def __init__(self, args, inference_model_dir=None):
@@ -30,6 +32,9 @@ class Predictor(object):
         if args.use_fp16 is True:
             assert args.use_tensorrt is True
         self.args = args
+        # per-operator timing of the preprocessing(optional)
+        if args.get("op_profile", False) and not op_profile.enabled():
+            op_profile.enable(args.get("op_profile_dir", "./op_profile"))
         if self.args.get("use_onnx", False):
             self.predictor, self.config = self.create_onnx_predictor(
                 args, inference_model_dir)
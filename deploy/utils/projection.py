@@ -0,0 +1,123 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+PCA(-whitening) projection of retrieval features to a lower dimension. It is
+fitted from the gallery features by tools/fit_projection.py, saved as
+`projection.npz` next to the index, and applied to gallery features when
+building the index and to query features by RecPredictor.
+"""
+
+import os
+
+import numpy as np
+
+PROJECTION_FILE = "projection.npz"
+
+
+class Projection(object):
+    """
+    y = (x - mean) @ matrix, L2-normalized again if `normalize`.
+
+    Args:
+        mean: [input_dim] mean of the fitted features.
+        matrix: [input_dim, output_dim] principal axes, divided by the square
+            root of their variance for whitening.
+        normalize: whether to L2-normalize the projected features.
+    """
+
+    def __init__(self, mean, matrix, normalize=True):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.normalize = bool(normalize)
+
+    @property
+    def input_dim(self):
+        return self.matrix.shape[0]
+
+    @property
+    def output_dim(self):
+        return self.matrix.shape[1]
+
+    @classmethod
+    def fit(cls, features, dim, whiten=False, normalize=True, eps=1e-6):
+        """
+        fit the projection to the top `dim` principal axes of `features`,
+        return the projection and the explained variance ratio.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        assert 0 < dim <= features.shape[1], \
+            "dim must be in (0, {}]".format(features.shape[1])
+        mean = features.mean(axis=0)
+        centered = features - mean
+        cov = centered.T @ centered / max(len(features) - 1, 1)
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        order = np.argsort(eigvals)[::-1][:dim]
+        eigvals = np.maximum(eigvals[order], 0)
+        matrix = eigvecs[:, order]
+        if whiten:
+            matrix = matrix / np.sqrt(eigvals + eps)
+        explained = float(eigvals.sum() / max(np.trace(cov), eps))
+        return cls(mean, matrix, normalize), explained
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["mean"], data["matrix"], data["normalize"])
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            mean=self.mean,
+            matrix=self.matrix,
+            normalize=self.normalize)
+        os.replace(tmp_path, path)
+
+    def __call__(self, features, chunk_size=65536, out=None):
+        """project [N, input_dim] features chunk by chunk, e.g. a memmap"""
+        assert features.shape[1] == self.input_dim, \
+            "The projection expects {}-d features, but got {}-d".format(
+                self.input_dim, features.shape[1])
+        if out is None:
+            out = np.empty(
+                [features.shape[0], self.output_dim], dtype=np.float32)
+        for start in range(0, features.shape[0], chunk_size):
+            chunk = np.asarray(
+                features[start:start + chunk_size], dtype=np.float32)
+            chunk = (chunk - self.mean) @ self.matrix
+            if self.normalize:
+                chunk /= np.maximum(
+                    np.linalg.norm(
+                        chunk, axis=1, keepdims=True), 1e-12)
+            out[start:start + chunk_size] = chunk
+        return out
+
+
+def get_projection_path(config):
+    """projection_file of IndexProcess, or projection.npz in index_dir"""
+    path = config.get("projection_file", None)
+    if path is None:
+        path = os.path.join(config["index_dir"], PROJECTION_FILE)
+    return path
+
+
+def load_projection(config):
+    """the projection of IndexProcess if use_projection is set, or None"""
+    if not config or not config.get("use_projection", False):
+        return None
+    path = get_projection_path(config)
+    assert os.path.exists(path), \
+        "The projection {} does not exist, fit it by tools/fit_projection.py".format(
+            path)
+    return Projection.load(path)
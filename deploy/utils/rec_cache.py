@@ -0,0 +1,136 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+LRU cache of recognition results keyed by a perceptual hash(dHash) of the
+crop or the whole frame, for streams in which most frames are near
+duplicates. Entries within `hamming_tolerance` bits of a query hash are hits.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def dhash(image, hash_size=8):
+    """difference hash, one bit per horizontally adjacent pixel pair"""
+    if image.ndim == 3:
+        image = np.ascontiguousarray(image).mean(axis=2, dtype=np.float32)
+    small = cv2.resize(
+        image.astype(np.float32), (hash_size + 1, hash_size),
+        interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _popcount(x):
+    """number of set bits of every element of an uint64 array"""
+    return np.unpackbits(
+        x.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class RecognitionCache(object):
+    """
+    Args:
+        capacity: max number of cached entries.
+        hamming_tolerance: max number of different hash bits of a hit, 0 for
+            exact hash matches only.
+        level: "crop" caches the feature and search result of every crop,
+            "frame" caches the output of the whole frame.
+        hash_size: the hash has hash_size * hash_size bits, at most 8.
+    """
+
+    def __init__(self,
+                 capacity=1024,
+                 hamming_tolerance=4,
+                 level="crop",
+                 hash_size=8):
+        assert level in ["crop", "frame"], "level must be crop or frame"
+        assert 0 < hash_size <= 8, "hash_size must be in (0, 8]"
+        self.capacity = capacity
+        self.hamming_tolerance = hamming_tolerance
+        self.level = level
+        self.hash_size = hash_size
+        # hash -> (version, value, cost)
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_time = 0.0
+
+    def _find(self, key):
+        if key in self.entries:
+            return key
+        if self.hamming_tolerance <= 0 or not self.entries:
+            return None
+        keys = np.fromiter(self.entries.keys(), dtype=np.uint64)
+        dist = _popcount(np.bitwise_xor(keys, np.uint64(key)))
+        nearest = int(np.argmin(dist))
+        if dist[nearest] > self.hamming_tolerance:
+            return None
+        return int(keys[nearest])
+
+    def get(self, key, version=None):
+        """return the cached value of `key`, or None"""
+        with self._lock:
+            found = self._find(key)
+            if found is None or self.entries[found][0] != version:
+                return None
+            self.entries.move_to_end(found)
+            return self.entries[found]
+
+    def put(self, key, value, version=None, cost=0.0):
+        with self._lock:
+            self.entries[key] = (version, value, cost)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def lookup(self, image, version, compute):
+        """
+        return the cached value of the image, or compute, cache and return
+        it on a miss. `version` is the gallery version the value belongs to.
+        """
+        start = time.time()
+        key = dhash(image, self.hash_size)
+        entry = self.get(key, version)
+        if entry is not None:
+            self.hits += 1
+            self.saved_time += max(entry[2] - (time.time() - start), 0.0)
+            return entry[1]
+        self.misses += 1
+        start = time.time()
+        value = compute()
+        self.put(key, value, version, time.time() - start)
+        return value
+
+    def invalidate(self, *args):
+        """drop all entries, e.g. as the listener of a new gallery version"""
+        with self._lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "saved_ms": self.saved_time * 1000,
+            "invalidations": self.invalidations,
+            "size": len(self.entries)
+        }
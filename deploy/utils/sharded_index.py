@@ -0,0 +1,195 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sharded faiss index for galleries which do not fit one process. The layout
+in an index directory is:
+
+index_dir/
+|-- shards.json        # shard manifest: num_shards, metric, index_method, shard paths
+|-- shard_000
+|   |-- vector.index   # IndexIDMap2 holding the vectors whose id % num_shards == 0
+|-- shard_001
+|-- ……
+|-- doc_store          # one doc_store for all shards, keyed by the global ids
+
+Every shard stores the global ids, so the merged top-k maps directly into
+the doc_store.
+"""
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+SHARD_MANIFEST = "shards.json"
+
+
+def is_sharded(index_dir):
+    return os.path.exists(os.path.join(index_dir, SHARD_MANIFEST))
+
+
+def shard_of(ids, num_shards):
+    return np.asarray(ids, dtype=np.int64) % num_shards
+
+
+def _metric_type(metric):
+    return faiss.METRIC_INNER_PRODUCT if metric == "IP" else faiss.METRIC_L2
+
+
+def _build_shard(args):
+    """build one shard in a worker process, features are read from a memmap"""
+    (shard_path, feature_path, feature_shape, feature_dtype, rows, ids,
+     embedding_size, index_method, metric) = args
+    features = np.memmap(
+        feature_path, dtype=feature_dtype, mode="r", shape=feature_shape)
+    features = np.ascontiguousarray(features[rows], dtype=np.float32)
+    index = faiss.IndexIDMap2(
+        faiss.index_factory(embedding_size, index_method,
+                            _metric_type(metric)))
+    index.train(features)
+    index.add_with_ids(features, ids)
+    os.makedirs(shard_path, exist_ok=True)
+    faiss.write_index(index, os.path.join(shard_path, "vector.index"))
+    return index.ntotal
+
+
+def write_manifest(index_dir, num_shards, metric, index_method):
+    manifest = {
+        "num_shards": num_shards,
+        "metric": metric,
+        "index_method": index_method,
+        "shards": ["shard_{:03d}".format(i) for i in range(num_shards)]
+    }
+    with open(os.path.join(index_dir, SHARD_MANIFEST), "w") as fd:
+        json.dump(manifest, fd, indent=2)
+    return manifest
+
+
+def build_shards(index_dir,
+                 features,
+                 rows,
+                 ids,
+                 num_shards,
+                 embedding_size,
+                 index_method,
+                 metric="IP",
+                 num_workers=None):
+    """
+    build `num_shards` sub-indexes in parallel, one shard per worker process.
+
+    Args:
+        features: np.memmap of gallery features, workers open the same file
+            instead of receiving the features through pickling.
+        rows: row of every vector to add in `features`.
+        ids: global id of every vector, vectors go to shard id % num_shards.
+    """
+    assert isinstance(features, np.memmap), "features must be a np.memmap"
+    rows = np.asarray(rows, dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.int64)
+    manifest = write_manifest(index_dir, num_shards, metric, index_method)
+    shard_ids = shard_of(ids, num_shards)
+    tasks = []
+    for i, shard in enumerate(manifest["shards"]):
+        mask = shard_ids == i
+        tasks.append((os.path.join(index_dir, shard), features.filename,
+                      features.shape, features.dtype.name, rows[mask],
+                      ids[mask], embedding_size, index_method, metric))
+    num_workers = min(num_workers or num_shards, num_shards)
+    # spawn, as the parent may hold an initialized inference predictor
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        return pool.map(_build_shard, tasks)
+
+
+class ShardedIndex(object):
+    """
+    A group of faiss sub-indexes searched as one index. Queries are fanned
+    out to all shards on a thread pool(faiss releases the GIL while
+    searching) and the per-shard top-k are merged.
+    """
+
+    def __init__(self, shards, metric="IP", index_method=None,
+                 num_threads=None):
+        self.shards = shards
+        self.metric = metric
+        self.index_method = index_method
+        self.num_shards = len(shards)
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_threads or self.num_shards)
+
+    @classmethod
+    def load(cls, index_dir, io_flags=0, num_threads=None):
+        with open(os.path.join(index_dir, SHARD_MANIFEST), "r") as fd:
+            manifest = json.load(fd)
+        shards = [
+            faiss.read_index(
+                os.path.join(index_dir, shard, "vector.index"), io_flags)
+            for shard in manifest["shards"]
+        ]
+        return cls(shards, manifest["metric"], manifest["index_method"],
+                   num_threads)
+
+    def write(self, index_dir):
+        manifest = write_manifest(index_dir, self.num_shards, self.metric,
+                                  self.index_method)
+        for shard, index in zip(manifest["shards"], self.shards):
+            os.makedirs(os.path.join(index_dir, shard), exist_ok=True)
+            faiss.write_index(index,
+                              os.path.join(index_dir, shard, "vector.index"))
+
+    @property
+    def ntotal(self):
+        return sum(index.ntotal for index in self.shards)
+
+    @property
+    def d(self):
+        return self.shards[0].d
+
+    def add_with_ids(self, features, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        shard_ids = shard_of(ids, self.num_shards)
+        for i, index in enumerate(self.shards):
+            mask = shard_ids == i
+            if mask.any():
+                index.add_with_ids(
+                    np.ascontiguousarray(features[mask]), ids[mask])
+
+    def remove_ids(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        shard_ids = shard_of(ids, self.num_shards)
+        removed = 0
+        for i, index in enumerate(self.shards):
+            mask = shard_ids == i
+            if mask.any():
+                removed += index.remove_ids(ids[mask])
+        return removed
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        results = list(
+            self.executor.map(lambda index: index.search(queries, k),
+                              self.shards))
+        scores = np.concatenate([r[0] for r in results], axis=1)
+        ids = np.concatenate([r[1] for r in results], axis=1)
+        # the -1 paddings of shards with less than k results rank last
+        if self.metric == "IP":
+            scores = np.where(ids < 0, -np.inf, scores)
+            order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        else:
+            scores = np.where(ids < 0, np.inf, scores)
+            order = np.argsort(scores, axis=1, kind="stable")[:, :k]
+        return (np.take_along_axis(scores, order, axis=1),
+                np.take_along_axis(ids, order, axis=1))
@@ -0,0 +1,145 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Batched test-time augmentation of ClsPredictor, configured by PreProcess.tta:
+
+    PreProcess:
+      transform_ops:
+        ...
+      tta:
+        flip: True
+        crop_size: 224
+        num_crops: 5
+        scales: [1.0]
+        fusion: mean
+
+The views(scales x crops x flip) of the preprocessed batch are concatenated
+into one larger batch per input shape and run by the predictor at once, then
+the outputs of the views of every image are fused. Views of another shape
+than the exported input shape need a model exported with dynamic shape.
+"""
+
+import cv2
+import numpy as np
+
+FUSIONS = ["mean", "max", "softmax_mean"]
+
+
+class TTA(object):
+    """
+    Args:
+        flip (bool): add the horizontal flip of every view.
+        crop_size (int|list): [h, w] of the crops of every scale, None to
+            use the whole image.
+        num_crops (int): 1 for the center crop, 5 for the center and the four
+            corner crops.
+        scales (list): scale factors of the images, resized by bilinear
+            interpolation.
+        fusion (str): "mean" or "max" of the outputs of the views, or
+            "softmax_mean", the log of the mean probability, which keeps
+            the softmax of the output the mean probability.
+    """
+
+    def __init__(self,
+                 flip=False,
+                 crop_size=None,
+                 num_crops=1,
+                 scales=None,
+                 fusion="mean"):
+        assert num_crops in [1, 5], "num_crops only supports 1 or 5"
+        assert fusion in FUSIONS, "fusion only supports {}".format(FUSIONS)
+        if isinstance(crop_size, int):
+            crop_size = [crop_size, crop_size]
+        self.flip = flip
+        self.crop_size = crop_size
+        self.num_crops = num_crops if crop_size is not None else 1
+        self.scales = scales or [1.0]
+        self.fusion = fusion
+
+    @property
+    def num_views(self):
+        return len(self.scales) * self.num_crops * (2 if self.flip else 1)
+
+    @staticmethod
+    def _resize(images, scale):
+        h, w = images.shape[2:]
+        size = (int(round(w * scale)), int(round(h * scale)))
+        # cv2 resizes HWC images
+        return np.stack([
+            cv2.resize(
+                img.transpose([1, 2, 0]), size,
+                interpolation=cv2.INTER_LINEAR).reshape(
+                    [size[1], size[0], -1]).transpose([2, 0, 1])
+            for img in images
+        ])
+
+    def _crops(self, images):
+        if self.crop_size is None:
+            return [images]
+        h, w = images.shape[2:]
+        ch, cw = self.crop_size
+        assert h >= ch and w >= cw, \
+            "TTA crop_size {} is larger than the image {}".format(
+                self.crop_size, [h, w])
+        boxes = [((h - ch) // 2, (w - cw) // 2)]
+        if self.num_crops == 5:
+            boxes += [(0, 0), (0, w - cw), (h - ch, 0), (h - ch, w - cw)]
+        return [images[:, :, t:t + ch, l:l + cw] for t, l in boxes]
+
+    def expand(self, images):
+        """[V * N, C, h, w] batches of the V views of every shape of the
+        [N, C, H, W] images"""
+        buckets = {}
+        for scale in self.scales:
+            scaled = images if scale == 1.0 else self._resize(images, scale)
+            for view in self._crops(scaled):
+                buckets.setdefault(view.shape[2:], []).append(view)
+                if self.flip:
+                    buckets[view.shape[2:]].append(view[:, :, :, ::-1])
+        return [
+            np.ascontiguousarray(np.concatenate(views))
+            for views in buckets.values()
+        ]
+
+    def fuse(self, outputs, batch_size):
+        """fuse the concatenated outputs of all views"""
+        outputs = outputs.reshape([-1, batch_size] + list(outputs.shape[1:]))
+        if self.fusion == "max":
+            return outputs.max(axis=0)
+        if self.fusion == "softmax_mean":
+            outputs = np.exp(outputs - outputs.max(axis=-1, keepdims=True))
+            outputs /= outputs.sum(axis=-1, keepdims=True)
+            return np.log(outputs.mean(axis=0))
+        return outputs.mean(axis=0)
+
+    def __call__(self, images, forward_fn):
+        """fused outputs of forward_fn, run on the views of the images"""
+        outputs = [forward_fn(views) for views in self.expand(images)]
+        return self.fuse(np.concatenate(outputs), len(images))
+
+    def __repr__(self):
+        return ("TTA(views={}, flip={}, crop_size={}, num_crops={}, "
+                "scales={}, fusion={})".format(
+                    self.num_views, self.flip, self.crop_size,
+                    self.num_crops, self.scales, self.fusion))
+
+
+def build_tta(config):
+    """TTA of the config, None if the config is None or keeps the images"""
+    if config is None:
+        return None
+    tta = TTA(**config)
+    if tta.num_views == 1 and tta.crop_size is None and tta.scales == [1.0]:
+        return None
+    return tta
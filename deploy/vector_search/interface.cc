@@ -257,6 +257,28 @@ void search_l2_index(float* dense_vec,int dim,int search_budget,int return_k, In
 }
 
 
+// search `num` queries of a mobius or l2 index. The visited list is owned by
+// this call, so calls on the same index can run in parallel threads
+void search_index_batch(float* dense_mat,int num,int dim,int search_budget,int return_k, IndexContext* index_context,idx_t* ret_id,double* ret_score){
+    Data* data = reinterpret_cast<Data*>(index_context->data);
+    GraphWrapper* graph = reinterpret_cast<GraphWrapper*>(index_context->graph);
+    VisitedList visited(data->max_vertices() + 5);
+
+    std::vector<std::pair<int,value_t>> point(dim);
+    std::vector<idx_t> topN;
+    std::vector<double> score;
+    for(int q = 0;q < num;++q){
+        for(int j = 0;j < dim;++j)
+            point[j] = std::make_pair(j,dense_mat[(size_t)q * dim + j]);
+        graph->search_top_k_with_score(point,search_budget,topN,score,&visited);
+        for(int i = 0;i < topN.size() && i < return_k;++i){
+            ret_id[(size_t)q * return_k + i] = topN[i];
+            ret_score[(size_t)q * return_k + i] = score[i];
+        }
+    }
+}
+
+
 void release_context(IndexContext* index_context){
     delete (Data*)(index_context->data);
     delete (GraphWrapper*)(index_context->graph);
@@ -20,6 +20,7 @@ import os
 import sys
 import json
 import platform
+from concurrent.futures import ThreadPoolExecutor
 
 from ctypes import *
 from numpy.ctypeslib import ndpointer
@@ -108,6 +109,23 @@ save_l2_index_prefix = lib.save_l2_index_prefix
 save_l2_index_prefix.restype = None
 save_l2_index_prefix.argtypes = [POINTER(IndexContext), ctypes.c_char_p]
 
+# for batch search of both IP and L2 index
+try:
+    search_index_batch = lib.search_index_batch
+    search_index_batch.restype = None
+    search_index_batch.argtypes = [
+        ctl.ndpointer(
+            np.float32, flags='aligned, c_contiguous'), ctypes.c_int,
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, POINTER(IndexContext),
+        ctl.ndpointer(
+            np.uint64, flags='aligned, c_contiguous'), ctl.ndpointer(
+                np.float64, flags='aligned, c_contiguous')
+    ]
+except AttributeError:
+    # the library is built before search_index_batch is added, rebuild it
+    # following README.md to search batches in parallel
+    search_index_batch = None
+
 release_context = lib.release_context
 release_context.restype = None
 release_context.argtypes = [POINTER(IndexContext)]
@@ -125,7 +143,11 @@ class Graph_Index(object):
         self.mobius_pow = 2.0
         self.index_context = IndexContext(0, 0)
         self.gallery_doc_dict = {}
+        # docs indexed by the int id, loaded from gallery_doc_dict
+        self.gallery_docs = None
         self.with_attr = False
+        self.executor = None
+        self.num_threads = 0
         assert dist_type in ["IP", "L2"], "Only support IP and L2 distance ..."
 
     def build(self,
@@ -202,9 +224,23 @@ class Graph_Index(object):
             self.gallery_doc_dict = ori_gallery_doc_dict
         with open(output_path, "w") as f:
             json.dump(self.gallery_doc_dict, f)
+        self._load_gallery_docs()
 
         print("finished creating index ...")
 
+    def _load_gallery_docs(self):
+        """
+        convert the string keys of gallery_doc_dict to an array indexed by id
+        """
+        self.gallery_docs = None
+        if self.with_attr:
+            self.gallery_docs = np.array(
+                [
+                    self.gallery_doc_dict[str(i)]
+                    for i in range(self.gallery_doc_dict["total_num"])
+                ],
+                dtype=object)
+
     def search(self, query, return_k=10, search_budget=100):
         """
         search
@@ -223,11 +259,71 @@ class Graph_Index(object):
                             ctypes.byref(self.index_context), ret_id,
                             ret_score)
 
-        ret_id = ret_id.tolist()
-        ret_doc = []
         if self.with_attr:
-            for i in range(return_k):
-                ret_doc.append(self.gallery_doc_dict[str(ret_id[i])])
+            ret_doc = self.gallery_docs[ret_id.astype(np.int64)].tolist()
+            return ret_score, ret_doc
+        else:
+            return ret_score, ret_id.tolist()
+
+    def search_batch(self,
+                     queries,
+                     return_k=10,
+                     search_budget=100,
+                     num_threads=None):
+        """
+        search a batch of queries, the queries are split into `num_threads`
+        chunks searched in parallel threads, as ctypes releases the GIL
+        during the native calls.
+
+        return: scores, [Q, return_k] float64 array; docs, [Q, return_k]
+            object array of docs if the index is built with gallery_docs,
+            else int64 array of ids. Missing results are None docs or -1 ids.
+        """
+        if paddle.is_tensor(queries):
+            queries = queries.numpy()
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis, :]
+        assert queries.ndim == 2 and queries.shape[1] == self.dim, \
+            "Query must be in shape [Q, {}] ...".format(self.dim)
+
+        num = queries.shape[0]
+        ret_id = np.full([num, return_k], -1, dtype=np.int64)
+        ret_score = np.zeros([num, return_k], dtype=np.float64)
+        if search_index_batch is None:
+            # the single query search of old libraries is not reentrant
+            if self.dist_type == "IP":
+                search_func = search_mobius_index
+            else:
+                search_func = search_l2_index
+            for i in range(num):
+                search_func(queries[i], self.dim, search_budget, return_k,
+                            ctypes.byref(self.index_context),
+                            ret_id[i].view(np.uint64), ret_score[i])
+        elif num > 0:
+            num_threads = min(num_threads or os.cpu_count() or 1, num)
+            bounds = np.linspace(0, num, num_threads + 1).astype("int64")
+
+            def search_chunk(i):
+                start, end = bounds[i], bounds[i + 1]
+                search_index_batch(queries[start:end], end - start, self.dim,
+                                   search_budget, return_k,
+                                   ctypes.byref(self.index_context),
+                                   ret_id[start:end].view(np.uint64),
+                                   ret_score[start:end])
+
+            if num_threads == 1:
+                search_chunk(0)
+            else:
+                if self.executor is None or self.num_threads < num_threads:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=num_threads)
+                    self.num_threads = num_threads
+                list(self.executor.map(search_chunk, range(num_threads)))
+
+        if self.with_attr:
+            ret_doc = self.gallery_docs[np.maximum(ret_id, 0)]
+            ret_doc[ret_id < 0] = None
             return ret_score, ret_doc
         else:
             return ret_score, ret_id
@@ -259,6 +355,7 @@ class Graph_Index(object):
         self.dim = self.gallery_doc_dict["dim"]
         self.dist_type = self.gallery_doc_dict["dist_type"]
         self.with_attr = self.gallery_doc_dict["with_attr"]
+        self._load_gallery_docs()
 
         if self.dist_type == "IP":
             load_mobius_index_prefix(
@@ -76,6 +76,8 @@ public:
     virtual void add_vertex_lock(idx_t vertex_id,std::vector<std::pair<int,value_t>>& point) = 0;
     virtual void search_top_k(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result) = 0;
     virtual void search_top_k_with_score(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result,std::vector<double>& score){}
+    //reentrant search, every thread passes its own visited list
+    virtual void search_top_k_with_score(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result,std::vector<double>& score,VisitedList* visited){}
 
     virtual void dump(std::string path = "bfsg.graph") = 0;
     virtual void load(std::string path = "bfsg.graph") = 0;
@@ -456,6 +458,13 @@ public:
     }
     
     void astar_multi_start_search_with_score(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result,std::vector<double>& score){
+        int explore_cnt = astar_multi_start_search_with_score(query,k,result,score,p_visited);
+        total_explore_cnt += explore_cnt;
+        ++total_explore_times;
+    }
+
+    //the member p_visited is shadowed by the visited list of the caller
+    int astar_multi_start_search_with_score(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result,std::vector<double>& score,VisitedList* p_visited){
         std::priority_queue<std::pair<dist_t,idx_t>,std::vector<std::pair<dist_t,idx_t>>,std::greater<std::pair<dist_t,idx_t>>> q;
         const int num_start_point = 1;
 
@@ -499,8 +508,6 @@ public:
 	                q.push(std::make_pair(dist,start));
             }
         }
-        total_explore_cnt += explore_cnt;
-        ++total_explore_times;
         result.resize(topk.size());
         score.resize(topk.size());
         int i = result.size() - 1;
@@ -510,6 +517,7 @@ public:
             topk.pop();
             --i;
         }
+        return explore_cnt;
     }
 
     void astar_multi_start_search(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result){
@@ -577,6 +585,10 @@ public:
     void search_top_k_with_score(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result,std::vector<double>& score){
         astar_multi_start_search_with_score(query,k,result,score);
     }
+
+    void search_top_k_with_score(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result,std::vector<double>& score,VisitedList* visited){
+        astar_multi_start_search_with_score(query,k,result,score,visited);
+    }
     
 	void search_top_k_lock(const std::vector<std::pair<int,value_t>>& query,int k,std::vector<idx_t>& result){
         astar_multi_start_search_lock(query,k,result);
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
 import numpy as np
 from interface import Graph_Index
 
@@ -29,6 +31,17 @@ scores, docs = indexer.search(query=query_vector, return_k=10, search_budget=100
 print(scores)
 print(docs)
 
+# 批量查询, 结果为[Q, return_k]的数组, 并与逐条查询比较吞吐
+query_vectors = np.random.rand(1000,128).astype(np.float32)
+start = time.time()
+for query in query_vectors:
+    indexer.search(query=query, return_k=10, search_budget=100)
+single_qps = len(query_vectors) / (time.time() - start)
+start = time.time()
+scores, docs = indexer.search_batch(queries=query_vectors, return_k=10, search_budget=100)
+batch_qps = len(query_vectors) / (time.time() - start)
+print("search qps: {:.1f}, search_batch qps: {:.1f}".format(single_qps, batch_qps))
+
 # 保存与加载
 indexer.dump(index_path="test") 
 indexer.load(index_path="test") 
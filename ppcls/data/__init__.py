@@ -20,7 +20,7 @@ import numpy as np
 import paddle.distributed as dist
 from functools import partial
 from paddle.io import DistributedBatchSampler, BatchSampler, DataLoader
-from ppcls.utils import logger
+from ppcls.utils import logger, op_profile
 
 from ppcls.data import dataloader
 # dataset
@@ -37,6 +37,7 @@ from ppcls.data.dataloader.face_dataset import FaceEvalDataset, FiveFaceEvalData
 from ppcls.data.dataloader.custom_label_dataset import CustomLabelDataset
 from ppcls.data.dataloader.cifar import Cifar10, Cifar100
 from ppcls.data.dataloader.metabin_sampler import DomainShuffleBatchSampler, NaiveIdentityBatchSampler
+from ppcls.data.dataloader.synthetic_dataset import SyntheticDataset, SyntheticBatchLoader
 
 # sampler
 from ppcls.data.dataloader.DistributedRandomIdentitySampler import DistributedRandomIdentitySampler
@@ -68,7 +69,7 @@ def create_operators(params, class_num=None):
         op = op_func(**param)
         ops.append(op)
 
-    return ops
+    return op_profile.wrap_ops(ops)
 
 
 def worker_init_fn(worker_id: int, num_workers: int, rank: int, seed: int):
@@ -134,6 +135,20 @@ def build_dataloader(config, mode, device, use_dali=False, seed=None):
 
     logger.debug("build batch_sampler({}) success...".format(batch_sampler))
 
+    # batches of synthetic data kept on the device, without DataLoader
+    if config[mode]['loader'].get("synthetic_batches", False):
+        if batch_sampler is not None:
+            # the batches are served in order, only the batch size is taken
+            assert type(batch_sampler) in [
+                DistributedBatchSampler, BatchSampler
+            ], "synthetic_batches only supports the default sampler, " \
+                "DistributedBatchSampler or BatchSampler"
+            batch_size = batch_sampler.batch_size
+            drop_last = batch_sampler.drop_last
+        data_loader = SyntheticBatchLoader(dataset, batch_size, drop_last)
+        logger.debug("build data_loader({}) success...".format(data_loader))
+        return data_loader
+
     # build batch operator
     def mix_collate_fn(batch):
         batch = transform(batch, batch_ops)
@@ -15,13 +15,11 @@
 from __future__ import absolute_import
 from __future__ import division
 
-import copy
-import random
-from collections import defaultdict
-
 import numpy as np
 from paddle.io import DistributedBatchSampler
 
+from ppcls.data.dataloader.identity_plan import build_identity_index, distinct_batches, split_groups
+
 
 class DistributedRandomIdentitySampler(DistributedBatchSampler):
     """Randomly sample N identities, then for each identity,
@@ -49,81 +47,57 @@ class DistributedRandomIdentitySampler(DistributedBatchSampler):
         self.drop_last = drop_last
         self.max_iters = max_iters
         self.num_pids_per_batch = self.batch_size // self.num_instances
-        self.index_dic = defaultdict(list)
-        for index, pid in enumerate(self.dataset.labels):
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
+        # samples of pids[i] are indices[offsets[i]:offsets[i + 1]]
+        self.pids, self.offsets, self.indices = build_identity_index(
+            self.dataset.labels)
         # estimate number of examples in an epoch
-        self.length = 0
-        for pid in self.pids:
-            idxs = self.index_dic[pid]
-            num = len(idxs)
-            if num < self.num_instances:
-                num = self.num_instances
-            self.length += num - num % self.num_instances
+        num = np.maximum(np.diff(self.offsets), self.num_instances)
+        self.length = int(np.sum(num - num % self.num_instances))
 
-    def _prepare_batch(self):
-        batch_idxs_dict = defaultdict(list)
-        count = []
-        for pid in self.pids:
-            idxs = copy.deepcopy(self.index_dic[pid])
-            if len(idxs) < self.num_instances:
-                idxs = np.random.choice(
-                    idxs, size=self.num_instances, replace=True)
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.num_instances:
-                    batch_idxs_dict[pid].append(batch_idxs)
-                    batch_idxs = []
-        count = [len(batch_idxs_dict[pid]) for pid in self.pids]
-        count = np.array(count)
-        avai_pids = copy.deepcopy(self.pids)
-        return batch_idxs_dict, avai_pids, count
+    def _prepare_batch(self, weighted=False):
+        """
+        Split the samples of every identity into groups of num_instances and
+        order the groups into batches of num_pids_per_batch distinct
+        identities. Without `weighted`, each batch takes one group of every
+        identity in a random round-robin, so all identities with groups left
+        are equally likely. With `weighted`, the groups are shuffled as a
+        whole, so identities are picked by their number of groups left.
 
-    def __iter__(self):
-        # prepare
-        batch_idxs_dict, avai_pids, count = self._prepare_batch()
+        Returns:
+            np.ndarray: sample indices of the batches, [num_batches, batch_size].
+        """
+        # the global random state, seeded by Global.seed and rank
+        rng = np.random
+        groups, group_pid, group_rank = split_groups(
+            rng, self.offsets, self.indices, self.num_instances)
+        if weighted:
+            stream = rng.permutation(len(groups))
+        else:
+            # stop at the round with fewer identities than a batch needs
+            num_in_round = np.bincount(group_rank)
+            num_rounds = np.argmax(
+                np.append(num_in_round, 0) < self.num_pids_per_batch)
+            keep = np.nonzero(group_rank < num_rounds)[0]
+            order = np.argsort(
+                group_rank[keep] + rng.random_sample(len(keep)),
+                kind="stable")
+            stream = keep[order]
+        stream = distinct_batches(stream, group_pid, self.num_pids_per_batch)
+        return groups[stream].reshape([-1, self.batch_size])
 
-        # sample
+    def __iter__(self):
         if self.max_iters is not None:
+            batches = self._prepare_batch(weighted=True)
+            cursor = 0
             for _ in range(self.max_iters):
-                final_idxs = []
-                if len(avai_pids) < self.num_pids_per_batch:
-                    batch_idxs_dict, avai_pids, count = self._prepare_batch()
-
-                selected_pids = np.random.choice(avai_pids,
-                                                 self.num_pids_per_batch,
-                                                 False, count / count.sum())
-                for pid in selected_pids:
-                    batch_idxs = batch_idxs_dict[pid].pop(0)
-                    final_idxs.extend(batch_idxs)
-                    pid_idx = avai_pids.index(pid)
-                    if len(batch_idxs_dict[pid]) == 0:
-                        avai_pids.pop(pid_idx)
-                        count = np.delete(count, pid_idx)
-                    else:
-                        count[pid_idx] = len(batch_idxs_dict[pid])
-                yield final_idxs
+                if cursor >= len(batches):
+                    batches = self._prepare_batch(weighted=True)
+                    cursor = 0
+                yield batches[cursor].tolist()
+                cursor += 1
         else:
-            final_idxs = []
-            while len(avai_pids) >= self.num_pids_per_batch:
-                selected_pids = random.sample(avai_pids,
-                                              self.num_pids_per_batch)
-                for pid in selected_pids:
-                    batch_idxs = batch_idxs_dict[pid].pop(0)
-                    final_idxs.extend(batch_idxs)
-                    if len(batch_idxs_dict[pid]) == 0:
-                        avai_pids.remove(pid)
-            _sample_iter = iter(final_idxs)
-            batch_indices = []
-            for idx in _sample_iter:
-                batch_indices.append(idx)
-                if len(batch_indices) == self.batch_size:
-                    yield batch_indices
-                    batch_indices = []
-            if not self.drop_last and len(batch_indices) > 0:
+            batches = self._prepare_batch()
+            for batch_indices in batches.tolist():
                 yield batch_indices
 
     def __len__(self):
@@ -21,7 +21,7 @@ import cv2
 
 from ppcls.data import preprocess
 from ppcls.data.preprocess import transform
-from ppcls.utils import logger
+from ppcls.utils import logger, op_profile
 
 
 def create_operators(params):
@@ -42,7 +42,7 @@ def create_operators(params):
         op = getattr(preprocess, op_name)(**param)
         ops.append(op)
 
-    return ops
+    return op_profile.wrap_ops(ops)
 
 
 class CommonDataset(Dataset):
@@ -19,20 +19,50 @@ from paddle.io import Dataset
 from .common_dataset import create_operators
 from ppcls.data.preprocess import transform as transform_func
 
+def unique_pair_index(pairs):
+    """
+    Map every (left, right) pair of hashable images(paths or bytes) to the
+    indices of its images in the list of unique images.
+
+    Returns:
+        tuple: (unique images in the order of first appearance, [num_pairs, 2]
+            int64 pair index)
+    """
+    image_index = {}
+    pair_index = np.empty([len(pairs), 2], dtype=np.int64)
+    for i, pair in enumerate(pairs):
+        for j, image in enumerate(pair):
+            pair_index[i, j] = image_index.setdefault(image, len(image_index))
+    return list(image_index.keys()), pair_index
+
+
 class FaceEvalDataset(Dataset):
+    """
+    Face verification pairs listed in pair_label_path. With unique_images,
+    the dataset returns every image of the pairs once, as (image, index), so
+    that its embedding is extracted once, and the pairs are given by
+    `pair_index` into the images and `pair_labels`.
+    """
+
     def __init__(self,
                  dataset_root,
                  pair_label_path,
                  transform_ops=None,
-                 delimiter=None):
+                 delimiter=None,
+                 unique_images=True):
         super().__init__()
         self._dataset_root = dataset_root
         self._pair_label_path = pair_label_path
         self.delimiter = delimiter if delimiter is not None else " "
         self._transform_ops = create_operators(transform_ops) if transform_ops \
             is not None else None
+        self.unique_images = unique_images
 
         self._load_anno()
+        if self.unique_images:
+            self.images, self.pair_index = unique_pair_index(self.image_pairs)
+            self.pair_labels = np.array(self.labels, dtype=np.int64)
+            self.pair_remains = []
     
     def _load_anno(self):
         assert os.path.exists(
@@ -59,20 +89,23 @@ class FaceEvalDataset(Dataset):
                 assert label in [0, 1], f"label must be 0 or 1, but got {label}"
                 self.labels.append(label)
 
-    def __getitem__(self, idx):
-        with open(self.image_pairs[idx][0], 'rb') as f:
-            img_left = f.read()
-        with open(self.image_pairs[idx][1], 'rb') as f:
-            img_right = f.read()
+    def _read_image(self, path):
+        with open(path, 'rb') as f:
+            img = f.read()
         if self._transform_ops is not None:
-            img_left = transform_func(img_left, self._transform_ops)
-            img_right = transform_func(img_right, self._transform_ops)
-        
-        img_left = img_left.transpose((2, 0, 1))
-        img_right = img_right.transpose((2, 0, 1))
+            img = transform_func(img, self._transform_ops)
+        return img.transpose((2, 0, 1))
+
+    def __getitem__(self, idx):
+        if self.unique_images:
+            return self._read_image(self.images[idx]), np.int64(idx)
+        img_left = self._read_image(self.image_pairs[idx][0])
+        img_right = self._read_image(self.image_pairs[idx][1])
         return img_left, img_right, self.labels[idx]
 
     def __len__(self):
+        if self.unique_images:
+            return len(self.images)
         return len(self.image_pairs)
 
 
@@ -87,13 +120,17 @@ class FiveFaceEvalDataset(Dataset):
     def __init__(self, 
                  val_data_path, 
                  val_targets=['agedb_30','cfp_fp','lfw'],
-                 transform_ops=None):
+                 transform_ops=None,
+                 unique_images=True):
         '''
         agedb_30: 0
         cfp_fp: 1
         lfw: 2
         cplfw: 3
         calfw: 4
+
+        With unique_images, the dataset returns every distinct image buffer
+        once, as FaceEvalDataset does.
         '''
         if isinstance(val_targets, str):
             val_targets = [val_targets]
@@ -128,7 +165,20 @@ class FiveFaceEvalDataset(Dataset):
         self.all_issame = all_issame
         self.all_dataname_idxs = all_dataname_idxs
 
+        self.unique_images = unique_images
+        if self.unique_images:
+            self.images, self.pair_index = unique_pair_index(all_img_buffs)
+            self.pair_labels = np.array(all_issame, dtype=np.int64)
+            self.pair_remains = [
+                np.array(all_dataname_idxs, dtype=np.int64)
+            ]
+            # the pairs only keep the index of their images
+            self.all_img_buffs = None
+
     def __getitem__(self, index):
+        if self.unique_images:
+            img = transform_func(self.images[index], self._transform_ops)
+            return img.transpose((2, 0, 1)), np.int64(index)
         left_buff, right_buff = self.all_img_buffs[index]
         if self._transform_ops is not None:
             img_left = transform_func(left_buff, self._transform_ops)
@@ -141,4 +191,6 @@ class FiveFaceEvalDataset(Dataset):
         return img_left, img_right, label, dataname_idx
 
     def __len__(self):
+        if self.unique_images:
+            return len(self.images)
         return len(self.all_img_buffs)
\ No newline at end of file
@@ -0,0 +1,212 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Vectorized helpers of the identity samplers(PKSampler and
+DistributedRandomIdentitySampler), which build the batches of a whole epoch
+at once instead of sampling batch by batch in Python.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import heapq
+from collections import Counter
+
+import numpy as np
+
+# max number of random keys drawn at once by the gumbel-top-k sampling
+GUMBEL_BUDGET = 1 << 24
+
+
+def build_identity_index(labels):
+    """Group sample indices by identity in CSR style.
+
+    Args:
+        labels (list|np.ndarray): label of every sample.
+
+    Returns:
+        tuple: (pids, offsets, indices), identities in the order of their
+            first sample, and the indices of the samples of pids[i] in
+            indices[offsets[i]:offsets[i + 1]], in dataset order.
+    """
+    labels = np.asarray(labels)
+    labels = labels.reshape([len(labels)])
+    pids, first, inverse, counts = np.unique(
+        labels, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    indices = np.argsort(rank[inverse.reshape([-1])], kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(counts[order])])
+    return pids[order], offsets.astype(np.int64), indices.astype(np.int64)
+
+
+def weighted_sample(rng, prob, num_rows, k):
+    """Draw k distinct ids for each of num_rows rows, one by one with
+    probability proportional to `prob` among the ids not drawn yet, the
+    same distribution as np.random.choice(replace=False, p=prob).
+
+    Small id sets use gumbel-top-k. For large ones, ids are drawn with
+    replacement from the cdf and repeated ids are rejected, which keeps the
+    cost per row at O(k log(num_ids)).
+    """
+    num_ids = len(prob)
+    assert np.count_nonzero(prob) >= k, \
+        "Fewer ids with non-zero probability than the ids of a row"
+    out = np.empty([num_rows, k], dtype=np.int64)
+    if num_ids * num_rows <= GUMBEL_BUDGET or 4 * k > num_ids:
+        rows = np.arange(num_rows)
+    else:
+        cdf = np.cumsum(prob, dtype=np.float64)
+        cdf /= cdf[-1]
+        draws = np.searchsorted(
+            cdf, rng.random_sample([num_rows, 2 * k]), side="right")
+        draws = np.minimum(draws, num_ids - 1)
+        # drop the repeats of ids drawn before in the same row
+        order = np.argsort(draws, axis=1, kind="stable")
+        sorted_draws = np.take_along_axis(draws, order, axis=1)
+        repeat = np.zeros_like(draws, dtype=bool)
+        np.put_along_axis(
+            repeat,
+            order[:, 1:],
+            sorted_draws[:, 1:] == sorted_draws[:, :-1],
+            axis=1)
+        unique = ~repeat
+        num_unique = unique.sum(axis=1)
+        done = num_unique >= k
+        keep = unique & (np.cumsum(unique, axis=1) <= k) & done[:, None]
+        out[done] = draws[keep].reshape([-1, k])
+        # rows with too many repeats fall back to gumbel-top-k
+        rows = np.nonzero(~done)[0]
+
+    with np.errstate(divide="ignore"):
+        log_prob = np.log(np.maximum(prob, 0).astype(np.float64))
+    chunk = max(GUMBEL_BUDGET // num_ids, 1)
+    for start in range(0, len(rows), chunk):
+        chunk_rows = rows[start:start + chunk]
+        keys = log_prob + rng.gumbel(size=[len(chunk_rows), num_ids])
+        top = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+        # in the order the ids are drawn
+        top_keys = np.take_along_axis(keys, top, axis=1)
+        out[chunk_rows] = np.take_along_axis(
+            top, np.argsort(-top_keys, axis=1), axis=1)
+    return out
+
+
+def sample_instances(rng, offsets, indices, groups, k):
+    """Draw k samples of every identity in `groups`, without replacement
+    for identities with at least k samples, with replacement otherwise.
+
+    Returns:
+        np.ndarray: sample indices with shape of [len(groups), k].
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    starts = offsets[groups]
+    counts = offsets[groups + 1] - starts
+    pos = np.empty([len(groups), k], dtype=np.int64)
+
+    small = counts < k
+    if small.any():
+        pos[small] = (rng.random_sample([small.sum(), k]) *
+                      counts[small, None]).astype(np.int64)
+    # k smallest random keys of all samples for few samples per identity
+    dense = ~small & (counts <= 8 * k)
+    if dense.any():
+        dense_counts = counts[dense]
+        keys = rng.random_sample([len(dense_counts), dense_counts.max()])
+        keys[np.arange(keys.shape[1]) >= dense_counts[:, None]] = 2.0
+        pos[dense] = np.argsort(keys, axis=1)[:, :k]
+    # redraw rows with repeated samples for many samples per identity
+    rows = np.nonzero(~small & ~dense)[0]
+    while len(rows) > 0:
+        draws = (rng.random_sample([len(rows), k]) *
+                 counts[rows, None]).astype(np.int64)
+        pos[rows] = draws
+        sorted_draws = np.sort(draws, axis=1)
+        rows = rows[(sorted_draws[:, 1:] == sorted_draws[:, :-1]).any(axis=1)]
+    return indices[starts[:, None] + pos]
+
+
+def split_groups(rng, offsets, indices, k):
+    """Shuffle the samples of every identity and split them into groups of
+    k samples, dropping the remainder. Identities with fewer than k samples
+    get one group drawn with replacement.
+
+    Returns:
+        tuple: (groups, group_pid, group_rank), the [num_groups, k] sample
+            indices, the identity of every group and its rank among the
+            groups of the identity.
+    """
+    counts = np.diff(offsets)
+    num_pids = len(counts)
+    sample_pid = np.repeat(np.arange(num_pids), counts)
+    order = np.lexsort((rng.random_sample(len(indices)), sample_pid))
+    shuffled = indices[order]
+
+    num_groups = np.where(counts < k, 0, counts // k)
+    pos = np.arange(len(indices)) - offsets[sample_pid]
+    keep = pos < (num_groups * k)[sample_pid]
+    big_groups = shuffled[keep].reshape([-1, k])
+    big_pid = np.repeat(np.arange(num_pids), num_groups)
+    group_start = np.cumsum(num_groups) - num_groups
+    big_rank = np.arange(len(big_pid)) - group_start[big_pid]
+
+    small_pid = np.nonzero(counts < k)[0]
+    small_groups = sample_instances(rng, offsets, indices, small_pid, k)
+    return (np.concatenate([big_groups, small_groups]),
+            np.concatenate([big_pid, small_pid]),
+            np.concatenate([big_rank, np.zeros_like(small_pid)]))
+
+
+def distinct_batches(stream, group_pid, num_per_batch):
+    """Reorder a stream of groups so that every batch of num_per_batch
+    consecutive groups has distinct identities, by swapping a repeated group
+    with the next later group of another identity.
+
+    Returns:
+        np.ndarray: the reordered stream, truncated to the batches which
+            could be made distinct.
+    """
+    stream = np.array(stream, dtype=np.int64)
+    pids = group_pid[stream]
+    num_batches = len(stream) // num_per_batch
+    batch_pids = np.sort(
+        pids[:num_batches * num_per_batch].reshape(
+            [num_batches, num_per_batch]),
+        axis=1)
+    todo = np.nonzero((batch_pids[:, 1:] == batch_pids[:, :-1]).any(
+        axis=1))[0].tolist()
+    heapq.heapify(todo)
+    while todo:
+        batch = heapq.heappop(todo)
+        if batch >= num_batches:
+            break
+        start = batch * num_per_batch
+        end = start + num_per_batch
+        counter = Counter(pids[start:end].tolist())
+        candidate = end
+        for i in range(start, end):
+            if counter[pids[i]] <= 1:
+                continue
+            while candidate < len(stream) and pids[candidate] in counter:
+                candidate += 1
+            if candidate >= len(stream):
+                num_batches = batch
+                break
+            counter[pids[i]] -= 1
+            counter[pids[candidate]] += 1
+            stream[[i, candidate]] = stream[[candidate, i]]
+            pids[[i, candidate]] = pids[[candidate, i]]
+            heapq.heappush(todo, candidate // num_per_batch)
+    return stream[:num_batches * num_per_batch]
@@ -15,12 +15,11 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from collections import defaultdict
-
 import numpy as np
 import paddle.distributed as dist
 from paddle.io import DistributedBatchSampler
 
+from ppcls.data.dataloader.identity_plan import build_identity_index, sample_instances, weighted_sample
 from ppcls.utils import logger
 
 
@@ -58,22 +57,19 @@ class PKSampler(DistributedBatchSampler):
         assert hasattr(self.dataset,
                        "labels"), "Dataset must have labels attribute."
         self.sample_per_id = sample_per_id
-        self.label_dict = defaultdict(list)
         self.sample_method = sample_method
         self.total_epochs = total_epochs
-        for idx, label in enumerate(self.dataset.labels):
-            self.label_dict[label].append(idx)
-        self.label_list = list(self.label_dict)
+        # samples of label_list[i] are indices[offsets[i]:offsets[i + 1]]
+        self.label_list, self.offsets, self.indices = build_identity_index(
+            self.dataset.labels)
         assert len(self.label_list) * self.sample_per_id >= self.batch_size, \
             f"batch size({self.batch_size}) should not be bigger than than #classes({len(self.label_list)})*sample_per_id({self.sample_per_id})"
         if self.sample_method == "id_avg_prob":
-            self.prob_list = np.array([1 / len(self.label_list)] *
-                                      len(self.label_list))
+            self.prob_list = np.full(
+                [len(self.label_list)], 1 / len(self.label_list))
         elif self.sample_method == "sample_avg_prob":
-            counter = []
-            for label_i in self.label_list:
-                counter.append(len(self.label_dict[label_i]))
-            self.prob_list = np.array(counter) / sum(counter)
+            counter = np.diff(self.offsets)
+            self.prob_list = counter / counter.sum()
         else:
             logger.error(
                 "PKSampler only support id_avg_prob and sample_avg_prob sample method, "
@@ -81,16 +77,21 @@ class PKSampler(DistributedBatchSampler):
 
         if id_list and ratio:
             assert len(id_list) % 2 == 0 and len(id_list) == len(ratio) * 2
-            for i in range(len(self.prob_list)):
-                for j in range(len(ratio)):
-                    if i >= id_list[j * 2] and i <= id_list[j * 2 + 1]:
-                        self.prob_list[i] = self.prob_list[i] * ratio[j]
-                        break
-            self.prob_list = self.prob_list / sum(self.prob_list)
+            # the first range containing an id decides its ratio
+            scale = np.ones_like(self.prob_list)
+            unset = np.ones(len(self.prob_list), dtype=bool)
+            positions = np.arange(len(self.prob_list))
+            for j in range(len(ratio)):
+                in_range = unset & (positions >= id_list[j * 2]) & (
+                    positions <= id_list[j * 2 + 1])
+                scale[in_range] = ratio[j]
+                unset &= ~in_range
+            self.prob_list = self.prob_list * scale
+            self.prob_list = self.prob_list / self.prob_list.sum()
 
-        diff = np.abs(sum(self.prob_list) - 1)
+        diff = np.abs(self.prob_list.sum() - 1)
         if diff > 0.00000001:
-            self.prob_list[-1] = 1 - sum(self.prob_list[:-1])
+            self.prob_list[-1] = 1 - self.prob_list[:-1].sum()
             if self.prob_list[-1] > 1 or self.prob_list[-1] < 0:
                 logger.error("PKSampler prob list error")
             else:
@@ -98,37 +99,25 @@ class PKSampler(DistributedBatchSampler):
                     "PKSampler: sum of prob list not equal to 1, diff is {}, change the last prob".
                     format(diff))
 
+    def _plan(self, rng):
+        """sample indices of all batches of an epoch, [len(self), batch_size]"""
+        label_per_batch = self.batch_size // self.sample_per_id
+        batch_labels = weighted_sample(rng, self.prob_list, len(self),
+                                       label_per_batch)
+        batch_index = sample_instances(rng, self.offsets, self.indices,
+                                       batch_labels.reshape([-1]),
+                                       self.sample_per_id)
+        return batch_index.reshape([len(self), self.batch_size])
+
     def __iter__(self):
-        # shuffle manually, same as DistributedBatchSampler.__iter__
+        # the plan of an epoch is seeded by rank and epoch when shuffling,
+        # same as DistributedBatchSampler.__iter__
         if self.shuffle:
             rank = dist.get_rank()
-            np.random.RandomState(rank * self.total_epochs +
-                                  self.epoch).shuffle(self.label_list)
-            np.random.RandomState(rank * self.total_epochs +
-                                  self.epoch).shuffle(self.prob_list)
+            rng = np.random.RandomState(rank * self.total_epochs + self.epoch)
             self.epoch += 1
-
-        label_per_batch = self.batch_size // self.sample_per_id
-        for _ in range(len(self)):
-            batch_index = []
-            batch_label_list = np.random.choice(
-                self.label_list,
-                size=label_per_batch,
-                replace=False,
-                p=self.prob_list)
-            for label_i in batch_label_list:
-                label_i_indexes = self.label_dict[label_i]
-                if self.sample_per_id <= len(label_i_indexes):
-                    batch_index.extend(
-                        np.random.choice(
-                            label_i_indexes,
-                            size=self.sample_per_id,
-                            replace=False))
-                else:
-                    batch_index.extend(
-                        np.random.choice(
-                            label_i_indexes,
-                            size=self.sample_per_id,
-                            replace=True))
-            if not self.drop_last or len(batch_index) == self.batch_size:
-                yield batch_index
+        else:
+            # the global random state
+            rng = np.random
+        for batch_index in self._plan(rng).tolist():
+            yield batch_index
@@ -0,0 +1,161 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Synthetic data generated once and served from memory, to measure the
+throughput of the model and the optimizer without the input pipeline, e.g.
+by tools/benchmark_synthetic.py.
+
+SyntheticDataset works with any sampler and paddle.io.DataLoader. With
+`loader.synthetic_batches: True` build_dataloader returns a
+SyntheticBatchLoader instead, which serves whole batches already on the
+device, without worker processes or collation.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import paddle
+from paddle.io import Dataset
+
+from ppcls.utils import logger
+
+
+class SyntheticDataset(Dataset):
+    """
+    Args:
+        num_samples (int): number of samples of an epoch.
+        image_shape (list): [C, H, W] of the images.
+        class_num (int): number of classes of the labels.
+        dtype (str): "float32", "float16" or "uint8" images.
+        multilabel (bool): multi-hot float32 labels with shape of
+            [class_num] as MultiLabelDataset, instead of int64 labels.
+        with_camera (bool): also return the camera id of the sample, as the
+            datasets of person and vehicle ReID.
+        num_unique (int): number of distinct images generated, served in turn.
+        seed (int): random seed of the data.
+    """
+
+    def __init__(self,
+                 num_samples=1281167,
+                 image_shape=[3, 224, 224],
+                 class_num=1000,
+                 dtype="float32",
+                 multilabel=False,
+                 with_camera=False,
+                 num_unique=64,
+                 seed=0):
+        assert dtype in ["float32", "float16", "uint8"], \
+            "SyntheticDataset only supports float32, float16 or uint8 images"
+        rng = np.random.RandomState(seed)
+        num_unique = min(num_unique, num_samples)
+        self.num_samples = num_samples
+        self.image_shape = list(image_shape)
+        self.class_num = class_num
+        self.multilabel = multilabel
+        self.with_camera = with_camera
+        if dtype == "uint8":
+            self.images = rng.randint(
+                0, 256, [num_unique] + self.image_shape).astype("uint8")
+        else:
+            self.images = rng.standard_normal(
+                [num_unique] + self.image_shape).astype(dtype)
+        # labels of every sample, read by the identity samplers
+        self.labels = rng.randint(0, class_num, num_samples).astype("int64")
+        if multilabel:
+            self.multi_labels = (rng.random_sample([num_unique, class_num]) <
+                                 0.1).astype("float32")
+        self.cameras = np.arange(num_samples, dtype="int64") % 6
+        logger.info(
+            "Build SyntheticDataset of {} samples, {} unique {} images with "
+            "shape of {}".format(num_samples, num_unique, dtype,
+                                 self.image_shape))
+
+    def __getitem__(self, idx):
+        img = self.images[idx % len(self.images)]
+        if self.multilabel:
+            label = self.multi_labels[idx % len(self.multi_labels)]
+        else:
+            label = self.labels[idx]
+        if self.with_camera:
+            return img, label, self.cameras[idx]
+        return img, label
+
+    def __len__(self):
+        return self.num_samples
+
+    def batch(self, indices):
+        """the fields of the samples of indices stacked as arrays"""
+        indices = np.asarray(indices)
+        fields = [
+            self.images[indices % len(self.images)],
+            self.multi_labels[indices % len(self.multi_labels)]
+            if self.multilabel else self.labels[indices]
+        ]
+        if self.with_camera:
+            fields.append(self.cameras[indices])
+        return fields
+
+
+class SyntheticBatchLoader(object):
+    """
+    Batches of a SyntheticDataset, stacked once and kept on the device, and
+    served in turn without worker processes or collation. Every rank serves
+    len(dataset) / world_size samples an epoch, as DistributedBatchSampler.
+
+    Args:
+        dataset (SyntheticDataset): the data of the batches.
+        batch_size (int): batch size of every rank.
+        drop_last (bool): whether to drop the last incomplete batch, else
+            it is served as a full batch.
+        num_unique_batches (int): number of distinct batches kept on the
+            device.
+    """
+
+    def __init__(self,
+                 dataset,
+                 batch_size,
+                 drop_last=True,
+                 num_unique_batches=4):
+        assert isinstance(dataset, SyntheticDataset), \
+            "SyntheticBatchLoader only supports SyntheticDataset"
+        self.dataset = dataset
+        self.batch_size = batch_size
+        # read by Engine, e.g. to set the epoch when resuming
+        self.batch_sampler = None
+        num_rank_samples = int(
+            np.ceil(len(dataset) / paddle.distributed.get_world_size()))
+        if drop_last:
+            self.num_batches = num_rank_samples // batch_size
+        else:
+            self.num_batches = int(np.ceil(num_rank_samples / batch_size))
+        self.batches = []
+        start = paddle.distributed.get_rank() * batch_size
+        for _ in range(max(min(num_unique_batches, self.num_batches), 1)):
+            indices = np.arange(start, start + batch_size) % len(dataset)
+            self.batches.append(
+                [paddle.to_tensor(x) for x in dataset.batch(indices)])
+            start += batch_size * paddle.distributed.get_world_size()
+
+    def __iter__(self):
+        for i in range(self.num_batches):
+            # a new list as the fields of a batch may be replaced
+            yield list(self.batches[i % len(self.batches)])
+
+    def __len__(self):
+        return self.num_batches
+
+    def reset(self):
+        pass
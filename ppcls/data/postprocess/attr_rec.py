@@ -17,6 +17,75 @@ import numpy as np
 import paddle
 import paddle.nn.functional as F
 
+from .columnar import columns_to_list
+
+
+AGE_LIST = np.array(['AgeLess18', 'Age18-60', 'AgeOver60'], dtype=object)
+DIRECT_LIST = np.array(['Front', 'Side', 'Back'], dtype=object)
+BAG_LIST = np.array(['HandBag', 'ShoulderBag', 'Backpack'], dtype=object)
+UPPER_LIST = ['UpperStride', 'UpperLogo', 'UpperPlaid', 'UpperSplice']
+LOWER_LIST = np.array(
+    [
+        'LowerStripe', 'LowerPattern', 'LongCoat', 'Trousers', 'Shorts',
+        'Skirt&Dress'
+    ],
+    dtype=object)
+
+
+def _to_str(values):
+    """str of every float of an array, as an object array"""
+    return np.array([str(v) for v in values.tolist()], dtype=object)
+
+
+def _select(condition, if_true, if_false):
+    return np.where(condition, if_true, if_false).astype(object)
+
+
+def person_attributes(x, threshold=0.5, glasses_threshold=0.3,
+                      hold_threshold=0.6):
+    """attribute strings of a batch of person attribute probs, [N, 10]"""
+    upper_label = 'Upper: ' + _select(x[:, 3] > x[:, 2], 'LongSleeve',
+                                      'ShortSleeve')
+    for i, upper in enumerate(UPPER_LIST):
+        upper_label = upper_label + _select(x[:, 4 + i] > threshold,
+                                            ' {}'.format(upper), '')
+    lower_res = x[:, 8:14]
+    lower_label = np.full(x.shape[0], 'Lower: ', dtype=object)
+    for i, lower in enumerate(LOWER_LIST):
+        lower_label = lower_label + _select(lower_res[:, i] > threshold,
+                                            ' {}'.format(lower), '')
+    has_lower = (lower_res > threshold).any(axis=1)
+    lower_label = np.where(
+        has_lower, lower_label,
+        lower_label + ' ' + LOWER_LIST[np.argmax(
+            lower_res, axis=1)])
+    bag_idx = np.argmax(x[:, 15:18], axis=1)
+    bag_score = x[:, 15:18].max(axis=1)
+    return np.stack(
+        [
+            _select(x[:, 22] > threshold, 'Female', 'Male'),
+            AGE_LIST[np.argmax(x[:, 19:22], axis=1)],
+            DIRECT_LIST[np.argmax(x[:, 23:], axis=1)],
+            'Glasses: ' + _select(x[:, 1] > glasses_threshold, 'True',
+                                  'False'),
+            'Hat: ' + _select(x[:, 0] > threshold, 'True', 'False'),
+            'HoldObjectsInFront: ' + _select(x[:, 18] > hold_threshold,
+                                             'True', 'False'),
+            _select(bag_score > threshold, BAG_LIST[bag_idx], 'No bag'),
+            upper_label,
+            lower_label,
+            _select(x[:, 14] > threshold, 'Boots', 'No boots')
+        ],
+        axis=1)
+
+
+def person_output(x, glasses_threshold=0.3, hold_threshold=0.6):
+    """binary output of a batch of person attribute probs, [N, C]"""
+    threshold_list = np.full(x.shape[1], 0.5)
+    threshold_list[1] = glasses_threshold
+    threshold_list[18] = hold_threshold
+    return (x > threshold_list).astype(np.int8)
+
 
 class VehicleAttribute(object):
     def __init__(self, color_threshold=0.5, type_threshold=0.5):
@@ -30,45 +99,44 @@ class VehicleAttribute(object):
             "sedan", "suv", "van", "hatchback", "mpv", "pickup", "bus",
             "truck", "estate"
         ]
+        self.color_names = np.array(self.color_list, dtype=object)
+        self.type_names = np.array(self.type_list, dtype=object)
 
-    def __call__(self, x, file_names=None):
+    def columnar(self, x, file_names=None):
+        """"attr" as a [N] string array, "pred" as a [N, 19] int8 array"""
         if isinstance(x, dict):
             x = x['logits']
         assert isinstance(x, paddle.Tensor)
         if file_names is not None:
             assert x.shape[0] == len(file_names)
-        x = F.sigmoid(x).numpy()
+        x = F.sigmoid(x).numpy().astype(np.float64)
 
         # postprocess output of predictor
-        batch_res = []
-        for idx, res in enumerate(x):
-            res = res.tolist()
-            label_res = []
-            color_idx = np.argmax(res[:10])
-            type_idx = np.argmax(res[10:])
-            print(color_idx, type_idx)
-            if res[color_idx] >= self.color_threshold:
-                color_info = f"Color: ({self.color_list[color_idx]}, prob: {res[color_idx]})"
-            else:
-                color_info = "Color unknown"
-
-            if res[type_idx + 10] >= self.type_threshold:
-                type_info = f"Type: ({self.type_list[type_idx]}, prob: {res[type_idx + 10]})"
-            else:
-                type_info = "Type unknown"
-
-            label_res = f"{color_info}, {type_info}"
-
-            threshold_list = [self.color_threshold
-                              ] * 10 + [self.type_threshold] * 9
-            pred_res = (np.array(res) > np.array(threshold_list)
-                        ).astype(np.int8).tolist()
-            batch_res.append({
-                "attr": label_res,
-                "pred": pred_res,
-                "file_name": file_names[idx]
-            })
-        return batch_res
+        rows = np.arange(x.shape[0])
+        color_idx = np.argmax(x[:, :10], axis=1)
+        type_idx = np.argmax(x[:, 10:], axis=1)
+        color_prob = x[rows, color_idx]
+        type_prob = x[rows, type_idx + 10]
+        color_info = np.where(
+            color_prob >= self.color_threshold,
+            "Color: (" + self.color_names[color_idx] + ", prob: " +
+            _to_str(color_prob) + ")", "Color unknown")
+        type_info = np.where(
+            type_prob >= self.type_threshold,
+            "Type: (" + self.type_names[type_idx] + ", prob: " +
+            _to_str(type_prob) + ")", "Type unknown")
+
+        threshold_list = [self.color_threshold
+                          ] * 10 + [self.type_threshold] * 9
+        pred_res = (x > np.array(threshold_list)).astype(np.int8)
+        return {
+            "attr": color_info + ", " + type_info,
+            "pred": pred_res,
+            "file_names": file_names
+        }
+
+    def __call__(self, x, file_names=None):
+        return columns_to_list(self.columnar(x, file_names))
 
 
 class PersonAttribute(object):
@@ -80,95 +148,25 @@ class PersonAttribute(object):
         self.glasses_threshold = glasses_threshold
         self.hold_threshold = hold_threshold
 
-    def __call__(self, x, file_names=None):
+    def columnar(self, x, file_names=None):
+        """"attributes" as a [N, 10] string array, "output" as a [N, C] int8
+        array"""
         if isinstance(x, dict):
             x = x['logits']
         assert isinstance(x, paddle.Tensor)
         if file_names is not None:
             assert x.shape[0] == len(file_names)
-        x = F.sigmoid(x).numpy()
+        x = F.sigmoid(x).numpy().astype(np.float64)
+        return {
+            "attributes": person_attributes(x, self.threshold,
+                                            self.glasses_threshold,
+                                            self.hold_threshold),
+            "output": person_output(x, self.glasses_threshold,
+                                    self.hold_threshold)
+        }
 
-        # postprocess output of predictor
-        age_list = ['AgeLess18', 'Age18-60', 'AgeOver60']
-        direct_list = ['Front', 'Side', 'Back']
-        bag_list = ['HandBag', 'ShoulderBag', 'Backpack']
-        upper_list = ['UpperStride', 'UpperLogo', 'UpperPlaid', 'UpperSplice']
-        lower_list = [
-            'LowerStripe', 'LowerPattern', 'LongCoat', 'Trousers', 'Shorts',
-            'Skirt&Dress'
-        ]
-        batch_res = []
-        for idx, res in enumerate(x):
-            res = res.tolist()
-            label_res = []
-            # gender 
-            gender = 'Female' if res[22] > self.threshold else 'Male'
-            label_res.append(gender)
-            # age
-            age = age_list[np.argmax(res[19:22])]
-            label_res.append(age)
-            # direction 
-            direction = direct_list[np.argmax(res[23:])]
-            label_res.append(direction)
-            # glasses
-            glasses = 'Glasses: '
-            if res[1] > self.glasses_threshold:
-                glasses += 'True'
-            else:
-                glasses += 'False'
-            label_res.append(glasses)
-            # hat
-            hat = 'Hat: '
-            if res[0] > self.threshold:
-                hat += 'True'
-            else:
-                hat += 'False'
-            label_res.append(hat)
-            # hold obj
-            hold_obj = 'HoldObjectsInFront: '
-            if res[18] > self.hold_threshold:
-                hold_obj += 'True'
-            else:
-                hold_obj += 'False'
-            label_res.append(hold_obj)
-            # bag
-            bag = bag_list[np.argmax(res[15:18])]
-            bag_score = res[15 + np.argmax(res[15:18])]
-            bag_label = bag if bag_score > self.threshold else 'No bag'
-            label_res.append(bag_label)
-            # upper
-            upper_res = res[4:8]
-            upper_label = 'Upper:'
-            sleeve = 'LongSleeve' if res[3] > res[2] else 'ShortSleeve'
-            upper_label += ' {}'.format(sleeve)
-            for i, r in enumerate(upper_res):
-                if r > self.threshold:
-                    upper_label += ' {}'.format(upper_list[i])
-            label_res.append(upper_label)
-            # lower
-            lower_res = res[8:14]
-            lower_label = 'Lower: '
-            has_lower = False
-            for i, l in enumerate(lower_res):
-                if l > self.threshold:
-                    lower_label += ' {}'.format(lower_list[i])
-                    has_lower = True
-            if not has_lower:
-                lower_label += ' {}'.format(lower_list[np.argmax(lower_res)])
-
-            label_res.append(lower_label)
-            # shoe
-            shoe = 'Boots' if res[14] > self.threshold else 'No boots'
-            label_res.append(shoe)
-
-            threshold_list = [0.5] * len(res)
-            threshold_list[1] = self.glasses_threshold
-            threshold_list[18] = self.hold_threshold
-            pred_res = (np.array(res) > np.array(threshold_list)
-                        ).astype(np.int8).tolist()
-
-            batch_res.append({"attributes": label_res, "output": pred_res})
-        return batch_res
+    def __call__(self, x, file_names=None):
+        return columns_to_list(self.columnar(x, file_names))
 
 
 class FaceAttribute(object):
@@ -244,41 +242,45 @@ class TableAttribute(object):
         self.obstruction_threshold = obstruction_threshold
         self.angle_threshold = angle_threshold
 
-    def __call__(self, x, file_names=None):
+    def columnar(self, x, file_names=None):
+        """"attributes" as a [N, 6] string array, "output" as a [N, 6] int8
+        array"""
         if isinstance(x, dict):
             x = x['logits']
         assert isinstance(x, paddle.Tensor)
         if file_names is not None:
             assert x.shape[0] == len(file_names)
-        x = F.sigmoid(x).numpy()
+        x = F.sigmoid(x).numpy().astype(np.float64)
 
         # postprocess output of predictor
-        batch_res = []
-        for idx, res in enumerate(x):
-            res = res.tolist()
-            label_res = []
-            source = 'Scanned' if res[0] > self.source_threshold else 'Photo'
-            number = 'Little' if res[1] > self.number_threshold else 'Numerous'
-            color = 'Black-and-White' if res[
-                2] > self.color_threshold else 'Multicolor'
-            clarity = 'Clear' if res[3] > self.clarity_threshold else 'Blurry'
-            obstruction = 'Without-Obstacles' if res[
-                4] > self.number_threshold else 'With-Obstacles'
-            angle = 'Horizontal' if res[
-                5] > self.number_threshold else 'Tilted'
-
-            label_res = [source, number, color, clarity, obstruction, angle]
-
-            threshold_list = [
-                self.source_threshold, self.number_threshold,
-                self.color_threshold, self.clarity_threshold,
-                self.obstruction_threshold, self.angle_threshold
-            ]
-            pred_res = (np.array(res) > np.array(threshold_list)
-                        ).astype(np.int8).tolist()
-            batch_res.append({
-                "attributes": label_res,
-                "output": pred_res,
-                "file_name": file_names[idx]
-            })
-        return batch_res
+        label_res = np.stack(
+            [
+                np.where(x[:, 0] > self.source_threshold, 'Scanned',
+                         'Photo'),
+                np.where(x[:, 1] > self.number_threshold, 'Little',
+                         'Numerous'),
+                np.where(x[:, 2] > self.color_threshold, 'Black-and-White',
+                         'Multicolor'),
+                np.where(x[:, 3] > self.clarity_threshold, 'Clear',
+                         'Blurry'),
+                np.where(x[:, 4] > self.number_threshold,
+                         'Without-Obstacles', 'With-Obstacles'),
+                np.where(x[:, 5] > self.number_threshold, 'Horizontal',
+                         'Tilted')
+            ],
+            axis=1).astype(object)
+
+        threshold_list = [
+            self.source_threshold, self.number_threshold,
+            self.color_threshold, self.clarity_threshold,
+            self.obstruction_threshold, self.angle_threshold
+        ]
+        pred_res = (x > np.array(threshold_list)).astype(np.int8)
+        return {
+            "attributes": label_res,
+            "output": pred_res,
+            "file_names": file_names
+        }
+
+    def __call__(self, x, file_names=None):
+        return columns_to_list(self.columnar(x, file_names))
@@ -0,0 +1,93 @@
+# copyright (c) 2022 PaddlePaddle Authors. All Rights Reserve.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers of the batch-vectorized postprocessing. A postprocess computes the
+results of the whole batch in columnar form, a dict of arrays with one row
+per sample, and `columns_to_list` converts them to the list of per-sample
+dicts returned by `__call__`.
+"""
+
+import numpy as np
+
+
+def label_array(class_id_map, num_classes):
+    """class id -> label name lookup table as a numpy object array"""
+    if class_id_map is None:
+        return None
+    if isinstance(class_id_map, dict):
+        size = max([num_classes] + [k + 1 for k in class_id_map])
+        labels = np.full(size, None, dtype=object)
+        for class_id, label_name in class_id_map.items():
+            labels[class_id] = label_name
+    else:
+        labels = np.empty(len(class_id_map), dtype=object)
+        labels[:] = class_id_map
+    return labels
+
+
+def topk_columns(probs, k):
+    """
+    ids and scores of the k largest probs of every row, in descending order.
+    Tied probs are ordered by descending class id, as
+    probs.argsort()[-k:][::-1] with a stable sort
+    """
+    num_classes = probs.shape[1]
+    k = min(k, num_classes)
+    if k < num_classes:
+        index = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+        kth = np.take_along_axis(probs, index, axis=1).min(axis=1)
+        # argpartition keeps any of the probs tied with the k-th largest one,
+        # sort these rows fully to keep the ones with the largest class ids
+        tied = np.nonzero((probs >= kth[:, None]).sum(axis=1) > k)[0]
+        if len(tied) > 0:
+            order = np.argsort(-probs[tied, ::-1], axis=1, kind="stable")
+            index[tied] = num_classes - 1 - order[:, :k]
+    else:
+        index = np.broadcast_to(np.arange(num_classes), probs.shape)
+    scores = np.take_along_axis(probs, index, axis=1)
+    order = np.lexsort((-index, -scores), axis=1)
+    return np.take_along_axis(index, order,
+                              axis=1), np.take_along_axis(
+                                  scores, order, axis=1)
+
+
+def columns_to_list(columns, score_decimals=None):
+    """
+    Convert columnar results to the list of per-sample dicts, keys keep the
+    order of the columns. Every column has one row per sample, except that
+    the flat columns of ragged results are split by the offsets in
+    columns["lod"]. None columns are dropped and "file_names" is output as
+    "file_name".
+    """
+    lod = columns.get("lod", None)
+    converted = {}
+    for key, value in columns.items():
+        if key == "lod" or value is None:
+            continue
+        if key == "file_names":
+            converted["file_name"] = list(value)
+            continue
+        if key == "scores" and score_decimals is not None:
+            value = np.around(value.astype(np.float64), score_decimals)
+        if isinstance(value, np.ndarray):
+            if lod is None:
+                value = value.tolist()
+            else:
+                value = [
+                    value[start:end].tolist()
+                    for start, end in zip(lod[:-1], lod[1:])
+                ]
+        converted[key] = value
+    keys = list(converted.keys())
+    return [dict(zip(keys, row)) for row in zip(*converted.values())]
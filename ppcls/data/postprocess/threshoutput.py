@@ -16,6 +16,8 @@ import os
 import numpy as np
 import paddle.nn.functional as F
 
+from .columnar import columns_to_list, label_array
+
 
 class ThreshOutput(object):
     def __init__(self, threshold, label_0="0", label_1="1"):
@@ -23,19 +25,21 @@ class ThreshOutput(object):
         self.label_0 = label_0
         self.label_1 = label_1
 
-    def __call__(self, x, file_names=None):
-        y = []
+    def columnar(self, x, file_names=None):
+        """binary results of the batch as [N, 1] arrays"""
         x = F.softmax(x, axis=-1).numpy()
-        for idx, probs in enumerate(x):
-            score = probs[1]
-            if score < self.threshold:
-                result = {"class_ids": [0], "scores":  [1 - score], "label_names": [self.label_0]}
-            else:
-                result = {"class_ids": [1], "scores": [score], "label_names": [self.label_1]}
-            if file_names is not None:
-                result["file_name"] = file_names[idx]
-            y.append(result)
-        return y
+        score = x[:, 1:2]
+        negative = score < self.threshold
+        return {
+            "class_ids": np.where(negative, 0, 1),
+            "scores": np.where(negative, 1 - score, score),
+            "label_names": np.where(negative, self.label_0,
+                                    self.label_1).astype(object),
+            "file_names": file_names
+        }
+
+    def __call__(self, x, file_names=None):
+        return columns_to_list(self.columnar(x, file_names))
 
 
 class MultiLabelThreshOutput(object):
@@ -43,6 +47,7 @@ class MultiLabelThreshOutput(object):
         self.threshold = threshold
         self.delimiter = delimiter if delimiter is not None else " "
         self.class_id_map = self.parse_class_id_map(class_id_map_file)
+        self.label_names = None
 
     def parse_class_id_map(self, class_id_map_file):
         if class_id_map_file is None:
@@ -65,26 +70,29 @@ class MultiLabelThreshOutput(object):
             class_id_map = None
         return class_id_map
 
-    def __call__(self, x, file_names=None):
-        y = []
+    def columnar(self, x, file_names=None):
+        """
+        results of the batch as flat arrays of the (sample, class) pairs over
+        the threshold, the pairs of sample i are in [lod[i], lod[i + 1])
+        """
         x = F.sigmoid(x).numpy()
-        for idx, probs in enumerate(x):
-            index = np.where(probs >= self.threshold)[0].astype("int32")
-            clas_id_list = []
-            score_list = []
-            label_name_list = []
-            for i in index:
-                clas_id_list.append(i.item())
-                score_list.append(probs[i].item())
-                if self.class_id_map is not None:
-                    label_name_list.append(self.class_id_map[i.item()])
-            result = {
-                "class_ids": clas_id_list,
-                "scores": np.around(
-                    score_list, decimals=5).tolist(),
-                "label_names": label_name_list    
-            }
-            if file_names is not None:
-                result["file_name"] = file_names[idx]
-            y.append(result)
-        return y
+        mask = x >= self.threshold
+        rows, class_ids = np.nonzero(mask)
+        if self.label_names is None:
+            self.label_names = label_array(self.class_id_map, x.shape[1])
+        if self.label_names is not None:
+            label_names = self.label_names[class_ids]
+        else:
+            label_names = np.empty(0, dtype=object)
+        lod = np.concatenate([[0], np.cumsum(mask.sum(axis=1))])
+        return {
+            "class_ids": class_ids,
+            "scores": x[rows, class_ids],
+            "label_names": label_names,
+            "file_names": file_names,
+            "lod": lod
+        }
+
+    def __call__(self, x, file_names=None):
+        return columns_to_list(
+            self.columnar(x, file_names), score_decimals=5)
@@ -17,6 +17,8 @@ import numpy as np
 import paddle
 import paddle.nn.functional as F
 
+from .columnar import columns_to_list, label_array, topk_columns
+
 
 class Topk(object):
     def __init__(self, topk=1, class_id_map_file=None, delimiter=None):
@@ -24,6 +26,7 @@ class Topk(object):
         self.topk = topk
         self.delimiter = delimiter if delimiter is not None else " "
         self.class_id_map = self.parse_class_id_map(class_id_map_file)
+        self.label_names = None
 
     def parse_class_id_map(self, class_id_map_file):
         if class_id_map_file is None:
@@ -50,7 +53,8 @@ class Topk(object):
             class_id_map = None
         return class_id_map
 
-    def __call__(self, x, file_names=None):
+    def columnar(self, x, file_names=None):
+        """topk results of the batch as [N, k] arrays"""
         if isinstance(x, dict):
             x = x['logits']
         assert isinstance(x, paddle.Tensor)
@@ -58,27 +62,20 @@ class Topk(object):
             assert x.shape[0] == len(file_names)
         x = F.softmax(x, axis=-1)
         x = x.numpy()
-        y = []
-        for idx, probs in enumerate(x):
-            index = probs.argsort(axis=0)[-self.topk:][::-1].astype(
-                "int32")
-            clas_id_list = []
-            score_list = []
-            label_name_list = []
-            for i in index:
-                clas_id_list.append(i.item())
-                score_list.append(probs[i].item())
-                if self.class_id_map is not None:
-                    label_name_list.append(self.class_id_map[i.item()])
-            result = {
-                "class_ids": clas_id_list,
-                "scores": np.around(
-                    score_list, decimals=5).tolist(),
-            }
-            if file_names is not None:
-                result["file_name"] = file_names[idx]
-            if label_name_list is not None:
-                result["label_names"] = label_name_list
-            y.append(result)
-        return y
+        class_ids, scores = topk_columns(x, self.topk)
+        if self.label_names is None:
+            self.label_names = label_array(self.class_id_map, x.shape[1])
+        if self.label_names is not None:
+            label_names = self.label_names[class_ids]
+        else:
+            label_names = np.empty((x.shape[0], 0), dtype=object)
+        return {
+            "class_ids": class_ids,
+            "scores": scores,
+            "file_names": file_names,
+            "label_names": label_names
+        }
 
+    def __call__(self, x, file_names=None):
+        return columns_to_list(
+            self.columnar(x, file_names), score_decimals=5)
@@ -19,6 +19,7 @@ import gc
 import shutil
 import copy
 import platform
+import time
 import paddle
 import paddle.distributed as dist
 from visualdl import LogWriter
@@ -27,7 +28,7 @@ import numpy as np
 import random
 
 from ppcls.utils.misc import AverageMeter
-from ppcls.utils import logger
+from ppcls.utils import logger, op_profile
 from ppcls.utils.logger import init_logger
 from ppcls.utils.config import print_config, dump_infer_config
 from ppcls.data import build_dataloader
@@ -49,6 +50,8 @@ from ppcls.data import create_operators
 from ppcls.engine import train as train_method
 from ppcls.engine.train.utils import type_name
 from ppcls.engine import evaluation
+from ppcls.engine.evaluation.output_store import build_output_store, output_config
+from ppcls.engine.tta import build_tta
 from ppcls.arch.gears.identity_head import IdentityHead
 
 
@@ -129,6 +132,13 @@ class Engine(object):
             "epochs": self.config["Global"]["epochs"]
         })
 
+        # per-operator timing of the preprocessing(optional), every rank
+        # saves the stats of its processes to op_profile/rank{rank}
+        if self.config["Global"].get("op_profile", False):
+            op_profile.enable(
+                os.path.join(self.output_dir, "op_profile",
+                             "rank{}".format(dist.get_rank())))
+
         # build dataloader
         if self.mode == 'train':
             self.train_dataloader = build_dataloader(
@@ -288,6 +298,13 @@ class Engine(object):
             np.random.seed(int(seed) + dist.get_rank())
             random.seed(int(seed) + dist.get_rank())
 
+        # build test-time augmentation(optional)
+        tta_config = self.config.get("TTA", None) or {}
+        self.eval_tta = build_tta(tta_config.get(
+            "Eval")) if self.eval_mode == "classification" else None
+        self.infer_tta = build_tta(tta_config.get(
+            "Infer")) if self.mode == "infer" else None
+
         # build postprocess for infer
         if self.mode == 'infer':
             self.preprocess_func = create_operators(self.config["Infer"][
@@ -489,7 +506,12 @@ class Engine(object):
     def eval(self, epoch_id=0):
         assert self.mode in ["train", "eval"]
         self.model.eval()
+        # raw outputs stored in Global.eval_output_dir(optional)
+        self.eval_output_store = build_output_store(self)
         eval_result = self.eval_func(self, epoch_id)
+        if self.eval_output_store is not None:
+            self.eval_output_store.commit(
+                config=output_config(self.config), epoch_id=epoch_id)
         self.model.train()
         return eval_result
 
@@ -510,6 +532,7 @@ class Engine(object):
         batch_data = []
         image_file_list = []
         save_path = self.config["Infer"].get("save_dir", None)
+        infer_time, infer_samples = 0.0, 0
         for idx, image_file in enumerate(image_list):
             with open(image_file, 'rb') as f:
                 x = f.read()
@@ -521,8 +544,12 @@ class Engine(object):
                 if len(batch_data) >= batch_size or idx == len(image_list) - 1:
                     batch_tensor = paddle.to_tensor(batch_data)
 
+                    tic = time.time()
                     with self.auto_cast(is_eval=True):
-                        out = self.model(batch_tensor)
+                        if self.infer_tta is not None:
+                            out = self.infer_tta(batch_tensor, self.model)
+                        else:
+                            out = self.model(batch_tensor)
 
                     if isinstance(out, list):
                         out = out[0]
@@ -534,6 +561,8 @@ class Engine(object):
                         out = out["output"]
 
                     result = self.postprocess_func(out, image_file_list)
+                    infer_time += time.time() - tic
+                    infer_samples += len(image_file_list)
                     if not save_path:
                         logger.info(result)
                     results.extend(result)
@@ -544,6 +573,12 @@ class Engine(object):
                     "Exception occured when parse line: {} with msg: {}".format(
                         image_file, ex))
                 continue
+        if self.infer_tta is not None and infer_time > 0:
+            num_views = self.infer_tta.num_views
+            logger.info(
+                "[Infer][TTA views: {}] ips: {:.5f} images/sec, {:.5f} views/sec".
+                format(num_views, infer_samples / infer_time, infer_samples *
+                       num_views / infer_time))
         if save_path:
             save_predict_result(save_path, results)
         return results
@@ -16,10 +16,13 @@ from __future__ import division
 from __future__ import print_function
 import time
 import platform
+from functools import partial
+import numpy as np
 import paddle
 
-from ppcls.utils.misc import AverageMeter
-from ppcls.utils import logger
+from ppcls.utils.misc import AverageMeter, all_reduce_meters
+from ppcls.utils import logger, op_profile
+from ppcls.engine.evaluation.output_store import dataset_file_ids, stored_batches
 
 
 def classification_eval(engine, epoch_id=0):
@@ -34,6 +37,14 @@ def classification_eval(engine, epoch_id=0):
     }
     print_batch_step = engine.config["Global"]["print_batch_step"]
 
+    store = getattr(engine, "eval_output_store", None)
+    if store is not None and store.complete:
+        # recompute the loss and metrics of the stored outputs
+        for batch in stored_batches(store, "eval"):
+            update_loss_and_metric(engine, output_info, batch["preds"],
+                                   batch["labels"], len(batch["labels"]))
+        return eval_result(engine, output_info, epoch_id)
+
     tic = time.time()
     accum_samples = 0
     total_samples = len(
@@ -41,6 +52,14 @@ def classification_eval(engine, epoch_id=0):
         dataset) if not engine.use_dali else engine.eval_dataloader.size
     max_iter = len(engine.eval_dataloader) - 1 if platform.system(
     ) == "Windows" else len(engine.eval_dataloader)
+    world_size = paddle.distributed.get_world_size()
+    tta = getattr(engine, "eval_tta", None)
+    # when all metrics are sums over samples, every rank updates the loss and
+    # metrics with its own samples and they are reduced once after the loop,
+    # instead of gathering the outputs of every batch, unless they are stored
+    reduce_once = world_size > 1 and store is None and (
+        engine.eval_metric_func is None or
+        getattr(engine.eval_metric_func, "reducible", False))
     for iter_id, batch in enumerate(engine.eval_dataloader):
         if iter_id >= max_iter:
             break
@@ -56,13 +75,21 @@ def classification_eval(engine, epoch_id=0):
 
         # image input
         with engine.auto_cast(is_eval=True):
-            if engine.is_rec:
+            if tta is not None:
+                # the views of the batch in one forward per shape
+                if engine.is_rec:
+                    out = tta(batch[0],
+                              partial(rec_view_forward, engine.model,
+                                      batch[1]))
+                else:
+                    out = tta(batch[0], engine.model)
+            elif engine.is_rec:
                 out = engine.model(batch[0], batch[1])
             else:
                 out = engine.model(batch[0])
 
         # just for DistributedBatchSampler issue: repeat sampling
-        current_samples = batch_size * paddle.distributed.get_world_size()
+        current_samples = batch_size * world_size
         accum_samples += current_samples
 
         if isinstance(out, dict) and "Student" in out:
@@ -70,8 +97,25 @@ def classification_eval(engine, epoch_id=0):
         if isinstance(out, dict) and "logits" in out:
             out = out["logits"]
 
+        if reduce_once:
+            labels = batch[1]
+            preds = out
+            current_samples = batch_size
+            if accum_samples > total_samples and not engine.use_dali:
+                # the ranks hold consecutive parts of the last batch, those
+                # after the first total_samples samples are repeated ones
+                rank_start = accum_samples - batch_size * world_size + \
+                    paddle.distributed.get_rank() * batch_size
+                current_samples = min(
+                    max(total_samples - rank_start, 0), batch_size)
+                if 0 < current_samples < batch_size:
+                    if isinstance(preds, list):
+                        preds = [pred[:current_samples] for pred in preds]
+                    else:
+                        preds = preds[:current_samples]
+                    labels = labels[:current_samples]
         # gather Tensor when distributed
-        if paddle.distributed.get_world_size() > 1:
+        elif world_size > 1:
             label_list = []
             device_id = paddle.distributed.ParallelEnv().device_id
             label = batch[1].cuda(device_id) if engine.config["Global"][
@@ -107,19 +151,20 @@ def classification_eval(engine, epoch_id=0):
             labels = batch[1]
             preds = out
 
-        # calc loss
-        if engine.eval_loss_func is not None:
-            with engine.auto_cast(is_eval=True):
-                loss_dict = engine.eval_loss_func(preds, labels)
-
-            for key in loss_dict:
-                if key not in output_info:
-                    output_info[key] = AverageMeter(key, '7.5f')
-                output_info[key].update(float(loss_dict[key]), current_samples)
+        if store is not None:
+            if isinstance(preds, paddle.Tensor):
+                store.append(
+                    "eval",
+                    preds=preds,
+                    labels=labels,
+                    batch_sizes=np.array([len(labels)]))
+            else:
+                logger.warning(
+                    "Only the Tensor outputs of the model can be stored.")
+                store = engine.eval_output_store = None
 
-        #  calc metric
-        if engine.eval_metric_func is not None:
-            engine.eval_metric_func(preds, labels)
+        update_loss_and_metric(engine, output_info, preds, labels,
+                               current_samples)
         time_info["batch_cost"].update(time.time() - tic)
 
         if iter_id % print_batch_step == 0:
@@ -130,6 +175,10 @@ def classification_eval(engine, epoch_id=0):
 
             ips_msg = "ips: {:.5f} images/sec".format(
                 batch_size / time_info["batch_cost"].avg)
+            if tta is not None:
+                ips_msg += ", TTA views: {}, {:.5f} views/sec".format(
+                    tta.num_views, batch_size * tta.num_views /
+                    time_info["batch_cost"].avg)
 
             if "ATTRMetric" in engine.config["Metric"]["Eval"][0]:
                 metric_msg = ""
@@ -143,11 +192,50 @@ def classification_eval(engine, epoch_id=0):
             logger.info("[Eval][Epoch {}][Iter: {}/{}]{}, {}, {}".format(
                 epoch_id, iter_id,
                 len(engine.eval_dataloader), metric_msg, time_msg, ips_msg))
+            for line in op_profile.summary():
+                logger.info(line)
 
         tic = time.time()
     if engine.use_dali:
         engine.eval_dataloader.reset()
 
+    if reduce_once:
+        all_reduce_meters(list(output_info.values()))
+        if engine.eval_metric_func is not None:
+            engine.eval_metric_func.all_reduce()
+    if store is not None:
+        file_ids = dataset_file_ids(engine.eval_dataloader, total_samples)
+        if file_ids is not None:
+            store.set_file_ids("eval", file_ids)
+    return eval_result(engine, output_info, epoch_id)
+
+
+def rec_view_forward(model, label, views):
+    # every view of the images has the labels of the images
+    return model(views,
+                 paddle.tile(label, [views.shape[0] // label.shape[0], 1]))
+
+
+def update_loss_and_metric(engine, output_info, preds, labels,
+                           current_samples):
+    # calc loss
+    if engine.eval_loss_func is not None:
+        with engine.auto_cast(is_eval=True):
+            loss_dict = engine.eval_loss_func(preds, labels)
+
+        for key in loss_dict:
+            if key not in output_info:
+                output_info[key] = AverageMeter(key, '7.5f')
+            # a rank may only hold repeated samples in the last batch
+            if current_samples > 0:
+                output_info[key].update(float(loss_dict[key]), current_samples)
+
+    #  calc metric
+    if engine.eval_metric_func is not None and current_samples > 0:
+        engine.eval_metric_func(preds, labels)
+
+
+def eval_result(engine, output_info, epoch_id):
     if "ATTRMetric" in engine.config["Metric"]["Eval"][0]:
         metric_msg = ", ".join([
             "evalres: ma: {:.5f} label_f1: {:.5f} label_pos_recall: {:.5f} label_neg_recall: {:.5f} instance_f1: {:.5f} instance_acc: {:.5f} instance_prec: {:.5f} instance_recall: {:.5f}".
@@ -13,17 +13,25 @@
 # limitations under the License.
 import time
 import platform
+import numpy as np
 import paddle
 import paddle.nn.functional as F
 
 from ppcls.utils.misc import AverageMeter
 from ppcls.utils import logger, all_gather
 
+# number of pairs passed to the metric at once
+PAIR_CHUNK_SIZE = 65536
+
 
 def face_recognition_eval(engine, epoch_id=0):
     # reset metric on beginning of eval
     if hasattr(engine.eval_metric_func, "reset"):
         engine.eval_metric_func.reset()
+    # datasets of unique images are evaluated by the index of the pairs
+    dataset = getattr(engine.eval_dataloader, "dataset", None)
+    if getattr(dataset, "unique_images", False):
+        return unique_image_eval(engine, epoch_id)
     output_info = dict()
 
     # log time_info for each batch
@@ -58,39 +66,10 @@ def face_recognition_eval(engine, epoch_id=0):
         labels = labels.astype('int64')
         batch_size = images_left.shape[0]
 
-        # flip images
-        if flip_test:
-            images_left = paddle.concat(
-                [images_left, paddle.flip(images_left, axis=-1)], 0)
-            images_right = paddle.concat(
-                [images_right, paddle.flip(images_right, axis=-1)], 0)
-
-        with engine.auto_cast(is_eval=True):
-            out_left = engine.model(images_left)
-            out_right = engine.model(images_right)
-
-        # get features
-        if engine.config["Global"].get("retrieval_feature_from",
-                                      "features") == "features":
-            # use output from neck as feature
-            embeddings_left = out_left["features"]
-            embeddings_right = out_right["features"]
-        else:
-            # use output from backbone as feature
-            embeddings_left = out_left["backbone"]
-            embeddings_right = out_right["backbone"]
-        
-        # normalize features
-        if feature_normalize:
-            embeddings_left = F.normalize(embeddings_left, p=2, axis=1)
-            embeddings_right = F.normalize(embeddings_right, p=2, axis=1)
-        
-        # fuse features by sum up if flip_test is True
-        if flip_test:
-            embeddings_left = embeddings_left[:batch_size] + \
-                              embeddings_left[batch_size:]
-            embeddings_right = embeddings_right[:batch_size] + \
-                               embeddings_right[batch_size:]
+        embeddings_left = extract_embeddings(engine, images_left, flip_test,
+                                             feature_normalize)
+        embeddings_right = extract_embeddings(engine, images_right,
+                                              flip_test, feature_normalize)
 
         # just for DistributedBatchSampler issue: repeat sampling
         current_samples = batch_size * paddle.distributed.get_world_size()
@@ -149,4 +128,130 @@ def face_recognition_eval(engine, epoch_id=0):
     if engine.eval_metric_func is None:
         return -1
     # return 1st metric in the dict
-    return engine.eval_metric_func.avg
\ No newline at end of file
+    return engine.eval_metric_func.avg
+
+
+def extract_embeddings(engine, images, flip_test=False,
+                       feature_normalize=False):
+    batch_size = images.shape[0]
+    # flip images
+    if flip_test:
+        images = paddle.concat([images, paddle.flip(images, axis=-1)], 0)
+
+    with engine.auto_cast(is_eval=True):
+        out = engine.model(images)
+
+    # get features
+    if engine.config["Global"].get("retrieval_feature_from",
+                                  "features") == "features":
+        # use output from neck as feature
+        embeddings = out["features"]
+    else:
+        # use output from backbone as feature
+        embeddings = out["backbone"]
+
+    # normalize features
+    if feature_normalize:
+        embeddings = F.normalize(embeddings, p=2, axis=1)
+
+    # fuse features by sum up if flip_test is True
+    if flip_test:
+        embeddings = embeddings[:batch_size] + embeddings[batch_size:]
+    return embeddings
+
+
+def unique_image_eval(engine, epoch_id=0):
+    """
+    Extract the embedding of every unique image of the pairs once, and
+    evaluate the pairs by looking up the embeddings of their images.
+    """
+    dataset = engine.eval_dataloader.dataset
+    time_info = {
+        "batch_cost": AverageMeter(
+            "batch_cost", '.5f', postfix=" s,"),
+        "reader_cost": AverageMeter(
+            "reader_cost", ".5f", postfix=" s,"),
+    }
+    print_batch_step = engine.config["Global"]["print_batch_step"]
+    max_iter = len(engine.eval_dataloader) - 1 if platform.system(
+    ) == "Windows" else len(engine.eval_dataloader)
+    flip_test = engine.config["Global"].get("flip_test", False)
+    feature_normalize = engine.config["Global"].get("feature_normalize", False)
+
+    all_embeddings = []
+    all_index = []
+    tic = time.time()
+    for iter_id, batch in enumerate(engine.eval_dataloader):
+        if iter_id >= max_iter:
+            break
+        if iter_id == 5:
+            for key in time_info:
+                time_info[key].reset()
+        time_info["reader_cost"].update(time.time() - tic)
+
+        images = paddle.to_tensor(batch[0])
+        batch_size = images.shape[0]
+        all_embeddings.append(
+            extract_embeddings(engine, images, flip_test, feature_normalize))
+        all_index.append(
+            paddle.to_tensor(batch[1]).astype('int64').reshape([-1]))
+        time_info["batch_cost"].update(time.time() - tic)
+
+        if iter_id % print_batch_step == 0:
+            time_msg = "s, ".join([
+                "{}: {:.5f}".format(key, time_info[key].avg)
+                for key in time_info
+            ])
+            ips_msg = "ips: {:.5f} images/sec".format(
+                batch_size / time_info["batch_cost"].avg)
+            logger.info("[Eval][Epoch {}][Iter: {}/{}]{}, {}".format(
+                epoch_id, iter_id,
+                len(engine.eval_dataloader), time_msg, ips_msg))
+
+        tic = time.time()
+
+    embeddings = paddle.concat(all_embeddings)
+    index = paddle.concat(all_index)
+    # gather once, the repeated samples of DistributedBatchSampler write the
+    # same embedding to the same index
+    if paddle.distributed.get_world_size() > 1:
+        embeddings = all_gather(embeddings)
+        index = all_gather(index)
+    embeddings = embeddings.numpy()
+    unique_embeddings = np.zeros(
+        [len(dataset), embeddings.shape[1]], dtype=embeddings.dtype)
+    index = index.numpy()
+    unique_embeddings[index] = embeddings
+    # the pairs with an image not extracted(e.g. of the last batch skipped on
+    # Windows) are dropped, as the pairs of skipped batches before
+    extracted = np.zeros([len(dataset)], dtype=bool)
+    extracted[index] = True
+    valid = np.nonzero(extracted[dataset.pair_index[:, 0]] & extracted[
+        dataset.pair_index[:, 1]])[0]
+    logger.info("Extracted {} of {} unique images of {} pairs, {} pairs "
+                "evaluated".format(
+                    int(extracted.sum()),
+                    len(dataset), len(dataset.pair_index), len(valid)))
+
+    #  calc metric by pairs
+    if engine.eval_metric_func is None:
+        return -1
+    place = paddle.CPUPlace()
+    for start in range(0, len(valid), PAIR_CHUNK_SIZE):
+        pairs = valid[start:start + PAIR_CHUNK_SIZE]
+        pair_index = dataset.pair_index[pairs]
+        engine.eval_metric_func(
+            paddle.to_tensor(
+                unique_embeddings[pair_index[:, 0]], place=place),
+            paddle.to_tensor(
+                unique_embeddings[pair_index[:, 1]], place=place),
+            paddle.to_tensor(
+                dataset.pair_labels[pairs], place=place), *[
+                    paddle.to_tensor(
+                        x[pairs], place=place) for x in dataset.pair_remains
+                ])
+
+    metric_msg = engine.eval_metric_func.avg_info
+    logger.info("[Eval][Epoch {}][Avg]{}".format(epoch_id, metric_msg))
+    # return 1st metric in the dict
+    return engine.eval_metric_func.avg
@@ -0,0 +1,311 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Store of the raw eval outputs(logits or features, labels, cameras, file ids)
+of a checkpoint, so that metrics can be recomputed without running the model.
+
+An entry of the store is a directory named by the hash of the model
+parameters and of the config the outputs depend on. Every array of every
+split is appended batch by batch to a raw `<split>.<name>.bin` file and read
+back as np.memmap. The entry is written to `<key>.tmp` and renamed when
+complete, so a partial entry is never read.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import paddle
+
+from ppcls.utils import logger
+from ppcls.utils.amp import AutoCast
+
+META_FILE = "meta.json"
+# eval modes whose outputs can be stored
+SUPPORTED_EVAL_MODES = ["classification", "retrieval"]
+
+
+class EvalOutputStore(object):
+    """
+    Args:
+        path (str): directory of the entry.
+        writable (bool): whether this process writes the outputs, only one
+            rank writes when distributed.
+        reuse (bool): whether to read a complete entry, if False the entry
+            is written again.
+        keep (int): number of the latest entries kept in the parent
+            directory when this entry is committed, all are kept if None.
+    """
+
+    def __init__(self, path, writable=True, reuse=True, keep=None):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.writable = writable
+        self.keep = keep
+        self.meta = None
+        if reuse and os.path.exists(os.path.join(self.path, META_FILE)):
+            with open(os.path.join(self.path, META_FILE)) as f:
+                self.meta = json.load(f)
+        self._splits = {}
+        self._file_ids = {}
+
+    @property
+    def complete(self):
+        return self.meta is not None
+
+    @property
+    def splits(self):
+        return list(self.meta["splits"].keys()) if self.complete else []
+
+    def append(self, split, **arrays):
+        """append the arrays of a batch to the split, arrays of a split must
+        be appended with the same names every time"""
+        if not self.writable or self.complete:
+            return
+        if not self._splits and os.path.exists(self.tmp_path):
+            # left by an interrupted eval
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        split_meta = self._splits.setdefault(split, {})
+        for name, array in arrays.items():
+            if array is None:
+                continue
+            if isinstance(array, paddle.Tensor):
+                array = array.numpy()
+            array = np.ascontiguousarray(array)
+            info = split_meta.setdefault(name, {
+                "shape": [0] + list(array.shape[1:]),
+                "dtype": array.dtype.name
+            })
+            assert list(array.shape[1:]) == info["shape"][1:] and \
+                array.dtype.name == info["dtype"], \
+                f"{split}.{name} changes from {info} to {array.shape} {array.dtype}"
+            with open(self._file(self.tmp_path, split, name), "ab") as f:
+                f.write(array.tobytes())
+            info["shape"][0] += len(array)
+
+    def set_file_ids(self, split, file_ids):
+        if self.writable and not self.complete:
+            self._file_ids[split] = [str(x) for x in file_ids]
+
+    def commit(self, **meta):
+        """finish the entry, then it can be loaded"""
+        if not self.writable or self.complete or not self._splits:
+            return
+        for split, file_ids in self._file_ids.items():
+            with open(os.path.join(self.tmp_path, f"{split}.file_ids.txt"),
+                      "w") as f:
+                f.write("\n".join(file_ids))
+        meta = dict(meta, splits=self._splits)
+        with open(os.path.join(self.tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+        self.meta = meta
+        logger.info(f"Saved eval outputs to {self.path}")
+        if self.keep is not None:
+            self._prune(self.keep)
+
+    def _prune(self, keep):
+        """remove all but the `keep` latest committed entries"""
+        root = os.path.dirname(os.path.abspath(self.path))
+        entries = []
+        for name in os.listdir(root):
+            meta_path = os.path.join(root, name, META_FILE)
+            if os.path.exists(meta_path):
+                entries.append((os.path.getmtime(meta_path), name))
+        entries.sort(reverse=True)
+        for _, name in entries[keep:]:
+            if os.path.join(root, name) != os.path.abspath(self.path):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def load(self, split):
+        """arrays of the split as np.memmap, and file_ids if stored"""
+        assert self.complete, f"Eval outputs {self.path} are not complete"
+        assert split in self.meta["splits"], \
+            f"No {split} outputs in {self.path}, got {self.splits}"
+        outputs = {}
+        for name, info in self.meta["splits"][split].items():
+            if info["shape"][0] == 0:
+                outputs[name] = np.empty(info["shape"], dtype=info["dtype"])
+            else:
+                outputs[name] = np.memmap(
+                    self._file(self.path, split, name),
+                    dtype=info["dtype"],
+                    mode="r",
+                    shape=tuple(info["shape"]))
+        file_ids_path = os.path.join(self.path, f"{split}.file_ids.txt")
+        if os.path.exists(file_ids_path):
+            with open(file_ids_path) as f:
+                outputs["file_ids"] = f.read().split("\n")
+        return outputs
+
+    @staticmethod
+    def _file(root, split, name):
+        return os.path.join(root, f"{split}.{name}.bin")
+
+
+def _drop_keys(config, keys):
+    if isinstance(config, dict):
+        return {
+            k: _drop_keys(v, keys)
+            for k, v in config.items() if k not in keys
+        }
+    if isinstance(config, (list, tuple)):
+        return [_drop_keys(v, keys) for v in config]
+    return config
+
+
+def output_config(config):
+    """the part of the config the raw eval outputs depend on"""
+    global_config = config["Global"]
+    return {
+        "eval_mode": global_config.get("eval_mode", "classification"),
+        "use_multilabel": global_config.get("use_multilabel", False),
+        "retrieval_feature_from": global_config.get("retrieval_feature_from",
+                                                    "features"),
+        "AMP": config.get("AMP", None),
+        "TTA": (config.get("TTA", None) or {}).get("Eval", None),
+        # batching and loading do not change the outputs
+        "DataLoader": _drop_keys(
+            copy.deepcopy(config["DataLoader"]["Eval"]),
+            ["sampler", "loader"])
+    }
+
+
+def output_key(config, model):
+    """hash of the model parameters and of the output config"""
+    param_hash = hashlib.sha1()
+    for name, param in sorted(model.state_dict().items()):
+        param_hash.update(name.encode())
+        param_hash.update(np.ascontiguousarray(param.numpy()).tobytes())
+    config_hash = hashlib.sha1(
+        json.dumps(
+            output_config(config), sort_keys=True, default=str).encode())
+    return "{}_{}".format(param_hash.hexdigest()[:16],
+                          config_hash.hexdigest()[:16])
+
+
+def build_output_store(engine):
+    """
+    The store of the eval outputs of the current model in
+    Global.eval_output_dir, or None if it is not set. When the entry exists
+    and Global.reuse_eval_outputs is True(the default) the outputs are read
+    from it instead of running the model, otherwise they are written to it.
+
+    The evals during training are only stored when Global.keep_eval_outputs
+    is set, and then only the latest keep_eval_outputs entries are kept.
+    """
+    global_config = engine.config["Global"]
+    output_dir = global_config.get("eval_output_dir", None)
+    if output_dir is None:
+        return None
+    keep = global_config.get("keep_eval_outputs", None)
+    if engine.mode == "train" and not keep:
+        return None
+    if engine.eval_mode not in SUPPORTED_EVAL_MODES:
+        logger.warning(
+            f"Eval outputs of eval_mode {engine.eval_mode} can not be stored, "
+            f"only {SUPPORTED_EVAL_MODES} are supported.")
+        return None
+    reuse = global_config.get("reuse_eval_outputs", True)
+    writable = paddle.distributed.get_rank() == 0
+    if not reuse and not writable:
+        # the store is neither read nor written, skip hashing the model
+        return None
+    path = os.path.join(output_dir, output_key(engine.config, engine.model))
+    if reuse and paddle.distributed.get_world_size() > 1:
+        # all ranks must either run the model or read the outputs
+        complete = paddle.to_tensor(
+            [int(os.path.exists(os.path.join(path, META_FILE)))])
+        paddle.distributed.all_reduce(
+            complete, op=paddle.distributed.ReduceOp.MIN)
+        reuse = bool(complete.item())
+    store = EvalOutputStore(path, writable=writable, reuse=reuse, keep=keep or None)
+    if store.complete:
+        logger.info(f"Reuse the eval outputs in {path}")
+    return store
+
+
+def dataset_file_ids(dataloader, num_samples):
+    """image paths of the dataset of the dataloader, if any"""
+    images = getattr(getattr(dataloader, "dataset", None), "images", None)
+    if isinstance(images, list) and len(images) == num_samples:
+        return images
+    return None
+
+
+class OfflineEvalEngine(object):
+    """
+    The part of Engine used by the eval functions, to recompute the metrics
+    of stored outputs without building a model or dataloaders.
+    """
+
+    def __init__(self, config, output_path):
+        from ppcls.loss import build_loss
+        from ppcls.metric import build_metrics
+
+        self.config = config
+        self.eval_mode = config["Global"].get("eval_mode", "classification")
+        assert self.eval_mode in SUPPORTED_EVAL_MODES, \
+            f"eval_mode {self.eval_mode} is not supported"
+        self.model = None
+        self.use_dali = False
+        self.is_rec = False
+        self.auto_cast = AutoCast(False)
+        self.eval_output_store = EvalOutputStore(output_path, writable=False)
+        assert self.eval_output_store.complete, \
+            f"No complete eval outputs in {output_path}"
+
+        loss_config = config.get("Loss", {}) or {}
+        self.eval_loss_func = build_loss(loss_config["Eval"]) \
+            if loss_config.get("Eval") is not None else None
+        metric_config = config.get("Metric", {}) or {}
+        if metric_config.get("Eval") is not None:
+            self.eval_metric_func = build_metrics(metric_config["Eval"])
+        elif self.eval_mode == "retrieval":
+            self.eval_metric_func = build_metrics(
+                [{"name": "Recallk", "topk": (1, 5)}])
+        else:
+            self.eval_metric_func = None
+
+    def eval(self, epoch_id=0):
+        from ppcls.engine import evaluation
+        with paddle.no_grad():
+            return getattr(evaluation, self.eval_mode + "_eval")(self,
+                                                                 epoch_id)
+
+
+def stored_batches(store, split):
+    """yield the stored arrays of the split as tensors, batch by batch as
+    they were appended with their `batch_sizes`"""
+    outputs = store.load(split)
+    batch_sizes = outputs.pop("batch_sizes")
+    outputs.pop("file_ids", None)
+    start = 0
+    for batch_size in batch_sizes:
+        end = start + int(batch_size)
+        yield {
+            name: paddle.to_tensor(np.asarray(array[start:end]))
+            for name, array in outputs.items()
+        }
+        start = end
+
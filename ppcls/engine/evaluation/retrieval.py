@@ -16,18 +16,29 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import defaultdict
+from itertools import groupby
+from typing import Dict, List
 
 import numpy as np
 import paddle
 import scipy
 
+from ppcls.engine.evaluation.output_store import dataset_file_ids
 from ppcls.utils import all_gather, logger
 
+# number of stored features processed at once
+STORED_FEATURE_CHUNK_SIZE = 4096
+
 
 def retrieval_eval(engine, epoch_id=0):
-    engine.model.eval()
+    store = getattr(engine, "eval_output_store", None)
+    if store is not None and store.complete:
+        use_gallery_query = "gallery_query" in store.splits
+    else:
+        engine.model.eval()
+        use_gallery_query = engine.gallery_query_dataloader is not None
     # step1. prepare query and gallery features
-    if engine.gallery_query_dataloader is not None:
+    if use_gallery_query:
         gallery_feat, gallery_label, gallery_camera = compute_feature(
             engine, "gallery_query")
         query_feat, query_label, query_camera = gallery_feat, gallery_label, gallery_camera
@@ -49,6 +60,11 @@ def retrieval_eval(engine, epoch_id=0):
     query_camera_blocks = paddle.split(
         query_camera, sections) if query_camera is not None else None
     metric_key = None
+    # binary features are compared by the hamming distance of packed codes
+    is_binary = engine.config["Global"].get("feature_binarize") is not None
+    if is_binary:
+        num_bits = gallery_feat.shape[1] * 8
+        gallery_words = pack_words(gallery_feat.numpy())
 
     # step3. compute metric
     if engine.eval_loss_func is None:
@@ -58,6 +74,9 @@ def retrieval_eval(engine, epoch_id=0):
         logger.info(f"re_ranking={use_reranking}")
         if use_reranking:
             # compute distance matrix
+            if is_binary:
+                query_feat = unpack_binary_feature(query_feat)
+                gallery_feat = unpack_binary_feature(gallery_feat)
             distmat = compute_re_ranking_dist(
                 query_feat, gallery_feat, engine.config["Global"].get(
                     "feature_normalize", True), 20, 6, 0.3)
@@ -74,11 +93,27 @@ def retrieval_eval(engine, epoch_id=0):
             metric_dict = engine.eval_metric_func(-distmat, query_label,
                                                   gallery_label, keep_mask)
         else:
+            world_size = paddle.distributed.get_world_size()
+            # every rank evaluates a contiguous range of the query blocks and
+            # the weighted metric sums of the ranks are reduced
+            shard_query = world_size > 1 and engine.config["Global"].get(
+                "shard_query_eval", True) and len(sections) >= world_size
+            block_ids = np.arange(len(sections))
+            if shard_query:
+                block_ids = np.array_split(
+                    block_ids, world_size)[paddle.distributed.get_rank()]
             metric_dict = defaultdict(float)
-            for block_idx, block_feat in enumerate(query_feat_blocks):
+            for block_idx in block_ids:
+                block_feat = query_feat_blocks[block_idx]
                 # compute distance matrix
-                distmat = paddle.matmul(
-                    block_feat, gallery_feat, transpose_y=True)
+                if is_binary:
+                    # inner product of the +-1 codes
+                    distmat = paddle.to_tensor(num_bits - 2 * hamming_distance(
+                        pack_words(block_feat.numpy()), gallery_words).astype(
+                            "float32"))
+                else:
+                    distmat = paddle.matmul(
+                        block_feat, gallery_feat, transpose_y=True)
                 # exclude illegal distance
                 if query_camera is not None:
                     camera_mask = query_camera_blocks[
@@ -86,7 +121,7 @@ def retrieval_eval(engine, epoch_id=0):
                     label_mask = query_label_blocks[
                         block_idx] != gallery_label.t()
                     keep_mask = label_mask | camera_mask
-                    distmat = keep_mask.astype(query_feat.dtype) * distmat
+                    distmat = keep_mask.astype(distmat.dtype) * distmat
                 else:
                     keep_mask = None
                 # compute metric by block
@@ -97,6 +132,8 @@ def retrieval_eval(engine, epoch_id=0):
                 for key in metric_block:
                     metric_dict[key] += metric_block[key] * block_feat.shape[
                         0] / num_query
+            if shard_query:
+                metric_dict = all_reduce_metric(metric_dict)
 
     metric_info_list = []
     for key, value in metric_dict.items():
@@ -110,6 +147,16 @@ def retrieval_eval(engine, epoch_id=0):
 
 
 def compute_feature(engine, name="gallery"):
+    # optional projection fitted by tools/fit_projection.py
+    projection = None
+    if engine.config["Global"].get("feature_projection") is not None:
+        projection = load_projection(engine.config["Global"][
+            "feature_projection"])
+
+    store = getattr(engine, "eval_output_store", None)
+    if store is not None and store.complete:
+        return load_stored_feature(engine, store, name, projection)
+
     if name == "gallery":
         dataloader = engine.gallery_dataloader
     elif name == "query":
@@ -122,6 +169,7 @@ def compute_feature(engine, name="gallery"):
         )
 
     all_feat = []
+    all_raw_feat = []
     all_label = []
     all_camera = []
     has_camera = False
@@ -152,37 +200,36 @@ def compute_feature(engine, name="gallery"):
         else:
             # use output from backbone as feature
             batch_feat = out["backbone"]
+        # the features before normalize, projection and binarize are stored
+        if store is not None:
+            all_raw_feat.append(batch_feat)
 
-        # do norm(optional)
-        if engine.config["Global"].get("feature_normalize", True):
-            batch_feat = paddle.nn.functional.normalize(batch_feat, p=2)
-
-        # do binarize(optional)
-        if engine.config["Global"].get("feature_binarize") == "round":
-            batch_feat = paddle.round(batch_feat).astype("float32") * 2.0 - 1.0
-        elif engine.config["Global"].get("feature_binarize") == "sign":
-            batch_feat = paddle.sign(batch_feat).astype("float32")
-
-        if paddle.distributed.get_world_size() > 1:
-            all_feat.append(all_gather(batch_feat))
-            all_label.append(all_gather(batch[1]))
-            if has_camera:
-                all_camera.append(all_gather(batch[2]))
-        else:
-            all_feat.append(batch_feat)
-            all_label.append(batch[1])
-            if has_camera:
-                all_camera.append(batch[2])
+        all_feat.append(
+            process_feature(batch_feat, engine.config["Global"], projection))
+        all_label.append(batch[1])
+        if has_camera:
+            all_camera.append(batch[2])
 
     if engine.use_dali:
         dataloader.reset()
 
+    batch_sizes = [len(label) for label in all_label]
     all_feat = paddle.concat(all_feat)
     all_label = paddle.concat(all_label)
     if has_camera:
         all_camera = paddle.concat(all_camera)
     else:
         all_camera = None
+    if store is not None:
+        all_raw_feat = paddle.concat(all_raw_feat)
+    # gather the samples of all ranks once instead of every batch
+    if paddle.distributed.get_world_size() > 1:
+        all_feat = gather_in_sample_order(all_feat, batch_sizes)
+        all_label = gather_in_sample_order(all_label, batch_sizes)
+        if has_camera:
+            all_camera = gather_in_sample_order(all_camera, batch_sizes)
+        if store is not None:
+            all_raw_feat = gather_in_sample_order(all_raw_feat, batch_sizes)
     # discard redundant padding sample(s) at the end
     total_samples = dataloader.size if engine.use_dali else len(
         dataloader.dataset)
@@ -191,10 +238,196 @@ def compute_feature(engine, name="gallery"):
     if has_camera:
         all_camera = all_camera[:total_samples]
 
+    if store is not None:
+        store.append(
+            name,
+            features=all_raw_feat[:total_samples],
+            labels=all_label,
+            cameras=all_camera)
+        file_ids = dataset_file_ids(dataloader, total_samples)
+        if file_ids is not None:
+            store.set_file_ids(name, file_ids)
+
     logger.info(f"Build {name} done, all feat shape: {all_feat.shape}")
     return all_feat, all_label, all_camera
 
 
+def process_feature(batch_feat: paddle.Tensor,
+                    global_config: dict,
+                    projection=None) -> paddle.Tensor:
+    """Normalize, project and binarize the features as set in Global config"""
+    # do norm(optional)
+    if global_config.get("feature_normalize", True):
+        batch_feat = paddle.nn.functional.normalize(batch_feat, p=2)
+
+    # do projection(optional)
+    if projection is not None:
+        batch_feat = project_feature(batch_feat, *projection)
+
+    # do binarize(optional), binary features are packed to 8 bits a byte
+    if global_config.get("feature_binarize") == "round":
+        batch_feat = pack_binary_feature(paddle.round(batch_feat) >= 1)
+    elif global_config.get("feature_binarize") == "sign":
+        batch_feat = pack_binary_feature(batch_feat > 0)
+    return batch_feat
+
+
+def load_stored_feature(engine, store, name, projection=None):
+    """Process the stored raw features of the split chunk by chunk"""
+    outputs = store.load(name)
+    raw_feat = outputs["features"]
+    all_feat = [
+        process_feature(
+            paddle.to_tensor(np.asarray(raw_feat[start:start +
+                                                 STORED_FEATURE_CHUNK_SIZE])),
+            engine.config["Global"], projection)
+        for start in range(0, len(raw_feat), STORED_FEATURE_CHUNK_SIZE)
+    ]
+    all_feat = paddle.concat(all_feat)
+    all_label = paddle.to_tensor(np.asarray(outputs["labels"]))
+    all_camera = paddle.to_tensor(np.asarray(outputs[
+        "cameras"])) if "cameras" in outputs else None
+    logger.info(f"Load {name} done, all feat shape: {all_feat.shape}")
+    return all_feat, all_label, all_camera
+
+
+def gather_in_sample_order(tensor: paddle.Tensor,
+                           batch_sizes: List[int]) -> paddle.Tensor:
+    """Gather the samples of all ranks in the order of the dataset
+
+    DistributedBatchSampler gives the ranks consecutive parts of every batch,
+    so the gathered samples are ordered batch by batch and rank by rank, as if
+    every batch were gathered.
+
+    Args:
+        tensor (paddle.Tensor): Concatenated samples of all batches of the rank.
+        batch_sizes (List[int]): Size of every batch, the same for all ranks.
+
+    Returns:
+        paddle.Tensor: Samples of all ranks.
+    """
+    gathered = all_gather(tensor, concat=False)
+    world_size = len(gathered)
+    parts = []
+    start = 0
+    # batches of the same size are reordered at once
+    for batch_size, group in groupby(batch_sizes):
+        num_batches = len(list(group))
+        end = start + batch_size * num_batches
+        part = paddle.stack(
+            [
+                x[start:end].reshape([num_batches, batch_size] + x.shape[1:])
+                for x in gathered
+            ],
+            axis=1)
+        parts.append(
+            part.reshape([num_batches * world_size * batch_size] +
+                         tensor.shape[1:]))
+        start = end
+    return paddle.concat(parts)
+
+
+def all_reduce_metric(metric_dict: Dict[str, float]) -> Dict[str, float]:
+    """Sum the metrics of all ranks, every rank must have the same keys"""
+    keys = list(metric_dict.keys())
+    values = paddle.to_tensor(
+        [float(metric_dict[key]) for key in keys], dtype="float64")
+    paddle.distributed.all_reduce(values)
+    return dict(zip(keys, values.numpy().tolist()))
+
+
+def load_projection(path: str):
+    """Load the projection saved by tools/fit_projection.py
+
+    Args:
+        path (str): Path of the projection.npz.
+
+    Returns:
+        tuple: Mean with shape of [D], matrix with shape of [D, d] and whether to normalize the projected features.
+    """
+    data = np.load(path)
+    return (paddle.to_tensor(data["mean"].astype("float32")),
+            paddle.to_tensor(data["matrix"].astype("float32")),
+            bool(data["normalize"]))
+
+
+def project_feature(feat: paddle.Tensor,
+                    mean: paddle.Tensor,
+                    matrix: paddle.Tensor,
+                    normalize: bool=True) -> paddle.Tensor:
+    """Project features with shape of [N, D] to [N, d] by (feat - mean) @ matrix"""
+    feat = paddle.matmul(feat - mean, matrix)
+    if normalize:
+        feat = paddle.nn.functional.normalize(feat, p=2)
+    return feat
+
+
+def pack_binary_feature(bits: paddle.Tensor) -> paddle.Tensor:
+    """Pack binary features to uint8 codes, 8 bits a byte in big-endian order
+
+    Args:
+        bits (paddle.Tensor): Bool tensor with shape of [N, D], D must be a multiple of 8.
+
+    Returns:
+        paddle.Tensor: Uint8 codes with shape of [N, D // 8].
+    """
+    assert bits.shape[1] % 8 == 0, \
+        "The binary feature only supports sizes multiple of 8"
+    return paddle.to_tensor(np.packbits(bits.numpy(), axis=1))
+
+
+def unpack_binary_feature(codes: paddle.Tensor) -> paddle.Tensor:
+    """Unpack uint8 codes to float features of +1 and -1"""
+    bits = np.unpackbits(codes.numpy(), axis=1)
+    return paddle.to_tensor(bits.astype("float32") * 2.0 - 1.0)
+
+
+if hasattr(np, "bitwise_count"):
+    _WORD_DTYPE = np.uint64
+    _popcount = np.bitwise_count
+else:
+    _WORD_DTYPE = np.uint8
+    _POPCOUNT_TABLE = np.array(
+        [bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x):
+        return _POPCOUNT_TABLE[x]
+
+
+def pack_words(codes: np.ndarray) -> np.ndarray:
+    """View uint8 codes with shape of [N, B] as words with shape of [W, N]
+
+    Codes are viewed as uint64 words when numpy has bitwise_count and B is a
+    multiple of 8, otherwise as bytes. Words are transposed so that every
+    word of all samples is contiguous for `hamming_distance`.
+    """
+    codes = np.ascontiguousarray(codes, dtype=np.uint8)
+    if _WORD_DTYPE == np.uint64 and codes.shape[1] % 8 == 0:
+        codes = codes.view(np.uint64)
+    return np.ascontiguousarray(codes.T)
+
+
+def hamming_distance(query_words: np.ndarray,
+                     gallery_words: np.ndarray) -> np.ndarray:
+    """Hamming distance of every query and gallery code by popcount
+
+    Args:
+        query_words (np.ndarray): Query words from `pack_words` with shape of [W, num_query].
+        gallery_words (np.ndarray): Gallery words from `pack_words` with shape of [W, num_gallery].
+
+    Returns:
+        np.ndarray: Int32 distance with shape of [num_query, num_gallery].
+    """
+    assert query_words.dtype == gallery_words.dtype and \
+        query_words.shape[0] == gallery_words.shape[0]
+    dist = np.zeros(
+        [query_words.shape[1], gallery_words.shape[1]], dtype=np.int32)
+    for query_word, gallery_word in zip(query_words, gallery_words):
+        dist += _popcount(
+            np.bitwise_xor(query_word[:, None], gallery_word[None, :]))
+    return dist
+
+
 def k_reciprocal_neighbor(rank: np.ndarray, p: int, k: int) -> np.ndarray:
     """Implementation of k-reciprocal nearest neighbors, i.e. R(p, k)
 
@@ -15,7 +15,7 @@ from __future__ import absolute_import, division, print_function
 
 import paddle
 import datetime
-from ppcls.utils import logger
+from ppcls.utils import logger, op_profile
 from ppcls.utils.misc import AverageMeter
 
 
@@ -74,6 +74,9 @@ def log_info(trainer, batch_size, epoch_id, iter_id):
     )
     for key in trainer.time_info:
         trainer.time_info[key].reset()
+    # per-operator timing of the preprocessing(optional)
+    for line in op_profile.summary():
+        logger.info(line)
 
     for i, lr in enumerate(trainer.lr_sch):
         logger.scaler(
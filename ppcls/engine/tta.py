@@ -0,0 +1,166 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Batched test-time augmentation of classification eval and infer. The views
+(scales x crops x flip) of a batch are concatenated into one larger batch per
+input shape, so all the views of the same shape run in a single forward, and
+the outputs of the views of every image are fused.
+
+Configured by TTA.Eval and TTA.Infer, e.g.
+
+    TTA:
+      Eval:
+        flip: True
+        crop_size: 224
+        num_crops: 5
+        scales: [1.0]
+        fusion: mean
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import paddle
+import paddle.nn.functional as F
+
+from ppcls.utils import logger
+
+FUSIONS = ["mean", "max", "softmax_mean"]
+
+
+class TTA(object):
+    """
+    Args:
+        flip (bool): add the horizontal flip of every view.
+        crop_size (int|list): [h, w] of the crops of every scale, None to
+            use the whole image.
+        num_crops (int): 1 for the center crop, 5 for the center and the four
+            corner crops.
+        scales (list): scale factors of the images, resized by bilinear
+            interpolation.
+        fusion (str): "mean" or "max" of the outputs of the views, or
+            "softmax_mean", the log of the mean probability, which keeps
+            the softmax of the output the mean probability.
+    """
+
+    def __init__(self,
+                 flip=False,
+                 crop_size=None,
+                 num_crops=1,
+                 scales=None,
+                 fusion="mean"):
+        assert num_crops in [1, 5], "num_crops only supports 1 or 5"
+        assert fusion in FUSIONS, f"fusion only supports {FUSIONS}"
+        if isinstance(crop_size, int):
+            crop_size = [crop_size, crop_size]
+        self.flip = flip
+        self.crop_size = crop_size
+        self.num_crops = num_crops if crop_size is not None else 1
+        self.scales = scales or [1.0]
+        self.fusion = fusion
+
+    @property
+    def num_views(self):
+        return len(self.scales) * self.num_crops * (2 if self.flip else 1)
+
+    def _crops(self, images):
+        if self.crop_size is None:
+            return [images]
+        h, w = images.shape[2:]
+        ch, cw = self.crop_size
+        assert h >= ch and w >= cw, \
+            f"TTA crop_size {self.crop_size} is larger than the image {[h, w]}"
+        boxes = [((h - ch) // 2, (w - cw) // 2)]
+        if self.num_crops == 5:
+            boxes += [(0, 0), (0, w - cw), (h - ch, 0), (h - ch, w - cw)]
+        return [images[:, :, t:t + ch, l:l + cw] for t, l in boxes]
+
+    def expand(self, images):
+        """
+        Args:
+            images (paddle.Tensor): [N, C, H, W] images.
+
+        Returns:
+            list: a [V * N, C, h, w] batch of the V views of every shape, in
+                the order of views.
+        """
+        buckets = {}
+        for scale in self.scales:
+            scaled = images
+            if scale != 1.0:
+                scaled = F.interpolate(
+                    images,
+                    scale_factor=scale,
+                    mode="bilinear",
+                    align_corners=False)
+            for view in self._crops(scaled):
+                buckets.setdefault(tuple(view.shape[2:]), []).append(view)
+                if self.flip:
+                    buckets[tuple(view.shape[2:])].append(
+                        paddle.flip(view, axis=[3]))
+        return [paddle.concat(views) for views in buckets.values()]
+
+    def fuse(self, outputs, batch_size):
+        """fuse the concatenated outputs of all views, a Tensor, or a list or
+        dict of Tensors"""
+        if isinstance(outputs, dict):
+            return {k: self.fuse(v, batch_size) for k, v in outputs.items()}
+        if isinstance(outputs, (list, tuple)):
+            return [self.fuse(v, batch_size) for v in outputs]
+        outputs = outputs.reshape([-1, batch_size] + outputs.shape[1:])
+        if self.fusion == "max":
+            return outputs.max(axis=0)
+        if self.fusion == "softmax_mean":
+            return paddle.log(F.softmax(outputs, axis=-1).mean(axis=0))
+        return outputs.mean(axis=0)
+
+    def __call__(self, images, forward_fn):
+        """
+        Args:
+            images (paddle.Tensor): [N, C, H, W] images.
+            forward_fn (callable): forward of a batch of views.
+
+        Returns:
+            the fused outputs of forward_fn for the N images.
+        """
+        batch_size = images.shape[0]
+        outputs = [forward_fn(views) for views in self.expand(images)]
+        return self.fuse(_concat(outputs), batch_size)
+
+    def __repr__(self):
+        return (f"TTA(views={self.num_views}, flip={self.flip}, "
+                f"crop_size={self.crop_size}, num_crops={self.num_crops}, "
+                f"scales={self.scales}, fusion={self.fusion})")
+
+
+def _concat(outputs):
+    if len(outputs) == 1:
+        return outputs[0]
+    if isinstance(outputs[0], dict):
+        return {k: _concat([x[k] for x in outputs]) for k in outputs[0]}
+    if isinstance(outputs[0], (list, tuple)):
+        return [_concat(list(x)) for x in zip(*outputs)]
+    return paddle.concat(outputs)
+
+
+def build_tta(config):
+    """TTA of the config, None if the config is None or keeps the images"""
+    if config is None:
+        return None
+    tta = TTA(**config)
+    if tta.num_views == 1 and tta.crop_size is None and tta.scales == [1.0]:
+        return None
+    logger.info(f"Use {tta}")
+    return tta
@@ -50,6 +50,19 @@ class CombinedMetrics(AvgMetrics):
             metric_dict.update(metric_func(*args, **kwargs))
         return metric_dict
 
+    @property
+    def reducible(self):
+        return all(
+            getattr(metric, "reducible", False)
+            for metric in self.metric_func_list)
+
+    @property
+    def meters(self):
+        return [
+            meter
+            for metric in self.metric_func_list for meter in metric.meters
+        ]
+
     @property
     def avg_info(self):
         return ", ".join([metric.avg_info for metric in self.metric_func_list])
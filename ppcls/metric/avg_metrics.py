@@ -1,7 +1,13 @@
 from paddle import nn
 
+from ppcls.utils.misc import all_reduce_meters
+
 
 class AvgMetrics(nn.Layer):
+    # the meters are sums over samples, so ranks can update them with their
+    # own samples and reduce them once by all_reduce
+    reducible = True
+
     def __init__(self):
         super().__init__()
         self.avg_meters = {}
@@ -15,6 +21,13 @@ class AvgMetrics(nn.Layer):
             for metric_key in self.avg_meters:
                 return self.avg_meters[metric_key].avg
 
+    @property
+    def meters(self):
+        return list(self.avg_meters.values())
+
+    def all_reduce(self):
+        all_reduce_meters(self.meters)
+
     @property
     def avg_info(self):
         return ", ".join([self.avg_meters[key].avg_info for key in self.avg_meters])
@@ -21,6 +21,7 @@ from sklearn.model_selection import KFold
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import normalize
 
+from ppcls.metric.threshold_sweep import sort_scores, count_less
 from ppcls.utils import logger
 
 
@@ -30,22 +31,23 @@ class FaceAccuracy(nn.Layer):
     """
     def __init__(self):
         super().__init__()
-        self.embedding_left_list = []
-        self.embedding_right_list = []
+        self.dist_list = []
         self.label_list = []
         self.best_acc = 0.
 
     def forward(self, embeddings_left, embeddings_right, labels, *args):
         assert len(embeddings_left) == len(embeddings_right) == len(labels)
-        self.embedding_left_list.append(normalize(embeddings_left.numpy()))
-        self.embedding_right_list.append(normalize(embeddings_right.numpy()))
+        # only the distances of the pairs are kept instead of the embeddings
+        self.dist_list.append(
+            self.pair_distance(
+                normalize(embeddings_left.numpy()),
+                normalize(embeddings_right.numpy())))
         self.label_list.append(labels.numpy())
 
         return {}
-    
+
     def reset(self):
-        self.embedding_left_list = []
-        self.embedding_right_list = []
+        self.dist_list = []
         self.label_list = []
         self.best_acc = 0.
 
@@ -55,20 +57,22 @@ class FaceAccuracy(nn.Layer):
 
     @property
     def avg_info(self):
-        embeddings_left = np.concatenate(self.embedding_left_list)
-        embeddings_right = np.concatenate(self.embedding_right_list)
-        labels = np.concatenate(self.label_list) 
-        num_samples = len(embeddings_left)
+        dist = np.concatenate(self.dist_list)
+        labels = np.concatenate(self.label_list)
+        num_samples = len(dist)
 
         thresholds = np.arange(0, 4, 0.01)
-        _, _, accuracy, best_thresholds = self.calculate_roc(thresholds, 
-                                                             embeddings_left,
-                                                             embeddings_right,
-                                                             labels)
+        _, _, accuracy, best_thresholds = self.calculate_roc_by_dist(
+            thresholds, dist, labels)
         self.best_acc = accuracy.mean()
         return "best_threshold: {:.4f}, acc: {:.4f}, num_samples: {}".format(
             best_thresholds.mean(), accuracy.mean(), num_samples)
-        
+
+    @staticmethod
+    def pair_distance(embeddings1, embeddings2):
+        diff = np.subtract(embeddings1, embeddings2)
+        return np.sum(np.square(diff), 1)
+
     @staticmethod
     def calculate_roc(thresholds,
                       embeddings1,
@@ -78,7 +82,38 @@ class FaceAccuracy(nn.Layer):
                       pca=0):
         assert (embeddings1.shape[0] == embeddings2.shape[0])
         assert (embeddings1.shape[1] == embeddings2.shape[1])
+        if pca == 0:
+            return FaceAccuracy.calculate_roc_by_dist(
+                thresholds,
+                FaceAccuracy.pair_distance(embeddings1, embeddings2),
+                actual_issame, nrof_folds)
+
+        def fold_dist(fold_idx, train_set):
+            print('doing pca on', fold_idx)
+            embed1_train = embeddings1[train_set]
+            embed2_train = embeddings2[train_set]
+            _embed_train = np.concatenate((embed1_train, embed2_train), axis=0)
+            pca_model = PCA(n_components=pca)
+            pca_model.fit(_embed_train)
+            embed1 = normalize(pca_model.transform(embeddings1))
+            embed2 = normalize(pca_model.transform(embeddings2))
+            return FaceAccuracy.pair_distance(embed1, embed2)
+
         nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
+        return FaceAccuracy.calculate_roc_by_dist(
+            thresholds, fold_dist, actual_issame[:nrof_pairs], nrof_folds)
+
+    @staticmethod
+    def calculate_roc_by_dist(thresholds, dist, actual_issame, nrof_folds=10):
+        """
+        k-fold roc of the pair distances. The accuracy of every threshold is
+        computed at once from the sorted distances of every fold, and
+        `dist` can also be a function of (fold_idx, train_set) returning the
+        distances of the fold.
+        """
+        nrof_pairs = len(actual_issame)
+        if not callable(dist):
+            nrof_pairs = min(nrof_pairs, len(dist))
         nrof_thresholds = len(thresholds)
         k_fold = KFold(n_splits=nrof_folds, shuffle=False)
 
@@ -87,47 +122,72 @@ class FaceAccuracy(nn.Layer):
         accuracy = np.zeros((nrof_folds))
         best_thresholds = np.zeros((nrof_folds))
         indices = np.arange(nrof_pairs)
-        # print('pca', pca)
-        dist = None
+        folds = list(k_fold.split(indices))
 
-        if pca == 0:
-            diff = np.subtract(embeddings1, embeddings2)
-            dist = np.sum(np.square(diff), 1)
-
-        for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):
-            if pca > 0:
-                print('doing pca on', fold_idx)
-                embed1_train = embeddings1[train_set]
-                embed2_train = embeddings2[train_set]
-                _embed_train = np.concatenate((embed1_train, embed2_train), axis=0)
-                pca_model = PCA(n_components=pca)
-                pca_model.fit(_embed_train)
-                embed1 = pca_model.transform(embeddings1)
-                embed2 = pca_model.transform(embeddings2)
-                embed1 = normalize(embed1)
-                embed2 = normalize(embed2)
-                diff = np.subtract(embed1, embed2)
-                dist = np.sum(np.square(diff), 1)
+        if not callable(dist):
+            # the test sets split the pairs, so the counts of a train set are
+            # the total counts minus those of its test set and every distance
+            # is sorted only once
+            test_counts = [
+                FaceAccuracy.count_issame(thresholds, dist[test_set],
+                                          actual_issame[test_set])
+                for _, test_set in folds
+            ]
+            total_counts = np.sum(test_counts, axis=0)
+
+        for fold_idx, (train_set, test_set) in enumerate(folds):
+            if callable(dist):
+                fold_dist = dist(fold_idx, train_set)
+                train_counts = FaceAccuracy.count_issame(
+                    thresholds, fold_dist[train_set],
+                    actual_issame[train_set])
+                counts = FaceAccuracy.count_issame(
+                    thresholds, fold_dist[test_set], actual_issame[test_set])
+            else:
+                counts = test_counts[fold_idx]
+                train_counts = total_counts - counts
 
             # Find the best threshold for the fold
-            acc_train = np.zeros((nrof_thresholds))
-            for threshold_idx, threshold in enumerate(thresholds):
-                _, _, acc_train[threshold_idx] = FaceAccuracy.calculate_accuracy(
-                    threshold, dist[train_set], actual_issame[train_set])
+            _, _, acc_train = FaceAccuracy.counts_to_accuracy(train_counts)
             best_threshold_index = np.argmax(acc_train)
             best_thresholds[fold_idx] = thresholds[best_threshold_index]
-            for threshold_idx, threshold in enumerate(thresholds):
-                tprs[fold_idx, threshold_idx], fprs[
-                    fold_idx, threshold_idx], _ = FaceAccuracy.calculate_accuracy(
-                        threshold, dist[test_set], actual_issame[test_set])
-            _, _, accuracy[fold_idx] = FaceAccuracy.calculate_accuracy(
-                thresholds[best_threshold_index], dist[test_set],
-                actual_issame[test_set])
+            tprs[fold_idx], fprs[fold_idx], acc_test = \
+                FaceAccuracy.counts_to_accuracy(counts)
+            accuracy[fold_idx] = acc_test[best_threshold_index]
 
         tpr = np.mean(tprs, 0)
         fpr = np.mean(fprs, 0)
         return tpr, fpr, accuracy, best_thresholds
 
+    @staticmethod
+    def count_issame(thresholds, dist, actual_issame):
+        """
+        [4, num_thresholds] counts of (tp, fp, positive, negative) pairs
+        predicted same by dist < threshold at every threshold
+        """
+        actual_issame = np.asarray(actual_issame).astype(bool)
+        pos_dist, pos_thresholds = sort_scores(dist[actual_issame],
+                                               thresholds)
+        neg_dist, neg_thresholds = sort_scores(dist[~actual_issame],
+                                               thresholds)
+        num_pos = np.count_nonzero(actual_issame)
+        num_neg = len(dist) - num_pos
+        return np.stack([
+            count_less(pos_dist, pos_thresholds),
+            count_less(neg_dist, neg_thresholds),
+            np.full(len(thresholds), num_pos),
+            np.full(len(thresholds), num_neg)
+        ])
+
+    @staticmethod
+    def counts_to_accuracy(counts):
+        """tpr, fpr and acc of every threshold, as calculate_accuracy"""
+        tp, fp, num_pos, num_neg = counts
+        tn = num_neg - fp
+        tpr = np.where(num_pos == 0, 0., tp / np.maximum(num_pos, 1))
+        fpr = np.where(num_neg == 0, 0., fp / np.maximum(num_neg, 1))
+        acc = (tp + tn) / (num_pos + num_neg)
+        return tpr, fpr, acc
 
     @staticmethod
     def calculate_accuracy(threshold, dist, actual_issame):
@@ -158,24 +218,23 @@ class FaceAccOnFiveDatasets(FaceAccuracy):
     def __init__(self):
         super().__init__()
         self.dataname_idx_list = []
-    
-    def forward(self, embeddings_left, embeddings_right, labels, 
+
+    def forward(self, embeddings_left, embeddings_right, labels,
                 dataname_idxs, *args):
         assert len(embeddings_left) == len(dataname_idxs)
         dataname_idxs = dataname_idxs.astype('int64').numpy()
         self.dataname_idx_list.append(dataname_idxs)
 
         return super().forward(embeddings_left, embeddings_right, labels)
-    
+
     def reset(self):
         super().reset()
         self.dataname_idx_list = []
-    
+
     @property
     def avg_info(self):
         results = {}
-        all_embeddings_left = np.concatenate(self.embedding_left_list)
-        all_embeddings_right = np.concatenate(self.embedding_right_list)
+        all_dist = np.concatenate(self.dist_list)
         all_labels = np.concatenate(self.label_list)
         dataname_idxs = np.concatenate(self.dataname_idx_list)
 
@@ -183,17 +242,16 @@ class FaceAccOnFiveDatasets(FaceAccuracy):
         for dataname_idx in np.unique(dataname_idxs):
             dataname = self.idx_to_dataname[dataname_idx]
             mask = dataname_idxs == dataname_idx
-            embeddings_left = all_embeddings_left[mask]
-            embeddings_right = all_embeddings_right[mask]
+            dist = all_dist[mask]
             labels = all_labels[mask]
 
             thresholds = np.arange(0, 4, 0.01)
-            _, _, accuracy, best_thresholds = self.calculate_roc(
-                thresholds, embeddings_left, embeddings_right, labels)
+            _, _, accuracy, best_thresholds = self.calculate_roc_by_dist(
+                thresholds, dist, labels)
             acc.append(accuracy.mean())
             results[f'{dataname}-best_threshold'] = f'{best_thresholds.mean():.4f}'
             results[f'{dataname}-acc'] = f'{accuracy.mean():.4f}'
-            results[f'{dataname}-num_samples'] = f'{len(embeddings_left)}'
+            results[f'{dataname}-num_samples'] = f'{len(dist)}'
         self.best_acc = np.mean(acc)
         results['avg_acc'] = f'{self.best_acc:.4f}'
 
@@ -13,6 +13,9 @@
 # limitations under the License.
 
 from cmath import nan
+import math
+import multiprocessing
+
 import numpy as np
 import paddle
 import paddle.nn as nn
@@ -26,6 +29,7 @@ from sklearn.preprocessing import binarize
 from easydict import EasyDict
 
 from ppcls.metric.avg_metrics import AvgMetrics
+from ppcls.metric.threshold_sweep import sort_scores, count_greater
 from ppcls.utils.misc import AverageMeter, AttrMeter
 from ppcls.utils import logger
 
@@ -164,8 +168,8 @@ class mINP(nn.Layer):
 class TprAtFpr(nn.Layer):
     def __init__(self, max_fpr=1 / 1000.):
         super().__init__()
-        self.gt_pos_score_list = []
-        self.gt_neg_score_list = []
+        self.score_list = []
+        self.label_list = []
         self.softmax = nn.Softmax(axis=-1)
         self.max_fpr = max_fpr
         self.max_tpr = 0.
@@ -174,16 +178,14 @@ class TprAtFpr(nn.Layer):
         if isinstance(x, dict):
             x = x["logits"]
         x = self.softmax(x)
-        for i, label_i in enumerate(label):
-            if label_i[0] == 0:
-                self.gt_neg_score_list.append(x[i][1].numpy())
-            else:
-                self.gt_pos_score_list.append(x[i][1].numpy())
+        # keep the scores on device, they are moved to host once in avg_info
+        self.score_list.append(x[:, 1])
+        self.label_list.append(label[:, 0])
         return {}
 
     def reset(self):
-        self.gt_pos_score_list = []
-        self.gt_neg_score_list = []
+        self.score_list = []
+        self.label_list = []
         self.max_tpr = 0.
 
     @property
@@ -194,26 +196,43 @@ class TprAtFpr(nn.Layer):
     def avg_info(self):
         max_tpr = 0.
         result = ""
-        gt_pos_score_list = np.array(self.gt_pos_score_list)
-        gt_neg_score_list = np.array(self.gt_neg_score_list)
-        for i in range(0, 10000):
-            threshold = i / 10000.
-            if len(gt_pos_score_list) == 0:
-                continue
-            tpr = np.sum(
-                gt_pos_score_list > threshold) / len(gt_pos_score_list)
-            if len(gt_neg_score_list) == 0 and tpr > max_tpr:
-                max_tpr = tpr
+        if len(self.score_list) == 0:
+            self.max_tpr = max_tpr
+            return result
+        scores = paddle.concat(self.score_list).numpy()
+        labels = paddle.concat(self.label_list).numpy()
+        gt_pos_scores = scores[labels != 0]
+        gt_neg_scores = scores[labels == 0]
+        if len(gt_pos_scores) == 0:
+            self.max_tpr = max_tpr
+            return result
+
+        # the python float thresholds i / 10000. of all the steps at once
+        thresholds = (np.arange(0, 10000) / 10000.).tolist()
+        sorted_scores, sorted_thresholds = sort_scores(gt_pos_scores,
+                                                       thresholds)
+        tpr = count_greater(sorted_scores,
+                            sorted_thresholds) / len(gt_pos_scores)
+        if len(gt_neg_scores) == 0:
+            feasible = np.ones(len(thresholds), dtype=bool)
+        else:
+            sorted_scores, sorted_thresholds = sort_scores(gt_neg_scores,
+                                                           thresholds)
+            fpr = count_greater(sorted_scores,
+                                sorted_thresholds) / len(gt_neg_scores)
+            feasible = fpr <= self.max_fpr
+        # the first threshold reaching the max tpr of the feasible ones
+        if feasible.any() and tpr[feasible].max() > max_tpr:
+            index = np.argmax(feasible & (tpr == tpr[feasible].max()))
+            max_tpr = tpr[index]
+            if len(gt_neg_scores) == 0:
                 result = "threshold: {}, fpr: 0.0, tpr: {:.5f}".format(
-                    threshold, tpr)
+                    thresholds[index], max_tpr)
                 msg = f"The number of negative samples is 0, please add negative samples."
                 logger.warning(msg)
-            fpr = np.sum(
-                gt_neg_score_list > threshold) / len(gt_neg_score_list)
-            if fpr <= self.max_fpr and tpr > max_tpr:
-                max_tpr = tpr
+            else:
                 result = "threshold: {}, fpr: {}, tpr: {:.5f}".format(
-                    threshold, fpr, tpr)
+                    thresholds[index], fpr[index], max_tpr)
         self.max_tpr = max_tpr
         return result
 
@@ -519,6 +538,69 @@ class ATTRMetric(nn.Layer):
         return metric_dict
 
 
+def _class_ap(scores, gt_pos, map_type):
+    """
+    AP of every class of the [num_classes, N] scores, scores of a class which
+    are equal keep their order. Returns the APs and the gt count of the
+    classes.
+    """
+    num_classes = scores.shape[0]
+    gt_counts = gt_pos.sum(axis=1)
+    # descending, stable as the sorted(reverse=True) of the records
+    order = np.argsort(-scores, axis=1, kind="stable")
+    pos = np.take_along_axis(gt_pos, order, axis=1)
+    accum_tp = np.cumsum(pos, axis=1)
+    ranks = np.arange(1, scores.shape[1] + 1)
+    precision = accum_tp / ranks
+    recall = accum_tp / np.maximum(gt_counts, 1)[:, None]
+    aps = np.zeros(num_classes)
+    if map_type == '11point':
+        # max precision at recall >= j / 10. from the suffix max of precision
+        suffix_max = np.maximum.accumulate(
+            precision[:, ::-1], axis=1)[:, ::-1]
+        suffix_max = np.concatenate(
+            [suffix_max, np.zeros([num_classes, 1])], axis=1)
+        max_precisions = np.zeros([num_classes, 11])
+        for class_idx in np.nonzero(gt_counts)[0]:
+            start = np.searchsorted(
+                recall[class_idx],
+                np.arange(11, dtype=np.float64) / 10.,
+                side="left")
+            max_precisions[class_idx] = suffix_max[class_idx, start]
+        # sum in the order of the recall points
+        aps = np.cumsum(max_precisions, axis=1)[:, -1] / 11.
+    elif map_type == 'integral':
+        # recall only grows at positive rows, by the gap to the previous one
+        prev_recall = np.maximum(accum_tp - 1, 0) / np.maximum(gt_counts,
+                                                               1)[:, None]
+        recall_gap = np.where(pos, recall - prev_recall, 0.)
+        aps = np.cumsum(precision * recall_gap, axis=1)[:, -1]
+        # a gap of 1 / gt_count too small to count is merged into the next
+        for class_idx in np.nonzero(
+            (gt_counts > 0) &
+            ((recall_gap <= 1e-6) & pos).any(axis=1))[0]:
+            aps[class_idx] = _integral_ap(precision[class_idx],
+                                          recall[class_idx])
+    else:
+        raise NotImplementedError(f"Unsupported mAP type {map_type}")
+    return aps, gt_counts
+
+
+def _integral_ap(precision, recall):
+    one_class_ap = 0.0
+    prev_recall = 0.
+    for i in range(len(precision)):
+        recall_gap = math.fabs(recall[i] - prev_recall)
+        if recall_gap > 1e-6:
+            one_class_ap += precision[i] * recall_gap
+            prev_recall = recall[i]
+    return one_class_ap
+
+
+def _class_ap_task(args):
+    return _class_ap(*args)
+
+
 class MultiLabelMAP(nn.Layer):
     """
     Calculate multi-label classification mean average precision.
@@ -527,107 +609,81 @@ class MultiLabelMAP(nn.Layer):
     The code base on:
     https://github.com/PaddlePaddle/PaddleDetection/blob/develop/ppdet/metrics/map_utils.py
 
+    The scores and labels of all batches are kept in growable numpy buffers
+    and the AP of the classes is computed in chunks of classes, each with one
+    argsort per class and cumsum based precision/recall.
+
     Args:
         map_type (str): Calculation method of mean average.
+        class_chunk_size (int): number of classes computed at once.
+        num_workers (int): number of processes computing chunks of classes
+            in parallel, 0 to compute in the current process.
     """
 
-    def __init__(self, map_type='integral'):
+    def __init__(self,
+                 map_type='integral',
+                 class_chunk_size=256,
+                 num_workers=0):
         super().__init__()
         assert map_type in ['11point', 'integral'], \
             "map_type currently only support '11point' and 'integral'"
         self.map_type = map_type
+        self.class_chunk_size = class_chunk_size
+        self.num_workers = num_workers
 
         self.reset()
 
     def reset(self):
         self.is_latest = True
-        self.class_score_poss = None
-        self.class_gt_counts = None
+        self.scores = None
+        self.gt_pos = None
+        self.num_samples = 0
         self.mAP = 0.0
 
-    def one_class_update(self, score, gt_label, class_idx):
-        topk_idx = np.argsort(score)[::-1]
-        topk_score = score[topk_idx]
-        topk_gt_label = gt_label[topk_idx]
-        for s, l in zip(topk_score, topk_gt_label):
-            if int(l) == 1:
-                self.class_score_poss[class_idx].append([s, 1.])
-                self.class_gt_counts[class_idx] += 1
-            else:
-                self.class_score_poss[class_idx].append([s, 0.])
-
-    @staticmethod
-    def get_tp_fp_accum(score_pos_list):
-        """
-        Calculate accumulating true/false positive results from
-        [score, pos] records
-        """
-        sorted_list = sorted(score_pos_list, key=lambda s: s[0], reverse=True)
-
-        accum_tp = 0
-        accum_fp = 0
-        accum_tp_list = []
-        accum_fp_list = []
-        for (score, pos) in sorted_list:
-            accum_tp += int(pos)
-            accum_tp_list.append(accum_tp)
-            accum_fp += 1 - int(pos)
-            accum_fp_list.append(accum_fp)
-
-        return accum_tp_list, accum_fp_list
+    def _append(self, scores, gt_pos):
+        if self.scores is None:
+            self.scores = np.empty(
+                [max(len(scores), 1024), scores.shape[1]],
+                dtype=scores.dtype)
+            self.gt_pos = np.empty(self.scores.shape, dtype=bool)
+        end = self.num_samples + len(scores)
+        if end > len(self.scores):
+            capacity = max(end, 2 * len(self.scores))
+            self.scores = np.resize(self.scores,
+                                    [capacity, self.scores.shape[1]])
+            self.gt_pos = np.resize(self.gt_pos,
+                                    [capacity, self.gt_pos.shape[1]])
+        self.scores[self.num_samples:end] = scores
+        self.gt_pos[self.num_samples:end] = gt_pos
+        self.num_samples = end
 
     def compute_mAP(self):
         if not self.is_latest:
+            scores = self.scores[:self.num_samples]
+            gt_pos = self.gt_pos[:self.num_samples]
+            num_classes = scores.shape[1]
+            tasks = []
+            for start in range(0, num_classes, self.class_chunk_size):
+                end = start + self.class_chunk_size
+                # class-major, so that every class is a contiguous row
+                tasks.append((np.ascontiguousarray(scores[:, start:end].T),
+                              np.ascontiguousarray(gt_pos[:, start:end].T),
+                              self.map_type))
+            if self.num_workers > 0 and len(tasks) > 1:
+                with multiprocessing.get_context("spawn").Pool(
+                        min(self.num_workers, len(tasks))) as pool:
+                    results = pool.map(_class_ap_task, tasks)
+            else:
+                results = [_class_ap(*task) for task in tasks]
+
             mAP = 0.
             valid_cnt = 0
-            for score_pos, count in zip(self.class_score_poss,
-                                        self.class_gt_counts):
-                if count == 0:
-                    continue
-
-                if len(score_pos) == 0:
-                    valid_cnt += 1
-                    continue
-
-                accum_tp_list, accum_fp_list = \
-                    self.get_tp_fp_accum(score_pos)
-                precision = []
-                recall = []
-                for ac_tp, ac_fp in zip(accum_tp_list, accum_fp_list):
-                    precision.append(float(ac_tp) / (ac_tp + ac_fp))
-                    recall.append(float(ac_tp) / count)
-
-                one_class_ap = 0.0
-                if self.map_type == '11point':
-                    max_precisions = [0.] * 11
-                    start_idx = len(precision) - 1
-                    for j in range(10, -1, -1):
-                        for i in range(start_idx, -1, -1):
-                            if recall[i] < float(j) / 10.:
-                                start_idx = i
-                                if j > 0:
-                                    max_precisions[j - 1] = max_precisions[j]
-                                    break
-                            else:
-                                if max_precisions[j] < precision[i]:
-                                    max_precisions[j] = precision[i]
-                    one_class_ap = sum(max_precisions) / 11.
+            for aps, gt_counts in results:
+                for one_class_ap, count in zip(aps, gt_counts):
+                    if count == 0:
+                        continue
                     mAP += one_class_ap
                     valid_cnt += 1
-                elif self.map_type == 'integral':
-                    import math
-                    prev_recall = 0.
-                    for i in range(len(precision)):
-                        recall_gap = math.fabs(recall[i] - prev_recall)
-                        if recall_gap > 1e-6:
-                            one_class_ap += precision[i] * recall_gap
-                            prev_recall = recall[i]
-                    mAP += one_class_ap
-                    valid_cnt += 1
-                else:
-                    raise NotImplementedError(
-                        f"Unsupported mAP type {self.map_type}")
-
             self.mAP = mAP / float(valid_cnt) if valid_cnt > 0 else mAP
 
             self.is_latest = True
@@ -636,15 +692,13 @@ class MultiLabelMAP(nn.Layer):
         scores = F.sigmoid(output).numpy()
         gt_labels = target.numpy()
 
-        if self.class_score_poss is None:
-            self.class_score_poss = [[] for _ in range(scores.shape[-1])]
-        if self.class_gt_counts is None:
-            self.class_gt_counts = [0] * scores.shape[-1]
-
-        for class_idx in range(scores.shape[-1]):
-            score = scores[:, class_idx]
-            gt_label = gt_labels[:, class_idx]
-            self.one_class_update(score, gt_label, class_idx)
+        # rows of a batch in the order of its per-class argsort, so that rows
+        # of equal score keep the order they are ranked in
+        topk_idx = np.argsort(scores, axis=0)[::-1]
+        self._append(
+            np.take_along_axis(scores, topk_idx, axis=0),
+            np.take_along_axis(gt_labels, topk_idx, axis=0).astype(np.int64)
+            == 1)
 
         self.is_latest = False
 
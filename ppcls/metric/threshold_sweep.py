@@ -0,0 +1,56 @@
+# copyright (c) 2022 PaddlePaddle Authors. All Rights Reserve.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Threshold sweeps of the verification metrics(TprAtFpr, FaceAccuracy). The
+scores are sorted once and the number of scores on either side of every
+threshold is found by binary search, instead of a full pass per threshold.
+The counts are exactly those of comparing the scores with each threshold.
+"""
+
+import numpy as np
+
+
+def sort_scores(scores, thresholds):
+    """
+    Sort the scores in the dtype numpy compares them with a threshold in,
+    e.g. float32 scores are compared with python float thresholds in
+    float32. NaN scores are dropped as they compare false with any threshold.
+
+    Args:
+        scores: array of scores.
+        thresholds: np.ndarray of thresholds, compared as numpy scalars, or a
+            list of python float thresholds.
+
+    Returns:
+        tuple: (sorted scores, thresholds in the same dtype)
+    """
+    scores = np.asarray(scores).reshape([-1])
+    dtype = scores.dtype
+    if len(thresholds) > 0:
+        dtype = np.result_type(scores, thresholds[0])
+    scores = np.sort(scores.astype(dtype, copy=False))
+    if scores.size > 0 and np.isnan(scores[-1]):
+        scores = scores[:np.searchsorted(scores, np.nan, side="left")]
+    return scores, np.asarray(thresholds).astype(dtype)
+
+
+def count_less(sorted_scores, thresholds):
+    """number of sorted scores < threshold for every threshold"""
+    return np.searchsorted(sorted_scores, thresholds, side="left")
+
+
+def count_greater(sorted_scores, thresholds):
+    """number of sorted scores > threshold for every threshold"""
+    return len(sorted_scores) - np.searchsorted(
+        sorted_scores, thresholds, side="right")
@@ -14,7 +14,7 @@
 
 import paddle
 
-__all__ = ['AverageMeter']
+__all__ = ['AverageMeter', 'all_reduce_meters']
 
 
 class AverageMeter(object):
@@ -71,6 +71,24 @@ class AverageMeter(object):
             self=self)
 
 
+def all_reduce_meters(meters):
+    """
+    Sum the sum and count of the AverageMeters over all ranks in one
+    all_reduce, so that their avg is the average of all samples. Every rank
+    must pass the same meters in the same order.
+    """
+    if len(meters) == 0:
+        return
+    state = paddle.to_tensor(
+        [[float(meter.sum), float(meter.count)] for meter in meters],
+        dtype="float64")
+    paddle.distributed.all_reduce(state)
+    for meter, (total, count) in zip(meters, state.numpy().tolist()):
+        meter.sum = total
+        meter.count = count
+        meter.avg = total / count if count > 0 else 0
+
+
 class AttrMeter(object):
     """
     Computes and stores the average and current value
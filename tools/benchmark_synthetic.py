@@ -0,0 +1,217 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run training steps of any config on synthetic data served from memory, and
+report the compute throughput and the time of every part of a step, to tell
+a regression of the model or the optimizer from one of the input pipeline:
+
+    python tools/benchmark_synthetic.py \
+        -c ppcls/configs/ImageNet/ResNet/ResNet50.yaml --steps 100
+
+The model, loss, optimizer and AMP of the config are used, the train data is
+replaced by SyntheticDataset with the batch size of DataLoader.Train.sampler.
+Batches are kept on the device by default, use --use_dataloader to serve
+them by paddle.io.DataLoader with --num_workers instead. The device is
+synchronized between the parts of a step to time them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import copy
+import os
+import sys
+import time
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(__dir__, '../')))
+
+import paddle
+
+from ppcls.utils import config, logger
+from ppcls.utils.misc import AverageMeter
+from ppcls.engine.engine import Engine
+from ppcls.engine.train.train import forward
+
+TIME_KEYS = [
+    "reader_cost", "forward_cost", "backward_cost", "optimizer_cost",
+    "batch_cost"
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("synthetic data benchmark script")
+    parser.add_argument(
+        '-c',
+        '--config',
+        type=str,
+        default='configs/config.yaml',
+        help='config file path')
+    parser.add_argument(
+        '-o',
+        '--override',
+        action='append',
+        default=[],
+        help='config options to be overridden')
+    parser.add_argument(
+        '--steps', type=int, default=100, help='number of timed steps')
+    parser.add_argument(
+        '--warmup', type=int, default=10, help='number of untimed steps')
+    parser.add_argument(
+        '--image_shape',
+        type=int,
+        nargs=3,
+        default=[3, 224, 224],
+        help='C H W of the images')
+    parser.add_argument(
+        '--dtype',
+        type=str,
+        default='float32',
+        choices=['float32', 'float16', 'uint8'],
+        help='dtype of the images')
+    parser.add_argument(
+        '--class_num',
+        type=int,
+        default=None,
+        help='number of classes, Arch.class_num or Arch.Head.class_num by '
+        'default')
+    parser.add_argument(
+        '--use_dataloader',
+        action='store_true',
+        help='serve the data by paddle.io.DataLoader')
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=0,
+        help='num_workers of paddle.io.DataLoader')
+    return parser.parse_args()
+
+
+def synthetic_config(config, args):
+    """the config with the train data replaced by SyntheticDataset"""
+    config = copy.deepcopy(config)
+    global_config = config["Global"]
+    global_config["eval_during_train"] = False
+    global_config["use_visualdl"] = False
+    global_config["use_dali"] = False
+    global_config.pop("iter_per_epoch", None)
+
+    data_config = config["DataLoader"]
+    data_config.pop("UnLabelTrain", None)
+    batch_size = data_config["Train"]["sampler"]["batch_size"]
+    class_num = args.class_num or config["Arch"].get(
+        "class_num", None) or (config["Arch"].get("Head", None) or
+                               {}).get("class_num", 1000)
+    data_config["Train"] = {
+        "dataset": {
+            "name": "SyntheticDataset",
+            "num_samples": batch_size * paddle.distributed.get_world_size() *
+            (args.warmup + args.steps),
+            "image_shape": args.image_shape,
+            "class_num": class_num,
+            "dtype": args.dtype,
+            "multilabel": global_config.get("use_multilabel", False)
+        },
+        "sampler": {
+            "batch_size": batch_size,
+            "drop_last": True,
+            "shuffle": False
+        },
+        "loader": {
+            "num_workers": args.num_workers,
+            "use_shared_memory": False,
+            "synthetic_batches": not args.use_dataloader
+        }
+    }
+    return config
+
+
+def synchronize(engine):
+    if engine.config["Global"]["device"] == "gpu":
+        paddle.device.cuda.synchronize()
+
+
+def benchmark(engine, steps, warmup):
+    engine.model.train()
+    time_info = {key: AverageMeter(key, ".5f") for key in TIME_KEYS}
+    print_batch_step = engine.config["Global"]["print_batch_step"]
+    dataloader_iter = iter(engine.train_dataloader)
+    for step in range(warmup + steps):
+        if step == warmup:
+            for key in time_info:
+                time_info[key].reset()
+        tic = time.time()
+        batch = next(dataloader_iter)
+        batch_size = batch[0].shape[0]
+        if not engine.config["Global"].get("use_multilabel", False):
+            batch[1] = batch[1].reshape([batch_size, -1])
+        synchronize(engine)
+        reader_toc = time.time()
+
+        with engine.auto_cast(is_eval=False):
+            out = forward(engine, batch)
+            loss_dict = engine.train_loss_func(out, batch[1])
+        synchronize(engine)
+        forward_toc = time.time()
+
+        engine.scaler.scale(loss_dict["loss"]).backward()
+        synchronize(engine)
+        backward_toc = time.time()
+
+        for i in range(len(engine.optimizer)):
+            engine.scaler.step(engine.optimizer[i])
+            engine.scaler.update()
+            engine.optimizer[i].clear_grad()
+        for i in range(len(engine.lr_sch)):
+            if not getattr(engine.lr_sch[i], "by_epoch", False):
+                engine.lr_sch[i].step()
+        if engine.ema:
+            engine.model_ema.update(engine.model)
+        synchronize(engine)
+        toc = time.time()
+
+        time_info["reader_cost"].update(reader_toc - tic)
+        time_info["forward_cost"].update(forward_toc - reader_toc)
+        time_info["backward_cost"].update(backward_toc - forward_toc)
+        time_info["optimizer_cost"].update(toc - backward_toc)
+        time_info["batch_cost"].update(toc - tic)
+        if step % print_batch_step == 0:
+            logger.info("[Benchmark][Step {}/{}] loss: {:.5f}, {}".format(
+                step, warmup + steps,
+                float(loss_dict["loss"]), ", ".join(
+                    "{}: {:.5f}s".format(key, time_info[key].avg)
+                    for key in time_info)))
+    return time_info, batch_size
+
+
+def main(args, config):
+    engine = Engine(synthetic_config(config, args), mode="train")
+    time_info, batch_size = benchmark(engine, args.steps, args.warmup)
+    batch_cost = time_info["batch_cost"].avg
+    world_size = paddle.distributed.get_world_size()
+    logger.info("[Benchmark][Avg] {}".format(", ".join(
+        "{}: {:.5f}s({:.1%})".format(key, time_info[key].avg, time_info[
+            key].avg / batch_cost) for key in TIME_KEYS[:-1])))
+    logger.info(
+        "[Benchmark][Avg] batch_cost: {:.5f}s, batch_size: {} x {} cards, "
+        "ips: {:.5f} samples/s, {:.5f} samples/s per card".format(
+            batch_cost, batch_size, world_size, batch_size * world_size /
+            batch_cost, batch_size / batch_cost))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = config.get_config(
+        args.config, overrides=args.override, show=False)
+    main(args, config)
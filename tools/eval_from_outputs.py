@@ -0,0 +1,75 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Recompute the eval metrics from the raw outputs stored by eval, without
+building the model or reading images.
+
+Eval with Global.eval_output_dir set stores the outputs of the checkpoint in
+a sub directory named by the hash of the parameters and the eval config:
+
+    python tools/eval.py -c config.yaml -o Global.eval_output_dir=./eval_outputs
+
+Then the metrics, loss and retrieval settings(e.g. Metric.Eval,
+Global.feature_normalize, Global.re_ranking) can be changed and evaluated
+again from the stored outputs:
+
+    python tools/eval_from_outputs.py -c config.yaml \
+        --outputs ./eval_outputs/<key> -o Global.re_ranking=True
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(__dir__, '../')))
+
+import paddle
+
+from ppcls.utils import config, logger
+from ppcls.engine.evaluation.output_store import OfflineEvalEngine
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("eval from stored outputs script")
+    parser.add_argument(
+        '-c',
+        '--config',
+        type=str,
+        default='configs/config.yaml',
+        help='config file path')
+    parser.add_argument(
+        '-o',
+        '--override',
+        action='append',
+        default=[],
+        help='config options to be overridden')
+    parser.add_argument(
+        '--outputs',
+        type=str,
+        required=True,
+        help='directory of the eval outputs of a checkpoint')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = config.get_config(
+        args.config, overrides=args.override, show=False)
+    logger.init_logger()
+    paddle.set_device(config["Global"].get("device", "cpu"))
+    engine = OfflineEvalEngine(config, args.outputs)
+    engine.eval()
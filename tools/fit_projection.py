@@ -0,0 +1,102 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Fit a PCA(-whitening) projection of retrieval features to a lower dimension.
+
+The projection is fitted from the gallery features extracted by
+build_gallery.py(or the features of --features .npy) and saved as
+projection.npz next to the index:
+
+    python tools/fit_projection.py -c deploy/configs/inference_general.yaml \
+        --dim 128 --whiten
+
+Then set IndexProcess.use_projection to True and IndexProcess.embedding_size
+to the projected dim, and build the gallery again: the cached raw features
+are reused and projected, and RecPredictor projects the query features. For
+evaluation, set Global.feature_projection of the training config to the
+saved file.
+"""
+import numpy as np
+from paddleclas.deploy.python.build_gallery import load_gallery_features
+from paddleclas.deploy.utils import config, logger
+from paddleclas.deploy.utils.projection import Projection, get_projection_path
+
+
+def parse_args():
+    parser = config.parser()
+    parser.add_argument(
+        '--dim', type=int, required=True, help="dim of projected features")
+    parser.add_argument(
+        '--whiten',
+        action='store_true',
+        help="scale every principal axis to unit variance")
+    parser.add_argument(
+        '--no_normalize',
+        action='store_true',
+        help="do not L2-normalize the projected features")
+    parser.add_argument(
+        '--features',
+        type=str,
+        default=None,
+        help="npy file of features to fit, the gallery features by default")
+    parser.add_argument(
+        '--max_samples',
+        type=int,
+        default=100000,
+        help="number of features to fit with, 0 for all")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--output',
+        type=str,
+        default=None,
+        help="path to save, IndexProcess.projection_file or projection.npz "
+        "in index_dir by default")
+    return parser.parse_args()
+
+
+def load_features(args, index_config):
+    if args.features is not None:
+        features = np.load(args.features, mmap_mode="r")
+        rows = np.arange(features.shape[0])
+    else:
+        assert index_config.get("dist_type", "IP") != "hamming", \
+            "The projection does not support hamming dist_type"
+        features, valid = load_gallery_features(index_config)
+        rows = np.nonzero(valid)[0]
+    if args.max_samples > 0 and len(rows) > args.max_samples:
+        rng = np.random.RandomState(args.seed)
+        rows = np.sort(rng.choice(rows, args.max_samples, replace=False))
+    return np.asarray(features[rows], dtype=np.float32)
+
+
+def main(args, config):
+    index_config = config["IndexProcess"]
+    features = load_features(args, index_config)
+    projection, explained = Projection.fit(
+        features,
+        args.dim,
+        whiten=args.whiten,
+        normalize=not args.no_normalize)
+    output = args.output or get_projection_path(index_config)
+    projection.save(output)
+    logger.info(
+        "Fit the projection from {}-d to {}-d with {} features, explained "
+        "variance: {:.4f}, whiten: {}. Saved to {}".format(
+            projection.input_dim, projection.output_dim,
+            features.shape[0], explained, args.whiten, output))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args, config.get_config(args.config, overrides=args.override))
@@ -0,0 +1,316 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tune the index method and search parameters of a PP-ShiTu gallery.
+
+Every index method in --index_methods is built from the gallery features
+extracted by build_gallery.py, and searched with every nprobe(IVF),
+efSearch(HNSW) and rerank_k(compressed indexes) in the sweep. Recall@k is
+measured against an exact search, QPS and p99 latency on this host. The
+fastest Pareto-optimal setting which reaches --target_recall(and
+--max_p99_ms) is written back into the IndexProcess section of the config,
+the other lines and the comments of the config are kept:
+
+    python tools/tune_index.py -c deploy/configs/inference_general.yaml \
+        --query_features query_features.npy --query_labels query_labels.txt
+
+index_method, nlist and pq_m take effect when the gallery is built again,
+nprobe, ef_search and rerank_k when SystemPredictor loads the index.
+"""
+import json
+import re
+
+import numpy as np
+from paddleclas.deploy.python.benchmark_index import build_index, exact_search, index_memory, load_features, measure, sample_queries
+from paddleclas.deploy.python.build_gallery import split_datafile
+from paddleclas.deploy.utils import config, logger
+from paddleclas.deploy.utils.index_factory import RerankIndex, get_index_method
+from paddleclas.deploy.utils.index_version import set_search_params
+from paddleclas.deploy.utils.projection import load_projection
+
+# keys of IndexProcess written by the tuner
+TUNED_KEYS = ["index_method", "nlist", "pq_m", "nprobe", "ef_search",
+              "rerank_k"]
+
+
+def parse_args():
+    parser = config.parser()
+    parser.add_argument(
+        '--query_features',
+        type=str,
+        default=None,
+        help="npy file of query features, gallery features are sampled and "
+        "held out of the gallery if not set")
+    parser.add_argument(
+        '--query_labels',
+        type=str,
+        default=None,
+        help="label of every query, one per line")
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument(
+        '--index_methods',
+        type=str,
+        default="Flat,HNSW32,IVF,IVFSQ8,IVFPQ,OPQ")
+    parser.add_argument(
+        '--nprobes', type=str, default="1,2,4,8,16,32,64,128,256")
+    parser.add_argument('--ef_searches', type=str, default="16,32,64,128,256")
+    parser.add_argument('--rerank_ks', type=str, default="0,50,100,200")
+    parser.add_argument(
+        '--topk',
+        type=int,
+        default=None,
+        help="k of recall@k, IndexProcess.return_k by default")
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--target_recall', type=float, default=0.95)
+    parser.add_argument(
+        '--max_p99_ms', type=float, default=0, help="0 for no limit")
+    parser.add_argument('--max_gallery', type=int, default=0)
+    parser.add_argument('--max_train', type=int, default=100000)
+    parser.add_argument(
+        '--output_config',
+        type=str,
+        default=None,
+        help="config to write the choice to, the input config by default")
+    parser.add_argument(
+        '--dry_run',
+        action='store_true',
+        help="report the choice without writing the config")
+    return parser.parse_args()
+
+
+def parse_list(value):
+    return [int(x) for x in value.split(",") if x.strip()]
+
+
+def load_gallery_labels(index_config, rows):
+    delimiter = index_config.get("delimiter", "\t")
+    _, gallery_docs = split_datafile(index_config["data_file"],
+                                     index_config["image_root"], delimiter)
+    return np.array([gallery_docs[r].split(delimiter)[1] for r in rows])
+
+
+def label_accuracy(ids, gallery_labels, query_labels):
+    """top-1 accuracy of the label of the nearest gallery image"""
+    top1 = ids[:, 0]
+    correct = (top1 >= 0) & (gallery_labels[np.maximum(top1, 0)] ==
+                             query_labels)
+    return float(np.mean(correct))
+
+
+def candidates(method, factory, index, gallery, dist_type, args, topk):
+    """yield (search params, searcher) of the sweep of one index"""
+    if method.startswith("HNSW"):
+        for ef_search in parse_list(args.ef_searches):
+            if ef_search < topk:
+                continue
+            set_search_params(index, ef_search=ef_search)
+            yield {"ef_search": ef_search}, index
+    elif "IVF" in factory:
+        nlist = int(factory.split("IVF")[1].split(",")[0])
+        rerank_ks = [0]
+        if method != "IVF":
+            rerank_ks = [k for k in parse_list(args.rerank_ks) if k == 0 or
+                         k > topk]
+        for nprobe in parse_list(args.nprobes):
+            if nprobe > nlist:
+                continue
+            set_search_params(index, nprobe=nprobe)
+            for rerank_k in rerank_ks:
+                params = {"nprobe": nprobe}
+                if method == "IVF":
+                    yield params, index
+                    continue
+                params["rerank_k"] = rerank_k
+                if rerank_k > 0:
+                    yield params, RerankIndex(index, gallery, rerank_k,
+                                              dist_type)
+                else:
+                    yield params, index
+    else:
+        yield {}, index
+
+
+def pareto_front(results):
+    """results which no other result beats on both recall and qps"""
+    front = []
+    for result in sorted(results, key=lambda r: (-r["recall"], -r["qps"])):
+        if not front or result["qps"] > front[-1]["qps"]:
+            front.append(result)
+    return front
+
+
+def choose(front, target_recall, max_p99_ms=0):
+    feasible = [
+        r for r in front
+        if r["recall"] >= target_recall and (max_p99_ms <= 0 or r["p99_ms"]
+                                             <= max_p99_ms)
+    ]
+    if not feasible:
+        logger.warning(
+            "No setting reaches recall {} within the latency limit, choose the "
+            "one with the highest recall".format(target_recall))
+        return front[0]
+    return max(feasible, key=lambda r: r["qps"])
+
+
+def format_result(result):
+    params = ", ".join("{}={}".format(k, v)
+                       for k, v in sorted(result["params"].items()))
+    line = "{:<28}{:<28}{:>8.4f}{:>10.0f}{:>10.3f}{:>12.1f}".format(
+        result["factory"], params, result["recall"], result["qps"],
+        result["p99_ms"], result["memory"] / 1024**2)
+    if "label_acc" in result:
+        line += "{:>10.4f}".format(result["label_acc"])
+    return line
+
+
+def patch_index_config(text, values):
+    """
+    set `values` in the IndexProcess section of a yaml text and remove the
+    other TUNED_KEYS there, the other lines are kept as they are
+    """
+    lines = text.splitlines(keepends=True)
+    section = re.compile(r"^IndexProcess:\s*(#.*)?$")
+    start = next((i for i, line in enumerate(lines)
+                  if section.match(line.rstrip())), None)
+    if start is None:
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        lines.append("IndexProcess:\n")
+        start = len(lines) - 1
+    # the section ends at the next line starting at column 0
+    end = start + 1
+    while end < len(lines) and (not lines[end].strip() or
+                                lines[end][0] in " \t"):
+        end += 1
+    last = end
+    while last > start + 1 and not lines[last - 1].strip():
+        last -= 1
+
+    item = re.compile(r"^(\s+)(\w+):(\s*)([^#\n]*?)(\s+#[^\n]*)?(\n?)$")
+    indent = None
+    for line in lines[start + 1:last]:
+        match = item.match(line)
+        if match:
+            indent = match.group(1)
+            break
+    indent = indent or "  "
+
+    pending = dict(values)
+    patched = []
+    for line in lines[start + 1:last]:
+        match = item.match(line)
+        if match is None or match.group(1) != indent or match.group(
+                2) not in TUNED_KEYS:
+            patched.append(line)
+            continue
+        key = match.group(2)
+        if key in pending:
+            patched.append("{}{}: {}{}\n".format(indent, key,
+                                                  json.dumps(pending.pop(key)),
+                                                  match.group(5) or ""))
+    for key, value in pending.items():
+        patched.append("{}{}: {}\n".format(indent, key, json.dumps(value)))
+    return "".join(lines[:start + 1] + patched + lines[last:])
+
+
+def write_config(config_path, output_path, choice):
+    values = {"index_method": choice["method"]}
+    values.update(choice["build_params"])
+    values.update(choice["params"])
+    with open(config_path, "r", encoding="utf-8") as fd:
+        text = fd.read()
+    with open(output_path, "w", encoding="utf-8") as fd:
+        fd.write(patch_index_config(text, values))
+    logger.info("Write the tuned IndexProcess to {}: {}".format(output_path,
+                                                                values))
+
+
+def main(args, config):
+    index_config = config["IndexProcess"]
+    dist_type = index_config.get("dist_type", "IP")
+    assert dist_type != "hamming", "tuning of binary index is not supported"
+    topk = args.topk or index_config.get("return_k", 5)
+
+    projection = load_projection(index_config)
+    gallery, rows = load_features(index_config, args.max_gallery, projection)
+    if args.query_features is None:
+        logger.warning("--query_features is not set, hold out {} gallery "
+                       "features as queries".format(args.num_queries))
+    gallery, queries, gallery_rows = sample_queries(
+        gallery,
+        args.num_queries,
+        args.query_features,
+        projection=projection)
+    rows = rows[gallery_rows]
+    gt = exact_search(gallery, queries, topk, dist_type)
+    query_labels = gallery_labels = None
+    if args.query_labels is not None:
+        with open(args.query_labels, "r", encoding="utf-8") as fd:
+            query_labels = np.array(fd.read().splitlines())
+        assert len(query_labels) == len(queries), \
+            "the number of query labels and query features are different"
+        gallery_labels = load_gallery_labels(index_config, rows)
+        logger.info("label accuracy of exact search: {:.4f}".format(
+            label_accuracy(gt, gallery_labels, query_labels)))
+    logger.info("gallery: {}, queries: {}, dim: {}, recall@{}".format(
+        gallery.shape[0], queries.shape[0], gallery.shape[1], topk))
+
+    results = []
+    for method in args.index_methods.split(","):
+        build_params = {}
+        if method in ["IVF", "IVFPQ", "OPQ", "IVFSQ8"]:
+            build_params["nlist"] = index_config.get("nlist", None)
+        if method in ["IVFPQ", "OPQ"]:
+            build_params["pq_m"] = index_config.get("pq_m", None)
+        factory = get_index_method(method, gallery.shape[0],
+                                   gallery.shape[1], dist_type,
+                                   **build_params)
+        index = build_index(gallery, factory, dist_type, args.max_train)
+        memory = index_memory(index)
+        for params, searcher in candidates(method, factory, index, gallery,
+                                           dist_type, args, topk):
+            result = measure(searcher, queries, gt, topk, args.batch_size)
+            result.update({
+                "method": method,
+                "factory": factory,
+                "build_params":
+                {k: v
+                 for k, v in build_params.items() if v is not None},
+                "params": params,
+                "memory": memory
+            })
+            if query_labels is not None:
+                _, ids = searcher.search(queries, topk)
+                result["label_acc"] = label_accuracy(ids, gallery_labels,
+                                                     query_labels)
+            results.append(result)
+            logger.info(format_result(result))
+
+    front = pareto_front(results)
+    header = "{:<28}{:<28}{:>8}{:>10}{:>10}{:>12}".format(
+        "index", "params", "recall", "qps", "p99(ms)", "memory(MB)")
+    if query_labels is not None:
+        header += "{:>10}".format("label_acc")
+    logger.info("Pareto front:\n{}".format("\n".join(
+        [header] + [format_result(r) for r in front])))
+    choice = choose(front, args.target_recall, args.max_p99_ms)
+    logger.info("Choose: {}".format(format_result(choice)))
+    if not args.dry_run:
+        write_config(args.config, args.output_config or args.config, choice)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args, config.get_config(args.config, overrides=args.override))